@@ -14,6 +14,14 @@ import argparse
 import numpy as np
 import random
 import scipy.sparse as sp
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import tempfile
+from common.cache import load_cached, csr_to_arrays, csr_from_arrays
+from common.ingest import NodeIndex, edge_file_to_csr, DEFAULT_CHUNK_SIZE
+from common.profiling import profiler, enable_profiling
+from common.evaluation import EvaluationScheduler, validation_log
 
 
 class GATLayer(nn.Module):
@@ -35,7 +43,7 @@ class GATLayer(nn.Module):
         nn.init.xavier_uniform_(self.a.data,gain=1.414)
     
     def forward(self,h,adj):
-        Wh = torch.mm(h,self.w)
+        Wh = torch.sparse.mm(h,self.w) if h.is_sparse else torch.mm(h,self.w)
         e = self._prepare_attentional_mechanism_input(Wh)
         zero_vec = -9e15*torch.ones_like(e)
         attention = torch.where(adj > 0, e, zero_vec) # adj>0的位置使用e对应位置的值替换，其余都为-9e15，这样设定经过Softmax后每个节点对应的行非邻居都会变为0。
@@ -56,48 +64,252 @@ class GATLayer(nn.Module):
         
         e = Wh1+Wh2.T # Wh1的每个原始与Wh2的所有元素相加，生成N*N的矩阵
         return self.leakyrelu(e)
+
+
+def segment_softmax(e, index, num_segments):
+    """按index分段做Softmax, 即对指向同一个目标节点的所有边做Softmax
+    Params:
+        e: 每条边的注意力分数 E*...
+        index: 每条边所属的目标节点 E
+        num_segments: 目标节点总数N
+    """
+    expanded = index.view(-1, *([1] * (e.dim() - 1))).expand_as(e)
+    e_max = e.new_full((num_segments,) + e.shape[1:], float('-inf'))
+    e_max = e_max.scatter_reduce(0, expanded, e.detach(), reduce='amax', include_self=True) # 每段的最大值，减去后数值更稳定
+    e = torch.exp(e - e_max[index])
+    e_sum = e.new_zeros((num_segments,) + e.shape[1:]).index_add_(0, index, e)
+    return e / (e_sum[index] + 1e-16)
+
+
+class SpGATLayer(GATLayer):
+    """只在E条边上计算注意力的GATLayer, 内存和时间都与E成正比
+    参数与GATLayer完全相同, 两者的state_dict可以互相加载, GATLayer作为稠密的参照实现
+    GAT模型使用融合多头的MultiHeadGATLayer, 这两个单头层不再直接使用, 作为其逐头的参照实现保留, tests/test_gat.py用它们检查融合层
+    """
+
+    def forward(self,h,edge_index):
+        """
+        Params:
+            h: 节点特征 N*in_size
+            edge_index: 2*E的边列表, 第0行为目标节点i, 第1行为邻居节点j, 对应稠密adj中adj[i,j]>0的位置
+        """
+        N = h.size(0)
+        row, col = edge_index
+        Wh = torch.sparse.mm(h,self.w) if h.is_sparse else torch.mm(h,self.w)
+        Wh1 = torch.matmul(Wh,self.a[:self.output_feature,:]).squeeze(1) # N
+        Wh2 = torch.matmul(Wh,self.a[self.output_feature:,:]).squeeze(1) # N
+        e = self.leakyrelu(Wh1[row] + Wh2[col]) # 只计算存在的边 E
+        attention = segment_softmax(e, row, N) # 对每个目标节点的所有入边做Softmax
+        attention = F.dropout(attention, self.dropout, training=self.training)
+        h_prime = torch.zeros_like(Wh).index_add_(0, row, attention.unsqueeze(1) * Wh[col]) # 按目标节点scatter-add聚合
+        
+        if self.concat:
+            return F.elu(h_prime)
+        else:
+            return h_prime
     
+class MultiHeadGATLayer(nn.Module):
+    """把nheads个注意力头融合到一起的GAT层
+    所有头的w拼成一个 in_size*(nheads*out_size) 的矩阵, 一次矩阵乘法完成投影
+    sparse=True时所有头的边注意力在一次批量计算中完成; 稠密矩阵逐头计算N*N的注意力, 比构造H*N*N的张量更快, 反向传播保存的中间结果也更少
+    concat=True时各头输出拼接为 N*(nheads*out_size), 否则取各头的平均 N*out_size
+    """
+
+    def __init__(self,input_feature,output_feature,nheads,dropout,alpha,concat=True,sparse=False):
+        super(MultiHeadGATLayer,self).__init__()
+        self.input_feature = input_feature
+        self.output_feature = output_feature
+        self.nheads = nheads
+        self.alpha = alpha
+        self.dropout = dropout
+        self.concat = concat
+        self.sparse = sparse
+        self.a = nn.Parameter(torch.empty(size=(nheads,2*output_feature)))
+        self.w = nn.Parameter(torch.empty(size=(input_feature,nheads*output_feature)))
+        self.leakyrelu = nn.LeakyReLU(self.alpha)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # 每个头单独初始化, 与单头GATLayer的分布一致
+        w = self.w.data.view(self.input_feature,self.nheads,self.output_feature)
+        for i in range(self.nheads):
+            nn.init.xavier_uniform_(w[:,i,:],gain=1.414)
+            nn.init.xavier_uniform_(self.a.data[i].unsqueeze(1),gain=1.414)
+
+    def forward(self,h,adj,num_dst=None):
+        """num_dst不为None时adj是采样得到的二部图块, 目标节点是输入节点的前num_dst个, 只输出这些节点"""
+        N = h.size(0)
+        M = N if num_dst is None else num_dst
+        Wh = torch.sparse.mm(h,self.w) if h.is_sparse else torch.mm(h,self.w) # 稀疏特征直接做稀疏×稠密乘法
+        Wh = Wh.view(N,self.nheads,self.output_feature) # 一次投影得到所有头 N*H*out
+        Wh1 = (Wh[:M]*self.a[:,:self.output_feature]).sum(-1) # M*H
+        Wh2 = (Wh*self.a[:,self.output_feature:]).sum(-1) # N*H
+        if self.sparse:
+            row, col = adj
+            e = self.leakyrelu(Wh1[row] + Wh2[col]) # E*H
+            attention = segment_softmax(e, row, M)
+            attention = F.dropout(attention, self.dropout, training=self.training)
+            h_prime = Wh.new_zeros((M,)+Wh.shape[1:]).index_add_(0, row, attention.unsqueeze(-1) * Wh[col]) # M*H*out
+        else:
+            # 稠密矩阵逐头计算N*N的分数, 不构造H*N*N的张量; 掩码只构造一次, 所有头共用
+            bias = torch.zeros_like(adj).masked_fill_(adj <= 0, -9e15) # 非邻居的分数加上-9e15, Softmax后为0
+            h_prime = []
+            for i in range(self.nheads):
+                e = self.leakyrelu(Wh1[:,i:i+1] + Wh2[:,i].unsqueeze(0)) # N*N
+                attention = F.softmax(e + bias, dim=1)
+                attention = F.dropout(attention, self.dropout, training=self.training)
+                h_prime.append(torch.mm(attention, Wh[:,i]))
+            h_prime = torch.stack(h_prime, 1) # N*H*out
+
+        if self.concat:
+            return F.elu(h_prime.reshape(M,self.nheads*self.output_feature)) # 与逐头torch.cat的顺序一致
+        else:
+            return h_prime.mean(1)
+
+
 class GAT(nn.Module):
-    def __init__(self,input_size,hidden_size,output_size,dropout,alpha,nheads,concat=True):
+    def __init__(self,input_size,hidden_size,output_size,dropout,alpha,nheads,concat=True,sparse=False):
         super(GAT,self).__init__()
         self.dropout= dropout
-        self.attention = [GATLayer(input_size, hidden_size, dropout=dropout, alpha=alpha,concat=True) for _ in range(nheads)]
-        for i,attention in enumerate(self.attention):
-            self.add_module('attention_{}'.format(i),attention)
-        
-        self.out_att = GATLayer(hidden_size*nheads, output_size, dropout=dropout, alpha=alpha,concat=False)
+        self.sparse = sparse # sparse=True时adj为2*E的边列表, 否则为N*N的稠密矩阵
+        self.attention = MultiHeadGATLayer(input_size, hidden_size, nheads, dropout=dropout, alpha=alpha, concat=True, sparse=sparse)
+        self.out_att = MultiHeadGATLayer(hidden_size*nheads, output_size, 1, dropout=dropout, alpha=alpha, concat=False, sparse=sparse)
         
     def forward(self,x,adj):
         #x = F.dropout(x,self.dropout,training=self.training)
-        x = torch.cat([att(x,adj) for att in self.attention],dim=1)
+        x = self.attention(x,adj)
         #x = F.dropout(x,self.dropout,training=self.training)
         x = F.elu(self.out_att(x,adj))
         
         return F.log_softmax(x,dim=1)
 
+    def forward_blocks(self,x,blocks):
+        """在NeighbourSampler采样的二部图块上前向计算, 需要sparse=True
+        blocks[i]=(edge_index, num_dst), 返回最后一个块的目标节点(即这一批节点)的输出
+        """
+        (edge_index1, num_dst1), (edge_index2, num_dst2) = blocks
+        x = self.attention(x,edge_index1,num_dst1)
+        x = F.elu(self.out_att(x,edge_index2,num_dst2))
+        return F.log_softmax(x,dim=1)
+
+class NeighbourSampler(object):
+    """逐层采样邻居, 为一批目标节点构造二部图块
+    从最后一层往前, 每个目标节点最多采样fanouts[i]个邻居并加上自环, 目标节点总是排在源节点的最前面
+    """
+    def __init__(self,edge_index,num_nodes,fanouts):
+        row, col = edge_index.numpy()
+        keep = row != col # 自环在采样后统一加入
+        order = np.argsort(row[keep], kind='stable')
+        self.indices = col[keep][order]
+        self.indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(row[keep], minlength=num_nodes), out=self.indptr[1:])
+        self.fanouts = fanouts
+
+    def _sample_layer(self,nodes,fanout):
+        """每个节点不放回地采样最多fanout个邻居, 返回 (目标节点在nodes中的位置, 邻居)"""
+        start, end = self.indptr[nodes], self.indptr[nodes + 1]
+        degree = end - start
+        seg = np.repeat(np.arange(len(nodes)), degree)
+        offset = np.arange(degree.sum()) - np.repeat(np.cumsum(degree) - degree, degree)
+        neighs = self.indices[np.repeat(start, degree) + offset]
+        order = np.lexsort((np.random.rand(len(seg)), seg)) # 段内随机排列, 取前fanout个
+        rank = np.arange(len(seg)) - np.repeat(np.cumsum(degree) - degree, degree)
+        keep = order[rank < fanout]
+        return seg[keep], neighs[keep]
+
+    def sample(self,nodes):
+        """Return: (blocks, input_nodes), blocks按从输入层到输出层的顺序排列"""
+        nodes = np.asarray(nodes, dtype=np.int64)
+        blocks = []
+        for fanout in reversed(self.fanouts):
+            seg, neighs = self._sample_layer(nodes, fanout)
+            num_dst = len(nodes)
+            src, first, inverse = np.unique(np.concatenate((nodes, neighs)), return_index=True, return_inverse=True)
+            order = np.argsort(first, kind='stable') # 按第一次出现的位置排列, 目标节点在最前面
+            rank = np.empty(len(src), dtype=np.int64)
+            rank[order] = np.arange(len(src))
+            row = np.concatenate((np.arange(num_dst), seg))
+            col = np.concatenate((np.arange(num_dst), rank[inverse[num_dst:]]))
+            blocks.insert(0, (torch.from_numpy(np.vstack((row, col))), num_dst))
+            nodes = src[order]
+        return blocks, torch.from_numpy(nodes)
+
 def train(epoch):
     t = time.time()
     model.train()
     optimizer.zero_grad()
-    output = model(features,adj)
-    loss_train = F.nll_loss(output[idx_train],labels[idx_train])
-    acc_train = accuracy(output[idx_train], labels[idx_train])
-    loss_train.backward()
-    optimizer.step()
-    model.eval()
-    output = model(features, adj)
-    acc_val = accuracy(output[idx_val],labels[idx_val])
-    loss_val = F.nll_loss(output[idx_val], labels[idx_val])
+    with profiler.phase('forward'):
+        output = model(features,adj)
+    with profiler.phase('loss'):
+        loss_train = F.nll_loss(output[idx_train],labels[idx_train])
+        acc_train = accuracy(output[idx_train], labels[idx_train])
+    with profiler.phase('backward'):
+        loss_train.backward()
+    with profiler.phase('step'):
+        optimizer.step()
+    val = scheduler.step(epoch)     # 按节奏在inference_mode下验证, 不验证的epoch不再做第二次前向
     print('Epoch: {:04d}'.format(epoch+1),
           'loss_train: {:.4f}'.format(loss_train.data.item()),
           'acc_train: {:.4f}'.format(acc_train.data.item()),
-          'loss_val: {:.4f}'.format(loss_val.data.item()),
-          'acc_val: {:.4f}'.format(acc_val.data.item()),
+          *validation_log(val),
           'time: {:.4f}s'.format(time.time() - t))
-    return loss_val.data.item()
 
+def minibatch_forward(nodes):
+    """逐批采样邻居并计算nodes的输出"""
+    outputs = []
+    for i in range(0, len(nodes), args.batch_size):
+        with profiler.phase('sample'):
+            blocks, input_nodes = sampler.sample(nodes[i:i + args.batch_size])
+        profiler.count('nodes', len(input_nodes))
+        with profiler.phase('gather'):
+            x = features.index_select(0, input_nodes) if features.is_sparse else features[input_nodes]
+        with profiler.phase('forward'):
+            outputs.append(model.forward_blocks(x, blocks))
+    return torch.cat(outputs)
+
+def train_minibatch(epoch):
+    t = time.time()
+    model.train()
+    perm = idx_train[torch.randperm(len(idx_train))]
+    loss_sum, correct = 0., 0.
+    for i in range(0, len(perm), args.batch_size):
+        batch = perm[i:i + args.batch_size]
+        optimizer.zero_grad()
+        output = minibatch_forward(batch)
+        with profiler.phase('loss'):
+            loss_train = F.nll_loss(output, labels[batch]) # 损失只在这一批目标节点上计算
+        with profiler.phase('backward'):
+            loss_train.backward()
+        with profiler.phase('step'):
+            optimizer.step()
+        loss_sum += loss_train.item() * len(batch)
+        correct += accuracy(output, labels[batch]).item() * len(batch)
+    val = scheduler.step(epoch)
+    print('Epoch: {:04d}'.format(epoch+1),
+          'loss_train: {:.4f}'.format(loss_sum / len(perm)),
+          'acc_train: {:.4f}'.format(correct / len(perm)),
+          *validation_log(val),
+          'time: {:.4f}s'.format(time.time() - t))
+
+def validate():
+    """验证集上的(损失, 准确率), 由EvaluationScheduler在inference_mode下调用"""
+    if sampler is not None:
+        output = minibatch_forward(idx_val)
+        return F.nll_loss(output, labels[idx_val]).item(), accuracy(output, labels[idx_val]).item()
+    output = model(features, adj)
+    return F.nll_loss(output[idx_val], labels[idx_val]).item(), accuracy(output[idx_val], labels[idx_val]).item()
+
+@torch.inference_mode()
 def compute_test():
     model.eval()
+    if sampler is not None:
+        output = minibatch_forward(idx_test)
+        loss_test = F.nll_loss(output, labels[idx_test])
+        acc_test = accuracy(output, labels[idx_test])
+        print("Test set results:",
+              "loss= {:.4f}".format(loss_test.data.item()),
+              "accuracy= {:.4f}".format(acc_test.data.item()))
+        return
     output = model(features, adj)
     loss_test = F.nll_loss(output[idx_test], labels[idx_test])
     acc_test = accuracy(output[idx_test], labels[idx_test])
@@ -146,38 +358,64 @@ def sparse_mx_to_torch_sparse_tensor(sparse_mx):
     shape = torch.Size(sparse_mx.shape)
     return torch.sparse.FloatTensor(indices, values, shape)
 
-def load_data(path="./cora/", dataset="cora"):
-    """读取引文网络数据cora"""
-    print('Loading {} dataset...'.format(dataset))
+def preprocess_data(path="./cora/", dataset="cora", chunk_size=DEFAULT_CHUNK_SIZE):
+    """解析cora的文本文件并做归一化, 返回可以缓存的数组
+    边文件按chunk_size行分块读取, 经磁盘上的有序段归并成CSR, 不会一次读入整个文件
+    """
     idx_features_labels = np.genfromtxt("{}{}.content".format(path, dataset),
                                         dtype=np.dtype(str)) # 使用numpy读取.txt文件
     features = sp.csr_matrix(idx_features_labels[:, 1:-1], dtype=np.float32) # 获取特征矩阵
     labels = encode_onehot(idx_features_labels[:, -1]) # 获取标签
 
-    # build graph
-    idx = np.array(idx_features_labels[:, 0], dtype=np.int32)
-    idx_map = {j: i for i, j in enumerate(idx)}
-    edges_unordered = np.genfromtxt("{}{}.cites".format(path, dataset),
-                                    dtype=np.int32)
-    edges = np.array(list(map(idx_map.get, edges_unordered.flatten())),
-                     dtype=np.int32).reshape(edges_unordered.shape)
-    adj = sp.coo_matrix((np.ones(edges.shape[0]), (edges[:, 0], edges[:, 1])),
-                        shape=(labels.shape[0], labels.shape[0]),
-                        dtype=np.float32)
-
     # build symmetric adjacency matrix
-    adj = adj + adj.T.multiply(adj.T > adj) - adj.multiply(adj.T > adj)
+    node_index = NodeIndex(idx_features_labels[:, 0])
+    with tempfile.TemporaryDirectory() as out_dir:
+        indptr, indices = edge_file_to_csr("{}{}.cites".format(path, dataset), node_index, out_dir,
+                                           chunk_size=chunk_size, dedupe=False)
+        adj = sp.csr_matrix((np.ones(len(indices), dtype=np.float32), np.array(indices), np.array(indptr)),
+                            shape=(labels.shape[0], labels.shape[0]))
+        adj.sum_duplicates() # 与原来的coo_matrix相同, 重复的边累加为权重
+    adj = adj.maximum(adj.T).tocsr() # 等价于 adj + adj.T.multiply(adj.T > adj) - adj.multiply(adj.T > adj)
+    edges = adj
 
     features = normalize(features)
     adj = normalize_adj(adj + sp.eye(adj.shape[0]))
 
+    arrays = {'labels': np.where(labels)[1].astype(np.int64)}
+    arrays.update(csr_to_arrays('features', features))
+    arrays.update(csr_to_arrays('edges', edges))
+    arrays.update(csr_to_arrays('adj', adj))
+    return arrays
+
+def load_data(path="./cora/", dataset="cora", sparse=False, use_cache=True, sparse_features=False):
+    """读取引文网络数据cora
+    sparse=True时adj以2*E的边列表返回, 不再生成N*N的稠密矩阵
+    use_cache=True时预处理结果缓存在磁盘上, 之后的启动直接内存映射读取
+    sparse_features=True时特征以torch稀疏张量返回, 不再转为稠密矩阵
+    """
+    print('Loading {} dataset...'.format(dataset))
+    sources = ["{}{}.content".format(path, dataset), "{}{}.cites".format(path, dataset)]
+    options = {'model': 'gat', 'features': 'row', 'adj': 'normalize_adj', 'duplicates': 'sum'}
+    build = lambda: preprocess_data(path, dataset)
+    arrays = load_cached(sources, options, build) if use_cache else build()
+    features = csr_from_arrays(arrays, 'features')
+    adj = csr_from_arrays(arrays, 'adj')
+    labels = np.array(arrays['labels'])
+
     idx_train = range(140)
     idx_val = range(200, 500)
     idx_test = range(500, 1500)
 
-    features = torch.FloatTensor(np.array(features.todense()))
-    labels = torch.LongTensor(np.where(labels)[1])
-    adj = torch.FloatTensor(np.array(adj.todense()))
+    if sparse_features:
+        features = sparse_mx_to_torch_sparse_tensor(features)
+    else:
+        features = torch.FloatTensor(np.array(features.todense()))
+    labels = torch.LongTensor(labels)
+    if sparse:
+        adj = adj.tocoo()
+        adj = torch.LongTensor(np.vstack((adj.row, adj.col)).astype(np.int64))
+    else:
+        adj = torch.FloatTensor(np.array(adj.todense()))
 
     idx_train = torch.LongTensor(idx_train)
     idx_val = torch.LongTensor(idx_val)
@@ -197,33 +435,40 @@ if __name__ == '__main__':
     parser.add_argument('--dropout', type=float, default=0.6, help='Dropout rate (1 - keep probability).')
     parser.add_argument('--alpha', type=float, default=0.2, help='Alpha for the leaky_relu.')
     parser.add_argument('--patience', type=int, default=100, help='Patience')
+    parser.add_argument('--eval_every', type=int, default=1, help='Validate every k epochs.')
+    parser.add_argument('--adaptive_eval', action='store_true', default=False, help='Double the validation interval (up to 16 epochs) while the validation loss does not improve.')
     parser.add_argument('--seed',type=int,default=17,help='Seed number')
+    parser.add_argument('--sparse', action='store_true', default=False, help='Use edge-list attention instead of the dense N*N matrix.')
+    parser.add_argument('--sparse_features', action='store_true', default=False, help='Keep the node features as a sparse tensor.')
+    parser.add_argument('--batch_size', type=int, default=0, help='Neighbour-sampled mini-batch size (0 = full batch).')
+    parser.add_argument('--fanouts', type=str, default='10,10', help='Neighbours sampled per node for each layer, input layer first.')
+    parser.add_argument('--profile', type=str, default=None, help='Write per-phase timings to this JSON file (plus a Chrome trace).')
+    parser.add_argument('--torch_profiler', action='store_true', default=False, help='Also record a torch.profiler trace when --profile is given.')
     args = parser.parse_args()
     random.seed(args.seed)
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
-    adj, features, labels, idx_train, idx_val, idx_test = load_data()
-    model = GAT(input_size=features.shape[1],hidden_size=args.hidden,output_size=int(labels.max())+1,dropout=args.dropout,nheads=8,alpha=args.alpha)
+    if args.profile:
+        enable_profiling(args.profile, torch_profiler=args.torch_profiler)
+    if args.batch_size > 0: # mini-batch训练在边列表上采样, 总是使用稀疏注意力
+        args.sparse = True
+    adj, features, labels, idx_train, idx_val, idx_test = load_data(sparse=args.sparse, sparse_features=args.sparse_features)
+    model = GAT(input_size=features.shape[1],hidden_size=args.hidden,output_size=int(labels.max())+1,dropout=args.dropout,nheads=8,alpha=args.alpha,sparse=args.sparse)
+    sampler = None
+    if args.batch_size > 0:
+        sampler = NeighbourSampler(adj, labels.shape[0], [int(f) for f in args.fanouts.split(',')])
     optimizer = optim.Adam(model.parameters(),lr=args.lr,weight_decay=args.weight_decay)
     
+    scheduler = EvaluationScheduler(model, validate, every=args.eval_every, adaptive=args.adaptive_eval, patience=args.patience)
+    
     t_total = time.time()
-    loss_values = []
-    bad_counter = 0
-    best = 1000+1
-    best_epoch = 0
-
-
-    for epoch in range(1000):
-        loss_values.append(train(epoch))
-        if loss_values[-1] < best:
-            best = loss_values[-1]
-            best_epoch = epoch
-            bad_counter = 0
-        else:
-            bad_counter += 1
-        
-        if bad_counter == args.patience:
+    for epoch in range(args.epochs):
+        train_minibatch(epoch) if sampler is not None else train(epoch)
+        if scheduler.should_stop:
             break
     print("Optimization Finished!")
     print("Total time elapsed: {:.4f}s".format(time.time() - t_total))
+    print('Loading {}th epoch'.format(scheduler.restore() + 1))
+    if profiler.enabled:
+        print(profiler.report())
     compute_test()
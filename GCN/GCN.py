@@ -13,13 +13,22 @@ import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 import scipy.sparse as sp
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import tempfile
+from common.cache import load_cached, csr_to_arrays, csr_from_arrays, array_digest
+from common.ingest import NodeIndex, edge_file_to_csr, DEFAULT_CHUNK_SIZE
+from common.profiling import profiler, enable_profiling
+from common.evaluation import EvaluationScheduler, validation_log
 import argparse
 # Two layer gcn
 class GCNLayer(nn.Module):
-    def __init__(self,input_features,output_features,bias=False):
+    def __init__(self,input_features,output_features,bias=False,propagate=True):
         super(GCNLayer,self).__init__()
         self.input_features = input_features
         self.output_features = output_features
+        self.propagate = propagate # propagate=False时输入已经是预先计算好的adj·x, 只做稠密矩阵乘法
         self.weights = nn.Parameter(torch.FloatTensor(input_features,output_features))
         if bias:
             self.bias = nn.Parameter(torch.FloatTensor(output_features))
@@ -34,19 +43,20 @@ class GCNLayer(nn.Module):
             self.bias.data.uniform_(-std,std)
 
     def forward(self,adj,x):
-        support = torch.mm(x,self.weights)
-        output = torch.spmm(adj,support)
+        support = torch.sparse.mm(x,self.weights) if x.is_sparse else torch.mm(x,self.weights) # 稀疏特征直接做稀疏×稠密乘法
+        output = torch.spmm(adj,support) if self.propagate else support
         if self.bias is not None:
             return output+self.bias
         return output
 
 class GCN(nn.Module):
-    def __init__(self,input_size,hidden_size,num_class,dropout,bias=False):
+    """两层GCN, precompute=True时输入的x应为precompute_features得到的adj·x, 第一层不再做spmm"""
+    def __init__(self,input_size,hidden_size,num_class,dropout,bias=False,precompute=False):
         super(GCN,self).__init__()
         self.input_size=input_size
         self.hidden_size=hidden_size
         self.num_class = num_class
-        self.gcn1 = GCNLayer(input_size,hidden_size,bias=bias)
+        self.gcn1 = GCNLayer(input_size,hidden_size,bias=bias,propagate=not precompute)
         self.gcn2 = GCNLayer(hidden_size,num_class,bias=bias)
         self.dropout = dropout
     def forward(self,adj,x):
@@ -55,6 +65,41 @@ class GCN(nn.Module):
         x = self.gcn2(adj,x)
         return F.log_softmax(x,dim=1)
 
+class SGC(nn.Module):
+    """完全线性化的GCN(SGC): softmax(adj^k·x·W), 输入为precompute_features得到的adj^k·x, 训练时没有任何稀疏运算"""
+    def __init__(self,input_size,num_class,bias=True):
+        super(SGC,self).__init__()
+        self.fc = nn.Linear(input_size,num_class,bias=bias)
+    def forward(self,adj,x):
+        return F.log_softmax(self.fc(x),dim=1)
+
+def propagate_features(adj,features,k=1):
+    """计算adj^k·features"""
+    for _ in range(k):
+        features = torch.spmm(adj,features)
+    return features
+
+def tensor_digest(t):
+    """稠密或稀疏张量的哈希: 形状、非零元素个数、下标和值"""
+    if t.is_sparse:
+        t = t.coalesce()
+        return array_digest([np.array(t.shape), np.array(t._nnz()), t.indices().numpy(), t.values().numpy()])
+    return array_digest([t.detach().numpy()])
+
+def precompute_features(adj,features,k=1,use_cache=False,key=None,cache_dir=None):
+    """预先计算adj^k·features, adj和features在训练中不变, 只需计算一次
+    use_cache=True时结果缓存在磁盘上, 之后的启动直接读取; 缓存的键由adj、features的内容和k决定,
+    也可以传入key(例如数据集和预处理选项)代替对输入计算哈希
+    """
+    if features.is_sparse: # adj·x的非零元素远多于x, 传播后以稠密形式保存
+        features = features.to_dense()
+    build = lambda: {'features': propagate_features(adj,features,k).numpy()}
+    if not use_cache:
+        return torch.from_numpy(build()['features'])
+    options = {'model': 'gcn', 'propagate': k,
+               'inputs': key if key is not None else [tensor_digest(adj), tensor_digest(features)]}
+    return torch.from_numpy(np.array(load_cached([], options, build, cache_dir=cache_dir)['features']))
+
 def encode_onehot(labels):
     classes = set(labels)
     classes_dict = {c: np.identity(len(classes))[i, :] for i, c in
@@ -81,11 +126,12 @@ def sparse_mx_to_torch_sparse_tensor(sparse_mx):
     shape = torch.Size(sparse_mx.shape)
     return torch.sparse.FloatTensor(indices, values, shape)
 
-def prepare_data(features,edge_list,labels):
+def prepare_data(features,edge_list,labels,sparse_features=False):
     """准备输入数据
     Params:
         features:网络节点总数ee
         edge_list:连边列表e
+        sparse_features:为True时特征以torch稀疏张量返回, 不再转为稠密矩阵
     """
     # 构造输入特征
     features = sp.csr_matrix(features,dtype=np.float64)
@@ -94,43 +140,67 @@ def prepare_data(features,edge_list,labels):
     adj = adj + adj.T.multiply(adj.T > adj) - adj.multiply(adj.T > adj)
     adj = normalize(adj + sp.eye(adj.shape[0]))
     features = normalize(features)
-    features = torch.FloatTensor(np.array(features.todense()))
+    if sparse_features:
+        features = sparse_mx_to_torch_sparse_tensor(features)
+    else:
+        features = torch.FloatTensor(np.array(features.todense()))
     adj = sparse_mx_to_torch_sparse_tensor(adj)
     labels = torch.LongTensor(labels)
 
     return features,adj,labels
 
-def load_data(path="./cora/", dataset="cora"):
-    """读取引文网络数据cora"""
-    print('Loading {} dataset...'.format(dataset))
+def preprocess_data(path="./cora/", dataset="cora", chunk_size=DEFAULT_CHUNK_SIZE):
+    """解析cora的文本文件并做归一化, 返回可以缓存的数组
+    边文件按chunk_size行分块读取, 经磁盘上的有序段归并成CSR, 不会一次读入整个文件
+    """
     idx_features_labels = np.genfromtxt("{}{}.content".format(path, dataset),
                                         dtype=np.dtype(str)) # 使用numpy读取.txt文件
     features = sp.csr_matrix(idx_features_labels[:, 1:-1], dtype=np.float32) # 获取特征矩阵
     labels = encode_onehot(idx_features_labels[:, -1]) # 获取标签
 
-    # build graph
-    idx = np.array(idx_features_labels[:, 0], dtype=np.int32)
-    idx_map = {j: i for i, j in enumerate(idx)}
-    edges_unordered = np.genfromtxt("{}{}.cites".format(path, dataset),
-                                    dtype=np.int32)
-    edges = np.array(list(map(idx_map.get, edges_unordered.flatten())),
-                     dtype=np.int32).reshape(edges_unordered.shape)
-    adj = sp.coo_matrix((np.ones(edges.shape[0]), (edges[:, 0], edges[:, 1])),
-                        shape=(labels.shape[0], labels.shape[0]),
-                        dtype=np.float32)
-
     # build symmetric adjacency matrix
-    adj = adj + adj.T.multiply(adj.T > adj) - adj.multiply(adj.T > adj)
+    node_index = NodeIndex(idx_features_labels[:, 0])
+    with tempfile.TemporaryDirectory() as out_dir:
+        indptr, indices = edge_file_to_csr("{}{}.cites".format(path, dataset), node_index, out_dir,
+                                           chunk_size=chunk_size, dedupe=False)
+        adj = sp.csr_matrix((np.ones(len(indices), dtype=np.float32), np.array(indices), np.array(indptr)),
+                            shape=(labels.shape[0], labels.shape[0]))
+        adj.sum_duplicates() # 与原来的coo_matrix相同, 重复的边累加为权重
+    adj = adj.maximum(adj.T).tocsr() # 等价于 adj + adj.T.multiply(adj.T > adj) - adj.multiply(adj.T > adj)
+    edges = adj
 
     features = normalize(features)
     adj = normalize(adj + sp.eye(adj.shape[0]))
 
+    arrays = {'labels': np.where(labels)[1].astype(np.int64)}
+    arrays.update(csr_to_arrays('features', features))
+    arrays.update(csr_to_arrays('edges', edges))
+    arrays.update(csr_to_arrays('adj', adj))
+    return arrays
+
+def load_data(path="./cora/", dataset="cora", use_cache=True, sparse_features=False):
+    """读取引文网络数据cora
+    use_cache=True时预处理结果缓存在磁盘上, 之后的启动直接内存映射读取
+    sparse_features=True时特征以torch稀疏张量返回, 不再转为稠密矩阵
+    """
+    print('Loading {} dataset...'.format(dataset))
+    sources = ["{}{}.content".format(path, dataset), "{}{}.cites".format(path, dataset)]
+    options = {'model': 'gcn', 'features': 'row', 'adj': 'normalize', 'duplicates': 'sum'}
+    build = lambda: preprocess_data(path, dataset)
+    arrays = load_cached(sources, options, build) if use_cache else build()
+    features = csr_from_arrays(arrays, 'features')
+    adj = csr_from_arrays(arrays, 'adj')
+    labels = np.array(arrays['labels'])
+
     idx_train = range(140)
     idx_val = range(200, 500)
     idx_test = range(500, 1500)
 
-    features = torch.FloatTensor(np.array(features.todense()))
-    labels = torch.LongTensor(np.where(labels)[1])
+    if sparse_features:
+        features = sparse_mx_to_torch_sparse_tensor(features)
+    else:
+        features = torch.FloatTensor(np.array(features.todense()))
+    labels = torch.LongTensor(labels)
     adj = sparse_mx_to_torch_sparse_tensor(adj)
 
     idx_train = torch.LongTensor(idx_train)
@@ -139,6 +209,62 @@ def load_data(path="./cora/", dataset="cora"):
 
     return adj, features, labels, idx_train, idx_val, idx_test
 
+def partition_graph(adj, num_parts, seed=None):
+    """用BFS区域生长把图划分为num_parts个大小相近的簇, 不依赖METIS等外部库
+    Params:
+        adj: scipy CSR邻接矩阵
+        num_parts: 簇的数量
+    Return:
+        parts: 长度为N的数组, 每个节点所属的簇
+    """
+    N = adj.shape[0]
+    target = int(math.ceil(N / num_parts)) # 每个簇的目标大小
+    parts = np.full(N, -1, dtype=np.int64)
+    seeds = np.random.RandomState(seed).permutation(N)
+    pos = 0
+    for part in range(num_parts):
+        size = 0
+        frontier = np.zeros(0, dtype=np.int64)
+        while size < target:
+            frontier = np.unique(frontier[parts[frontier] < 0])
+            if len(frontier) == 0: # 当前连通块已经用完, 从新的种子节点继续生长
+                while pos < N and parts[seeds[pos]] >= 0:
+                    pos += 1
+                if pos == N:
+                    break
+                frontier = seeds[pos:pos + 1]
+            take = frontier[:target - size]
+            parts[take] = part
+            size += len(take)
+            frontier = np.concatenate((frontier[len(take):], adj[take].indices)) # 未分配的同层节点+下一层邻居
+    return parts
+
+class ClusterLoader(object):
+    """Cluster-GCN的mini-batch: 先把图划分为num_parts个簇, 每一步取clusters_per_batch个簇的导出子图并重新归一化
+    每一步的内存只与簇的大小有关
+    """
+    def __init__(self, adj, num_parts, clusters_per_batch=1, seed=None):
+        adj = adj.coalesce()
+        index = adj.indices().numpy()
+        self.pattern = sp.csr_matrix((np.ones(index.shape[1], dtype=np.float32), (index[0], index[1])),
+                                     shape=tuple(adj.shape)) # adj+I的非零结构
+        parts = partition_graph(self.pattern, num_parts, seed)
+        order = np.argsort(parts, kind='stable')
+        self.clusters = np.split(order, np.cumsum(np.bincount(parts, minlength=num_parts))[:-1])
+        self.clusters_per_batch = clusters_per_batch
+
+    def __len__(self):
+        return int(math.ceil(len(self.clusters) / self.clusters_per_batch))
+
+    def __iter__(self):
+        order = np.random.permutation(len(self.clusters))
+        for i in range(0, len(order), self.clusters_per_batch):
+            with profiler.phase('sample'):
+                nodes = np.sort(np.concatenate([self.clusters[c] for c in order[i:i + self.clusters_per_batch]]))
+                sub_adj = sparse_mx_to_torch_sparse_tensor(normalize(self.pattern[nodes][:, nodes])) # 子图重新归一化
+            profiler.count('nodes', len(nodes))
+            yield torch.from_numpy(nodes), sub_adj
+
 def accuracy(output, labels):
     preds = output.max(1)[1].type_as(labels)
     correct = preds.eq(labels).double()
@@ -149,24 +275,78 @@ def train_gcn(epoch):
     t = time.time()
     model.train()
     optimizer.zero_grad()
-    output = model(adj,features)
-    loss = F.nll_loss(output[idx_train],labels[idx_train])
-    acc = accuracy(output[idx_train],labels[idx_train])
-    loss.backward()
-    optimizer.step()
-    loss_val = F.nll_loss(output[idx_val],labels[idx_val])
-    acc_val = accuracy(output[idx_val], labels[idx_val])
+    with profiler.phase('forward'):
+        output = model(adj,features)
+    with profiler.phase('loss'):
+        loss = F.nll_loss(output[idx_train],labels[idx_train])
+        acc = accuracy(output[idx_train],labels[idx_train])
+    with profiler.phase('backward'):
+        loss.backward()
+    with profiler.phase('step'):
+        optimizer.step()
+    result = None
+    if args.fastmode and scheduler.due(epoch): # 直接用训练时(dropout打开)的输出验证, 不再做eval模式的前向
+        result = val_metrics(output.detach())
+    val = scheduler.step(epoch, result)
     print('Epoch: {:04d}'.format(epoch+1),
           'loss_train: {:.4f}'.format(loss.item()),
           'acc_train: {:.4f}'.format(acc.item()),
-          'loss_val: {:.4f}'.format(loss_val.item()),
-          'acc_val: {:.4f}'.format(acc_val.item()),
+          *validation_log(val),
+          'time: {:.4f}s'.format(time.time() - t))
+
+
+def train_cluster_gcn(epoch, loader):
+    t = time.time()
+    model.train()
+    train_mask = torch.zeros(labels.shape[0], dtype=torch.bool)
+    train_mask[idx_train] = True
+    loss_sum, correct, count = 0., 0., 0
+    for nodes, sub_adj in loader:
+        mask = train_mask[nodes]
+        if not mask.any(): continue
+        optimizer.zero_grad()
+        with profiler.phase('gather'):
+            x = features.index_select(0, nodes) if features.is_sparse else features[nodes]
+        with profiler.phase('forward'):
+            output = model(sub_adj, x)
+        with profiler.phase('loss'):
+            loss = F.nll_loss(output[mask], labels[nodes][mask]) # 只在这一批的训练节点上计算损失
+        with profiler.phase('backward'):
+            loss.backward()
+        with profiler.phase('step'):
+            optimizer.step()
+        loss_sum += loss.item() * mask.sum().item()
+        correct += accuracy(output[mask], labels[nodes][mask]).item() * mask.sum().item()
+        count += mask.sum().item()
+    val = scheduler.step(epoch)
+    print('Epoch: {:04d}'.format(epoch+1),
+          'loss_train: {:.4f}'.format(loss_sum / max(count, 1)),
+          'acc_train: {:.4f}'.format(correct / max(count, 1)),
+          *validation_log(val),
           'time: {:.4f}s'.format(time.time() - t))
 
+def cluster_inference(loader):
+    """逐个子图计算所有节点的输出"""
+    model.eval()
+    output = torch.zeros(labels.shape[0], int(labels.max()) + 1)
+    with torch.no_grad():
+        for nodes, sub_adj in loader:
+            x = features.index_select(0, nodes) if features.is_sparse else features[nodes]
+            output[nodes] = model(sub_adj, x)
+    return output
+
+def val_metrics(output):
+    return F.nll_loss(output[idx_val],labels[idx_val]).item(), accuracy(output[idx_val], labels[idx_val]).item()
 
+def validate():
+    """验证集上的(损失, 准确率), 由EvaluationScheduler在inference_mode下调用"""
+    output = cluster_inference(loader) if args.clusters > 0 else model(adj,features)
+    return val_metrics(output)
+
+@torch.inference_mode()
 def test():
     model.eval()
-    output = model(adj,features)
+    output = cluster_inference(loader) if args.clusters > 0 else model(adj,features)
     loss_test = F.nll_loss(output[idx_test], labels[idx_test])
     acc_test = accuracy(output[idx_test], labels[idx_test])
     print("Test set results:",
@@ -179,7 +359,13 @@ if __name__ == '__main__':
     parser.add_argument('--no-cuda', action='store_true', default=False,
                         help='Disables CUDA training.')
     parser.add_argument('--fastmode', action='store_true', default=False,
-                        help='Validate during training pass.')
+                        help='Validate during training pass (full batch only).')
+    parser.add_argument('--eval_every', type=int, default=1,
+                        help='Validate every k epochs.')
+    parser.add_argument('--adaptive_eval', action='store_true', default=False,
+                        help='Double the validation interval (up to 16 epochs) while the validation loss does not improve.')
+    parser.add_argument('--patience', type=int, default=0,
+                        help='Stop after this many epochs without a better validation loss (0 = never).')
     parser.add_argument('--seed', type=int, default=42, help='Random seed.')
     parser.add_argument('--epochs', type=int, default=200,
                         help='Number of epochs to train.')
@@ -191,11 +377,46 @@ if __name__ == '__main__':
                         help='Number of hidden units.')
     parser.add_argument('--dropout', type=float, default=0.5,
                         help='Dropout rate (1 - keep probability).')
+    parser.add_argument('--precompute', action='store_true', default=False,
+                        help='Cache adj*features once so the first layer is a dense matmul.')
+    parser.add_argument('--sgc', type=int, default=0,
+                        help='Train a linear SGC model on adj^k*features (k>0).')
+    parser.add_argument('--sparse_features', action='store_true', default=False,
+                        help='Keep the node features as a sparse tensor.')
+    parser.add_argument('--clusters', type=int, default=0,
+                        help='Number of graph partitions for Cluster-GCN mini-batch training (0 = full batch).')
+    parser.add_argument('--clusters_per_batch', type=int, default=2,
+                        help='Number of partitions merged into each Cluster-GCN mini-batch.')
+    parser.add_argument('--profile', type=str, default=None,
+                        help='Write per-phase timings to this JSON file (plus a Chrome trace).')
+    parser.add_argument('--torch_profiler', action='store_true', default=False,
+                        help='Also record a torch.profiler trace when --profile is given.')
 
     args = parser.parse_args()
     np.random.seed(args.seed)
-    adj, features, labels, idx_train, idx_val, idx_test = load_data()
-    model = GCN(features.shape[1],args.hidden,labels.max().item() + 1,dropout=args.dropout)
+    if args.profile:
+        enable_profiling(args.profile, torch_profiler=args.torch_profiler)
+    adj, features, labels, idx_train, idx_val, idx_test = load_data(sparse_features=args.sparse_features)
+    if args.clusters > 0: # Cluster-GCN在每个子图上传播, 不能使用全图预先计算的特征
+        model = GCN(features.shape[1],args.hidden,labels.max().item() + 1,dropout=args.dropout)
+        loader = ClusterLoader(adj, args.clusters, args.clusters_per_batch, seed=args.seed)
+    elif args.sgc > 0:
+        features = precompute_features(adj,features,k=args.sgc,use_cache=True)
+        model = SGC(features.shape[1],labels.max().item() + 1)
+    else:
+        if args.precompute:
+            features = precompute_features(adj,features,k=1,use_cache=True)
+        model = GCN(features.shape[1],args.hidden,labels.max().item() + 1,dropout=args.dropout,precompute=args.precompute)
     optimizer = optim.Adam(model.parameters(),lr=args.lr,weight_decay=args.weight_decay)
+    scheduler = EvaluationScheduler(model, validate, every=args.eval_every, adaptive=args.adaptive_eval, patience=args.patience)
     for epoch in range(args.epochs):
-        train_gcn(epoch)
+        if args.clusters > 0:
+            train_cluster_gcn(epoch, loader)
+        else:
+            train_gcn(epoch)
+        if scheduler.should_stop:
+            break
+    print('Loading {}th epoch'.format(scheduler.restore() + 1))
+    test()
+    if profiler.enabled:
+        print(profiler.report())
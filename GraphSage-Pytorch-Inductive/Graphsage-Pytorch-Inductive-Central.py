@@ -6,11 +6,131 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 import random
 import math
+import itertools
+import hashlib
+import multiprocessing
+import traceback
 from sklearn.utils import shuffle
 from sklearn.metrics import f1_score
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.cache import load_cached
+from common.ingest import NodeIndex, iter_mapped_edges
+from common.profiling import profiler
+from common.checkpoint import CheckpointManager
+
+class CSRGraph(object):
+    """
+    以CSR格式存放的邻接表, 节点v的邻居为 indices[indptr[v]:indptr[v+1]], 按编号升序排列
+    Parameters:
+        indptr: 长度为N+1的数组
+        indices: 长度为E的数组
+    """
+    def __init__(self, indptr, indices):
+        super(CSRGraph, self).__init__()
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.num_nodes = len(self.indptr) - 1
+    
+    @classmethod
+    def from_edges(cls, rows, cols, num_nodes):
+        " 由有向边 rows[i]->cols[i] 构造, 重复的边只保留一条 "
+        keys = np.unique(np.asarray(rows, dtype=np.int64) * num_nodes + np.asarray(cols, dtype=np.int64))  # 去重, 同时按(源节点,目标节点)排好序
+        rows, cols = keys // num_nodes, keys % num_nodes
+        indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=num_nodes), out=indptr[1:])
+        return cls(indptr, cols)
+    
+    @classmethod
+    def from_adj_lists(cls, adj_lists, num_nodes):
+        " 由 {v0:[v0的邻居集合],...} 形式的邻接表构造 "
+        nodes = np.fromiter(adj_lists.keys(), dtype=np.int64, count=len(adj_lists))
+        lens = np.fromiter((len(adj_lists[n]) for n in nodes), dtype=np.int64, count=len(nodes))
+        cols = np.fromiter((m for n in nodes for m in adj_lists[n]), dtype=np.int64, count=int(lens.sum()))
+        return cls.from_edges(np.repeat(nodes, lens), cols, num_nodes)
+    
+    def __len__(self):
+        return self.num_nodes
+    
+    @property
+    def num_edges(self):
+        return len(self.indices)
+    
+    def degree(self, nodes=None):
+        " 节点的度, nodes为None时返回所有节点的度 "
+        degree = np.diff(self.indptr)
+        return degree if nodes is None else degree[np.asarray(nodes, dtype=np.int64)]
+    
+    def neighbours(self, node):
+        " 单个节点的全部邻居 "
+        return self.indices[self.indptr[node]:self.indptr[node+1]]
+    
+    def batch_neighbours(self, nodes):
+        " 一批节点的全部邻居, 返回(每个邻居对应的节点在nodes中的位置, 邻居编号) "
+        nodes = np.asarray(nodes, dtype=np.int64)
+        degree = self.degree(nodes)
+        seg = np.repeat(np.arange(len(nodes)), degree)
+        offsets = np.arange(len(seg)) - np.repeat(np.cumsum(degree) - degree, degree)  # 每个邻居在所属节点邻居列表中的位置
+        return seg, self.indices[self.indptr[nodes][seg] + offsets]
+    
+    def sample_neighbours(self, nodes):
+        " 为每个节点均匀采样一个邻居, 没有邻居的节点返回其自身 "
+        nodes = np.asarray(nodes, dtype=np.int64)
+        degree = self.degree(nodes)
+        offsets = (np.random.random_sample(len(nodes)) * degree).astype(np.int64)
+        has_neigh = degree > 0
+        samples = nodes.copy()
+        samples[has_neigh] = self.indices[self.indptr[nodes[has_neigh]] + offsets[has_neigh]]
+        return samples
+    
+    def k_hop(self, nodes, k):
+        " 从nodes出发k跳以内可以到达的全部节点(包括nodes本身), 排好序返回, 开销只与到达的节点数有关 "
+        visited = np.unique(np.asarray(nodes, dtype=np.int64))
+        frontier = visited
+        for i in range(k):
+            if len(frontier) == 0: break
+            _, neighs = self.batch_neighbours(frontier)
+            frontier = np.setdiff1d(neighs, visited)    # 只向外扩展新到达的节点
+            visited = np.union1d(visited, frontier)
+        return visited
+    
+    def edges(self):
+        " 全部有向边, 返回(源节点, 目标节点) "
+        return np.repeat(np.arange(self.num_nodes), self.degree()), self.indices
+    
+    # 以下更新操作都返回新的CSRGraph, 原图不变, 正在使用原图的采样器和worker不受影响
+    def add_nodes(self, num):
+        " 在末尾增加num个没有边的节点 "
+        return CSRGraph(np.concatenate((self.indptr, np.full(num, self.indptr[-1]))), self.indices)
+    
+    def update_edges(self, add=None, remove=None):
+        """
+        删除再增加有向边, 无向边需要两个方向都给出
+        Parameters:
+            add: (rows, cols) 增加的边, 已经存在的边不会重复
+            remove: (rows, cols) 删除的边, 不存在的边被忽略
+        """
+        N = self.num_nodes
+        rows, cols = self.edges()
+        keys = rows * N + cols
+        if remove is not None:
+            keys = keys[~np.isin(keys, np.asarray(remove[0], dtype=np.int64) * N + np.asarray(remove[1], dtype=np.int64))]
+        if add is not None:
+            add_rows, add_cols = np.asarray(add[0], dtype=np.int64), np.asarray(add[1], dtype=np.int64)
+            assert len(add_rows) == 0 or max(add_rows.max(), add_cols.max()) < N, 'add_nodes first'
+            keys = np.concatenate((keys, add_rows * N + add_cols))
+        return CSRGraph.from_edges(keys // N, keys % N, N)
+    
+    def remove_nodes(self, nodes):
+        " 删除与nodes相连的全部边, 节点编号保留, 成为没有边的节点 "
+        rows, cols = self.edges()
+        keep = ~(np.isin(rows, nodes) | np.isin(cols, nodes))
+        return CSRGraph.from_edges(rows[keep], cols[keep], self.num_nodes)
 
 class DataCenter(object):
     """
@@ -23,64 +143,43 @@ class DataCenter(object):
         super(DataCenter, self).__init__()
         self.file_paths = file_paths
     
-    def load_Dataset(self, dataset='cora'):
-        "读取存放在指定路径的数据集"
-        feat_list = []  # 用于存放每个节点对应特征向量的列表
-        label_list = [] # 用于存放每个节点对应类别的列表
-        node_map = {}   # 将节点进行重新编码
-        label_map = {}  # 将label映射为数字
-        
+    def load_Dataset(self, dataset='cora', use_cache=True, mmap_mode='r'):
+        """
+        读取存放在指定路径的数据集
+        use_cache=True时解析结果和按划分生成的CSR邻接表缓存在磁盘上, 之后的启动直接内存映射读取
+        mmap_mode='c'时特征等数组是写时复制的映射, 可以直接转为tensor, 同一台机器上的多个进程共享同一份物理内存
+        """
         if dataset == 'cora' :
             content = self.file_paths['cora_content']   # 获取cora_content的地址
             cite = self.file_paths['cora_cite']         # 获取cora_cite的地址
-            with open(content) as f1:
-                for i, each_sample in enumerate(f1.readlines()):    # 遍历每个样本的特征
-                    sample_clean = each_sample.strip().split()      # 提取每个样本的特征，其中第一个元素和最后一个元素是样本名称和对应的标签
-                    feat_list.append(sample_clean[1:-1])
-                    node_map[sample_clean[0]] = i                   # 把节点名称映射为节点编号  e.g. 31336 0, 1061127 1
-                    label = sample_clean[-1]
-                    if label not in label_map.keys():
-                        label_map[label] = len(label_map)           # 把label转化为数字
-                    label_list.append(label_map[label])
-                feat_list = np.asarray(feat_list, dtype=np.float64)
-                label_list = np.asarray(label_list, dtype=np.int64)
-            
+            build = lambda: self._parse_cora(content, cite)
+            arrays = load_cached([content, cite], {'model': 'graphsage', 'feats': 'float32'}, build, mmap_mode=mmap_mode) if use_cache else build()
+            feat_list = arrays['feats']
+            label_list = np.array(arrays['labels'])
+            pairs = arrays['pairs']
+
             #print(feat_list.shape[0]) #2708
             assert len(feat_list) == len(label_list)
             train_index, test_index, val_index = self._split_data(feat_list.shape[0])   # 使用getattr()可以获得数据
-            
-            adj_lists = defaultdict(set)    # 获得每个节点的邻居{v0:[v0的邻居集合],v1:[v1的邻居集合]}
-            with open(cite) as f2:
-                for j, each_pair in enumerate(f2.readlines()):
-                    pair = each_pair.strip().split()
-                    assert len(pair) == 2   # 如果pair长度不为2，引起异常
-                    
-                    #cite文件里节点关系共有4中情况， 有train-train， train-非train， 非train-train， 非train-非train， 
-
-                    if node_map[pair[0]] not in adj_lists: adj_lists[node_map[pair[0]]] = set()
-                    if node_map[pair[1]] not in adj_lists: adj_lists[node_map[pair[1]]] = set()
-
-                    if node_map[pair[0]] in train_index and node_map[pair[1]] in train_index:  #保证train节点只与train节点相关联
-                        adj_lists[node_map[pair[0]]].add(node_map[pair[1]])
-                        adj_lists[node_map[pair[1]]].add(node_map[pair[0]])      
-                    
-                    if node_map[pair[0]] not in train_index:
-                        # if node_map[pair[1]] in train_index:        #非train-train只能单向,双向可以逆向加入。
-                        #     adj_lists[node_map[pair[0]]].add(node_map[pair[1]])
-                        #     adj_lists[node_map[pair[0]]].add(node_map[pair[1]])
-                        # else:                                       #非train-非train可以双向
-                        adj_lists[node_map[pair[0]]].add(node_map[pair[1]])
-                        adj_lists[node_map[pair[1]]].add(node_map[pair[0]])
-            
-            adj_lists_copy = adj_lists.copy()
+            src, dst = pairs[:, 0], pairs[:, 1]
+
+            #cite文件里节点关系共有4中情况， 有train-train， train-非train， 非train-train， 非train-非train，
+            train_mask = np.zeros(len(feat_list), dtype=bool)
+            train_mask[train_index] = True
 
-            for demo in adj_lists:
-                if demo in train_index and len(adj_lists[demo]) == 0:
-                    del adj_lists_copy[demo]
-                    i, = np.where(train_index == demo)
-                    train_index = np.delete(train_index,i)
+            def build_graph():
+                keep = (train_mask[src] & train_mask[dst]) | ~train_mask[src]    # train-train保证train节点只与train节点相关联, 非train-任意节点为双向边
+                graph = CSRGraph.from_edges(np.concatenate((src[keep], dst[keep])),
+                                            np.concatenate((dst[keep], src[keep])), len(feat_list))   # 直接生成CSR格式的邻接表
+                return {'indptr': graph.indptr, 'indices': graph.indices}
+            # 邻接表取决于训练集的划分, 以划分的哈希作为缓存的选项; 所有rank的划分相同, 映射同一份缓存
+            split = hashlib.sha1(np.ascontiguousarray(train_index, dtype=np.int64).tobytes()).hexdigest()[:16]
+            graph = load_cached([content, cite], {'model': 'graphsage', 'graph': 'inductive', 'split': split}, build_graph, mmap_mode=mmap_mode) if use_cache else build_graph()
+            adj_lists = CSRGraph(graph['indptr'], graph['indices'])
 
-            adj_lists = adj_lists_copy
+            in_cites = np.bincount(pairs.ravel(), minlength=len(feat_list)) > 0
+            isolated = in_cites & (adj_lists.degree() == 0)                     # 出现在cite文件中却没有任何邻居的train节点从训练集中去掉
+            train_index = train_index[~isolated[train_index]]
 
             setattr(self, dataset+'_test', test_index)
             setattr(self, dataset+'_val', val_index)
@@ -89,6 +188,24 @@ class DataCenter(object):
             setattr(self, dataset+'_labels', label_list)
             setattr(self, dataset+'_adj_lists', adj_lists)
             
+    def _parse_cora(self, content, cite):
+        " 解析cora的文本文件, 返回特征、标签和用节点编号表示的引用关系 "
+        with open(content) as f1:
+            num_cols = len(f1.readline().split())
+            f1.seek(0)
+            samples = np.array(f1.read().split()).reshape(-1, num_cols)    # 一次性切分全部样本，其中第一列和最后一列是样本名称和对应的标签
+        feat_list = samples[:, 1:-1].astype(np.float32)                   # 与模型参数相同的类型, 使用时不需要再转换
+        node_names = samples[:, 0]                                          # 节点名称的下标就是节点编号  e.g. 31336 0, 1061127 1
+        labels, first, label_list = np.unique(samples[:, -1], return_index=True, return_inverse=True)
+        label_rank = np.empty(len(labels), dtype=np.int64)
+        label_rank[np.argsort(first)] = np.arange(len(labels))             # 按label第一次出现的顺序编号
+        label_list = label_rank[label_list.ravel()]
+
+        node_index = NodeIndex(node_names)
+        pairs = list(iter_mapped_edges(cite, node_index))                  # 分块读取cite文件, 每块直接映射为节点编号, 如果pair长度不为2，引起异常
+        pairs = np.concatenate(pairs) if pairs else np.zeros((0, 2), dtype=np.int64)
+        return {'feats': feat_list, 'labels': label_list, 'pairs': pairs}
+
     def _split_data(self, number_of_nodes, test_split=3, val_split=6):
         " 获得训练集、验证集和测试集 "
         rand_indices = np.random.permutation(number_of_nodes)   # 打乱顺序
@@ -99,20 +216,193 @@ class DataCenter(object):
         train_index = rand_indices[test_size+val_size:]
         return train_index, test_index, val_index
         
+class RandomWalkSampler(object):
+    """
+    批量随机游走采样正例: 所有节点的所有游走同时前进, 每一步都是对CSRGraph的一次向量化采样
+    Parameters:
+        adj_lists: CSRGraph 邻接表
+        train_mask: 长度为N的bool数组, 只有训练节点可以作为正例
+        num_walks: 每个节点随机游走的次数
+        walk_len: 每次随机游走的步长
+        restart_prob: 每一步以该概率回到起点(不产生正例), 为0时即普通随机游走
+    """
+    def __init__(self, adj_lists, train_mask, num_walks=6, walk_len=1, restart_prob=0.0):
+        super(RandomWalkSampler, self).__init__()
+        self.adj_lists = adj_lists
+        self.train_mask = train_mask
+        self.num_walks = num_walks
+        self.walk_len = walk_len
+        self.restart_prob = restart_prob
+
+    def sample(self, nodes):
+        " 返回(P, 2)的正例对数组 [(起点, 游走到的训练节点), ...], 按起点排列, 没有邻居的节点不产生正例 "
+        nodes = np.asarray(nodes, dtype=np.int64)
+        nodes = nodes[self.adj_lists.degree(nodes) > 0]
+        starts = np.repeat(nodes, self.num_walks)       # 每个节点num_walks个游走者
+        curr_nodes = starts
+        pairs = [np.zeros((0, 2), dtype=np.int64)]
+        for j in range(self.walk_len):
+            next_nodes = self.adj_lists.sample_neighbours(curr_nodes)
+            if self.restart_prob > 0:
+                restart = np.random.random_sample(len(next_nodes)) < self.restart_prob
+                next_nodes[restart] = starts[restart]
+            keep = (next_nodes != starts) & self.train_mask[next_nodes]
+            pairs.append(np.stack((starts[keep], next_nodes[keep]), axis=1))
+            curr_nodes = next_nodes
+        pairs = np.concatenate(pairs)
+        return pairs[np.argsort(pairs[:, 0], kind='stable')]
+
+class AliasTable(object):
+    """
+    Walker别名表, 按给定的权重以O(1)的代价批量采样下标
+    Parameters:
+        weights: 长度为n的非负权重
+    """
+    def __init__(self, weights):
+        super(AliasTable, self).__init__()
+        weights = np.asarray(weights, dtype=np.float64)
+        n = len(weights)
+        scaled = weights * n / weights.sum()
+        self.prob = np.ones(n, dtype=np.float64)
+        self.alias = np.arange(n, dtype=np.int64)
+        small = np.flatnonzero(scaled < 1.0)
+        large = np.flatnonzero(scaled >= 1.0)
+        while len(small) > 0 and len(large) > 0:            # 每一轮把一批small和同样数量的large一一配对
+            m = min(len(small), len(large))
+            s, l = small[:m], large[:m]
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            small = np.concatenate((small[m:], l[scaled[l] < 1.0]))
+            large = np.concatenate((large[m:], l[scaled[l] >= 1.0]))
+
+    def sample(self, size):
+        index = np.random.randint(len(self.prob), size=size)
+        return np.where(np.random.random_sample(size) < self.prob[index], index, self.alias[index])
+
+class NegativeSampler(object):
+    """
+    负样本采样: 负样本为与目标节点相距超过num_hops跳的训练节点
+    用向量化的拒绝采样抽取候选节点, 再对照目标节点的k跳邻居集合剔除, 不会构造"远节点"全集
+    每个节点的k跳邻居集合是排好序的数组, 放在LRU缓存中, 缓存按所有集合的总元素数限制大小(单个集合最大可达O(N)), 图变化后需调用clear_cache
+    Parameters:
+        adj_lists: CSRGraph 邻接表
+        train_nodes: 训练节点, 负样本从中抽取
+        num_hops: 距离目标节点num_hops跳以内的节点不能作为负样本
+        weighted: 为True时按 度^0.75 的权重抽取候选节点(别名表), 否则均匀抽取
+        cache_elements: 缓存中所有k跳邻居集合的元素总数上限, 每个元素8字节, 默认约128MB
+        max_rounds: 拒绝采样的最大轮数, 仍然不够的节点改为精确计算
+    """
+    def __init__(self, adj_lists, train_nodes, num_hops=5, weighted=False, cache_elements=1 << 24, max_rounds=5):
+        super(NegativeSampler, self).__init__()
+        self.adj_lists = adj_lists
+        self.train_nodes = np.asarray(train_nodes, dtype=np.int64)
+        self.num_hops = num_hops
+        self.cache_elements = cache_elements
+        self.cached_elements = 0    # 缓存中现有的元素总数
+        self.max_rounds = max_rounds
+        self.weighted = weighted
+        self.alias = AliasTable(np.power(adj_lists.degree(self.train_nodes), 0.75)) if weighted else None
+        self.cache = OrderedDict()
+
+    def clear_cache(self):
+        self.cache.clear()
+        self.cached_elements = 0
+
+    def update_graph(self, adj_lists, touched, train_nodes=None):
+        """
+        换成更新后的图, 只丢弃可能变化的k跳邻居集合
+        touched: 出边发生变化的节点; 节点x的k跳邻居集合只有在x能在k跳以内到达touched中的节点时才会变化
+        train_nodes: 更新后的训练节点(可选), 例如删除了节点时
+        """
+        self.adj_lists = adj_lists
+        if train_nodes is not None:
+            self.train_nodes = np.asarray(train_nodes, dtype=np.int64)
+        if self.weighted:
+            self.alias = AliasTable(np.power(adj_lists.degree(self.train_nodes), 0.75))
+        touched = np.unique(np.asarray(touched, dtype=np.int64))
+        stale = [node for node, hop in self.cache.items()
+                 if len(touched) and np.isin(touched, hop, assume_unique=True).any()]
+        for node in stale:
+            self.cached_elements -= len(self.cache.pop(node))
+        return len(stale)
+
+    def _k_hop(self, node):
+        " 节点num_hops跳以内的邻居集合(排好序), 带LRU缓存 "
+        hop = self.cache.get(node)
+        if hop is None:
+            hop = self.adj_lists.k_hop([node], self.num_hops)
+            if len(hop) <= self.cache_elements:                             # 比整个缓存还大的集合不缓存
+                self.cache[node] = hop
+                self.cached_elements += len(hop)
+                while self.cached_elements > self.cache_elements:          # 淘汰最久未使用的集合, 直到总元素数不超过上限
+                    self.cached_elements -= len(self.cache.popitem(last=False)[1])
+        else:
+            self.cache.move_to_end(node)
+        return hop
+
+    def _draw(self, size):
+        " 从训练节点中抽取size个候选节点 "
+        if self.alias is None:
+            return self.train_nodes[np.random.randint(len(self.train_nodes), size=size)]
+        return self.train_nodes[self.alias.sample(size)]
+
+    def sample(self, nodes, num_neg):
+        " 返回(P, 2)的负例对数组 [(目标节点, 负样本节点), ...], 按目标节点排列, 每个目标节点最多num_neg个互不相同的负样本 "
+        nodes = np.asarray(nodes, dtype=np.int64)
+        N = self.adj_lists.num_nodes
+        hops = [self._k_hop(node) for node in nodes.tolist()]
+        hop_keys = np.concatenate([i * N + hop for i, hop in enumerate(hops)] + [np.zeros(0, dtype=np.int64)])  # 以 段号*N+节点 编码, 整体有序
+
+        def outside(keys):
+            pos = np.minimum(np.searchsorted(hop_keys, keys), max(len(hop_keys) - 1, 0))
+            return hop_keys[pos] != keys if len(hop_keys) else np.ones(len(keys), dtype=bool)
+
+        chosen = np.zeros(0, dtype=np.int64)
+        need = np.full(len(nodes), num_neg, dtype=np.int64)
+        for r in range(self.max_rounds):
+            if not need.any(): break
+            seg = np.repeat(np.arange(len(nodes)), 2 * need)                                # 每个还缺样本的节点多抽一倍候选
+            keys = seg * N + self._draw(len(seg))
+            keys = np.concatenate((chosen, keys[outside(keys)]))
+            _, first = np.unique(keys, return_index=True)
+            keys = keys[np.sort(first)]                                                     # 去重并保持抽取的先后顺序
+            seg = keys // N
+            order = np.argsort(seg, kind='stable')
+            counts = np.bincount(seg, minlength=len(nodes))
+            rank = np.empty(len(keys), dtype=np.int64)
+            rank[order] = np.arange(len(keys)) - np.repeat(np.cumsum(counts) - counts, counts)
+            chosen = keys[rank < num_neg]                                                   # 每个节点只保留前num_neg个
+            need = num_neg - np.bincount(chosen // N, minlength=len(nodes))
+
+        for i in np.flatnonzero(need > 0):                                                  # 远节点太少时退化为精确计算
+            far_nodes = np.setdiff1d(self.train_nodes, np.concatenate((hops[i], chosen[chosen // N == i] % N)))
+            if need[i] < len(far_nodes):
+                far_nodes = np.random.choice(far_nodes, need[i], replace=False)
+            chosen = np.concatenate((chosen, i * N + far_nodes))
+
+        pairs = np.stack((nodes[chosen // N], chosen % N), axis=1)
+        return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
 class UnsupervisedLoss(object):
     " docstring for UnsupervisedLoss "
-    def __init__(self, adj_lists, train_nodes, device):
+    def __init__(self, adj_lists, train_nodes, device, n_walks=6, walk_len=1, restart_prob=0.0, neg_weighted=False):
         " 初始化参数 "
         super(UnsupervisedLoss, self).__init__()
         self.Q = 10                     # 负样本数量
-        self.N_WALKS = 6                # 每个节点随机游走的次数
-        self.WALK_LEN = 1               # 每次随机游走的步长
+        self.N_WALKS = n_walks          # 每个节点随机游走的次数
+        self.WALK_LEN = walk_len        # 每次随机游走的步长
+        self.RESTART_PROB = restart_prob    # 随机游走每一步回到起点的概率
         self.N_WALK_LEN = 5             # 每次负样本随机游走几个节点
-        self.MARGIN = 3 
-        self.adj_lists = adj_lists      # {v0:[v0的邻居集合],v1:[v1的邻居集合],...,vn:[vn的邻居集合]}
+        self.MARGIN = 3
+        self.adj_lists = adj_lists      # CSRGraph 邻接表
         self.train_nodes = train_nodes  # 训练节点
         self.device = device            # cpu or gpu
-                
+        self.train_mask = np.zeros(len(adj_lists), dtype=bool)     # 训练节点的bool掩码, 代替在train_nodes里线性查找
+        self.train_mask[train_nodes] = True
+        self.walker = RandomWalkSampler(adj_lists, self.train_mask, self.N_WALKS, self.WALK_LEN, self.RESTART_PROB)
+        self.neg_sampler = NegativeSampler(adj_lists, train_nodes, self.N_WALK_LEN, weighted=neg_weighted)
+
         self.target_nodes = None
         self.positive_pairs = []        # 存放正例样本 [(v0,v0邻居中采样到的正例节点),....,]
         self.negative_pairs = []        # 存放负例样本 [(v0,v0邻居中采样到的负例节点),....,]
@@ -120,120 +410,133 @@ class UnsupervisedLoss(object):
         self.node_negative_pairs = {}   # {v0:[(v0,从v0开始随机游走采样到的负例节点)],...,vn:[(vn,从vn开始随机游走采样到的负例节点)]}
         self.unique_nodes_batch = []    # 一个batch所有会用到的节点及其邻居节点
                 
+    def _pair_index(self, pairs):
+        " 把(源节点, 样本节点)对展平为两个下标张量, 下标为节点在unique_nodes_batch(即embeddings)中的位置 "
+        pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+        unique = np.asarray(self.unique_nodes_batch, dtype=np.int64)
+        sorter = np.argsort(unique)
+        index = sorter[np.searchsorted(unique, pairs, sorter=sorter)]                   # 用排序+二分查找代替逐个查字典
+        index = torch.from_numpy(index).to(self.device)
+        return index[:, 0], index[:, 1]
+    
+    def _pair_scores(self, embeddings):
+        """
+        一次计算这个batch全部正例对和负例对的余弦相似度
+        return:
+            pos_node, pos_score: 每个正例对的源节点下标及其相似度
+            neg_node, neg_score: 每个负例对的源节点下标及其相似度
+            valid: 同时拥有正例和负例的源节点, 只有这些节点参与损失的计算
+        """
+        pos_node, pos_neighb = self._pair_index(self.positive_pairs)
+        neg_node, neg_neighb = self._pair_index(self.negative_pairs)
+        score = F.cosine_similarity(embeddings[torch.cat((pos_node, neg_node))], embeddings[torch.cat((pos_neighb, neg_neighb))])
+        pos_score, neg_score = score[:len(pos_node)], score[len(pos_node):]
+        num_nodes = len(embeddings)
+        valid = (torch.bincount(pos_node, minlength=num_nodes) > 0) & (torch.bincount(neg_node, minlength=num_nodes) > 0)
+        return pos_node, pos_score, neg_node, neg_score, valid
+    
     def get_loss_sage(self, embeddings, nodes):
         " 根据论文里的公式计算损失函数 "
         assert len(embeddings) == len(self.unique_nodes_batch)                                  # 判断是不是每个节点都有了embeddings
-        assert False not in [nodes[i]==self.unique_nodes_batch[i] for i in range(len(nodes))]   # 判断目标节点集和unique集里的节点是否一一对应
-        node2index = {n:i for i, n in enumerate(self.unique_nodes_batch)}                       # 把节点重新编码
-        nodes_score = []
+        assert np.array_equal(np.asarray(nodes), np.asarray(self.unique_nodes_batch))           # 判断目标节点集和unique集里的节点是否一一对应
         assert len(self.node_positive_pairs) == len(self.node_negative_pairs)   # 确定正例节点对和负例节点对的数量是否相同
+        pos_node, pos_score, neg_node, neg_score, valid = self._pair_scores(embeddings)
+        num_nodes = len(embeddings)
         
-        for node in self.node_positive_pairs:                                   # 遍历所有节点
-            pps = self.node_positive_pairs[node]                                # 获得每个节点对应的正例 [(v0,v0正例样本1),(v0,v0正例样本2),...,(v0,v0正例样本n)]
-            nps = self.node_negative_pairs[node]                                # 获得每个节点对应的负例 [(v0,v0负例样本1),(v0,v0负例样本2),...,(v0,v0负例样本n)]
-            if len(pps) == 0 or len(nps) == 0 : continue                        # 判断是否都有正例和负例
-            
-            # Q * Exception(negative score) 计算负例样本的Loss，即Loss函数的后一项
-            indexs = [list(x) for x in zip(*nps)]                                               # [[源节点,...,源节点],[采样得到的负节点1,...,采样得到的负节点n]]
-            node_indexs = [node2index[x] for x in indexs[0]]                                    # 获得源节点的编号
-            neighb_indexs = [node2index[x] for x in indexs[1]]                                  # 获得负样本节点的编号
-            neg_score = F.cosine_similarity(embeddings[node_indexs], embeddings[neighb_indexs]) # 计算余弦相似性
-            neg_score = self.Q * torch.mean(torch.log(torch.sigmoid(-neg_score)), 0)            # 计算损失的后一项
-            
-            # multiple positive score 计算正例样本的Loss，即Loss函数的前一项
-            indexs = [list(x) for x in zip(*pps)]
-            node_indexs = [node2index[x] for x in indexs[0]]
-            neighb_indexs = [node2index[x] for x in indexs[1]]
-            pos_score = F.cosine_similarity(embeddings[node_indexs], embeddings[neighb_indexs])
-            pos_score = torch.log(torch.sigmoid(pos_score))                                     # 计算损失的前一项
-            
-            nodes_score.append(torch.mean(- pos_score - neg_score).view(1, -1))                  # 把每个节点的损失加入到列表中 view(1, -1) 中-1表示自动判断维度
-            
-        loss = torch.mean(torch.cat(nodes_score, 0))    # 对所有数求平均 torch.cat(nodes_score, 0)按照dim = 0(行)进行拼接
+        # Q * Exception(negative score) 计算负例样本的Loss，即Loss函数的后一项, 对每个源节点的所有负例求平均
+        neg_score = self.Q * segment_mean(F.logsigmoid(-neg_score).unsqueeze(1), neg_node, num_nodes).squeeze(1)
+        # multiple positive score 计算正例样本的Loss，即Loss函数的前一项
+        pos_score = segment_mean(F.logsigmoid(pos_score).unsqueeze(1), pos_node, num_nodes).squeeze(1)
+        
+        nodes_score = - pos_score - neg_score                                   # 每个节点的损失
+        loss = torch.mean(nodes_score[valid])                                   # 对所有节点求平均
         return loss
     
     def get_loss_margin(self, embeddings, nodes):
         assert len(embeddings) == len(self.unique_nodes_batch)
-        assert False not in [nodes[i] == self.unique_nodes_batch[i] for i in range(len(nodes))]
-        node2index = {n:i for i, n in enumerate(self.unique_nodes_batch)}
-        
-        nodes_score = []
-        
+        assert np.array_equal(np.asarray(nodes), np.asarray(self.unique_nodes_batch))
         assert len(self.node_positive_pairs) == len(self.node_negative_pairs)
-        for node in self.node_positive_pairs:
-            pps = self.node_positive_pairs[node]
-            nps = self.node_negative_pairs[node]
-            if len(pps) == 0 or len(nps) == 0 : continue
-            
-            indexs = [list(x) for x in zip(*pps)]
-            node_indexs = [node2index[x] for x in indexs[0]]
-            neighb_indexs = [node2index[x] for x in indexs[1]]
-            pos_score = F.cosine_similarity(embeddings[node_indexs], embeddings[neighb_indexs])
-            pos_score, _ = torch.min(torch.log(torch.sigmoid(pos_score)), 0)                    # MIN
-            
-            indexs = [list(x) for x in zip(*nps)]
-            node_indexs = [node2index[x] for x in indexs[0]]
-            neighb_indexs = [node2index[x] for x in indexs[1]]
-            neg_score = F.cosine_similarity(embeddings[node_indexs], embeddings[neighb_indexs])
-            neg_score, _ = torch.max(torch.log(torch.sigmoid(neg_score)), 0)                    # MAX
-            
-            nodes_score.append(torch.max(torch.tensor(0.0).to(self.device), neg_score-pos_score+self.MARGIN).view(1, -1))
+        pos_node, pos_score, neg_node, neg_score, valid = self._pair_scores(embeddings)
+        num_nodes = len(embeddings)
         
-        loss = torch.mean(torch.cat(nodes_score, 0), 0)
+        pos_score = -segment_max(-F.logsigmoid(pos_score).unsqueeze(1), pos_node, num_nodes).squeeze(1)  # MIN
+        neg_score = segment_max(F.logsigmoid(neg_score).unsqueeze(1), neg_node, num_nodes).squeeze(1)    # MAX
+        
+        nodes_score = torch.clamp(neg_score - pos_score + self.MARGIN, min=0.0)
+        loss = torch.mean(nodes_score[valid])
         return loss
     
+    def update_graph(self, adj_lists, touched, removed=()):
+        " 换成更新后的图(新增的节点不是训练节点), touched为出边发生变化的节点, removed为删除的节点, 不再作为训练节点 "
+        self.adj_lists = adj_lists
+        self.train_mask = np.concatenate((self.train_mask, np.zeros(len(adj_lists) - len(self.train_mask), dtype=bool)))
+        train_nodes = None
+        if len(removed):
+            self.train_mask[np.asarray(removed, dtype=np.int64)] = False
+            train_nodes = self.train_nodes = np.asarray(self.train_nodes)[self.train_mask[self.train_nodes]]
+        self.walker.adj_lists = adj_lists
+        self.walker.train_mask = self.train_mask
+        self.neg_sampler.update_graph(adj_lists, touched, train_nodes)
+    
     def extend_nodes(self, nodes, num_neg=6):
         " 获得目标节点集的正样本和负样本，输出这些节点的集合 "
+        return self.load_pairs(self.sample_pairs(nodes, num_neg))
+
+    def sample_pairs(self, nodes, num_neg=6):
+        """
+        采样目标节点集的正例对和负例对, 不修改自身的状态, 因此可以在后台的worker中运行
+        return: {'nodes': 目标节点, 'positive_pairs': (P,2)数组, 'negative_pairs': (P,2)数组, 'unique_nodes': 用到的所有节点}
+        """
+        positive_pairs = self.walker.sample(nodes)                      # 所有节点的随机游走一起完成
+        negative_pairs = self.neg_sampler.sample(nodes, num_neg)
+        unique_nodes = np.unique(np.concatenate((np.asarray(nodes, dtype=np.int64), positive_pairs.ravel(), negative_pairs.ravel())))  # k跳邻居覆盖全部训练节点时可能既没有正例也没有负例, 目标节点仍要计算
+        return {'nodes': nodes, 'positive_pairs': positive_pairs, 'negative_pairs': negative_pairs, 'unique_nodes': unique_nodes}
+
+    def load_pairs(self, sampled):
+        " 把sample_pairs的结果设为当前batch, 之后的get_loss_sage/get_loss_margin使用这些样本, 返回这个batch用到的所有节点 "
         self.positive_pairs = []
         self.node_positive_pairs = {}
         self.negative_pairs = []
         self.node_negative_pairs = {}
-        
+
+        nodes = sampled['nodes']
         self.target_nodes = nodes
-        self.get_positive_nodes(nodes)
-        self.get_negative_nodes(nodes, num_neg)
-        self.unique_nodes_batch = list(set([i for x in self.positive_pairs for i in x]) | set([i for x in self.negative_pairs for i in x]))
-        
-        assert set(self.target_nodes) < set(self.unique_nodes_batch)
+        self._set_positive_pairs(nodes, sampled['positive_pairs'])
+        self._set_negative_pairs(nodes, sampled['negative_pairs'])
+        self.unique_nodes_batch = sampled['unique_nodes'].tolist()
+
+        assert set(self.target_nodes) <= set(self.unique_nodes_batch)
         return self.unique_nodes_batch
-    
+
     def get_positive_nodes(self, nodes):
         return self._run_random_walks(nodes)    # 通过随机游走获得正例样本
-    
+
     def get_negative_nodes(self, nodes, num_neg):
         " 生成负样本，即让目标节点与目标节点相隔很远的节点组成一个负例 "
+        return self._set_negative_pairs(nodes, self.neg_sampler.sample(nodes, num_neg))   # (P, 2)数组
+
+    def _set_negative_pairs(self, nodes, negative_pairs):
+        self.negative_pairs = negative_pairs
         for node in nodes:
-            neighbors = set([node])
-            frontier = set([node])
-            for i in range(self.N_WALK_LEN):
-                current = set()
-                for outer in frontier:
-                    current |= self.adj_lists[int(outer)]                                               # 获取frontier中所有的邻居节点
-                frontier = current - neighbors                                                          # 去除源节点
-                neighbors |= current                                                                    # 源节点+邻居节点
-            far_nodes = set(self.train_nodes) - neighbors                                               # 减去train_nodes里源节点及其一阶邻居
-            neg_samples = random.sample(far_nodes, num_neg) if num_neg < len(far_nodes) else far_nodes  # 从二阶邻居开始采样
-            self.negative_pairs.extend([(node, neg_node) for neg_node in neg_samples])
-            self.node_negative_pairs[node] = [(node, neg_node) for neg_node in neg_samples]
+            self.node_negative_pairs[node] = []
+        starts, splits = np.unique(self.negative_pairs[:, 0], return_index=True)
+        for node, cur_pairs in zip(starts.tolist(), np.split(self.negative_pairs, splits[1:])):
+            self.node_negative_pairs[node] = cur_pairs
         return self.negative_pairs
-    
+
     def _run_random_walks(self, nodes):
-        for node in nodes:
-            if len(self.adj_lists[int(node)]) == 0 : continue   # 若该节点没有邻居节点则跳过
-            cur_pairs = []                                      # 创建一个
-            for i in range(self.N_WALKS):                       # 每个节点会有N_WALKS次的随机游走
-                curr_node = node
-                for j in range(self.WALK_LEN):                  # 每次随机游走WALK_LEN的长度
-                    neighs = self.adj_lists[int(curr_node)]
-                    next_node = random.choice(list(neighs))
-                    if next_node != node and next_node in self.train_nodes:
-                        self.positive_pairs.append((node, next_node))
-                        cur_pairs.append((node, next_node))
-                    curr_node = next_node
-                    
+        return self._set_positive_pairs(nodes, self.walker.sample(nodes))     # 所有节点的随机游走一起完成, (P, 2)数组
+
+    def _set_positive_pairs(self, nodes, positive_pairs):
+        self.positive_pairs = positive_pairs
+        starts, splits = np.unique(self.positive_pairs[:, 0], return_index=True)
+        for node, cur_pairs in zip(starts.tolist(), np.split(self.positive_pairs, splits[1:])):
             self.node_positive_pairs[node] = cur_pairs
+        for node in nodes:                                  # 有邻居但没有采到正例的节点对应空列表
+            if self.adj_lists.degree(int(node)) > 0 and int(node) not in self.node_positive_pairs:
+                self.node_positive_pairs[int(node)] = []
         return self.positive_pairs
-        
+
 class Classification(nn.Module):
     """
     一个简单的一层分类模型
@@ -257,6 +560,82 @@ class Classification(nn.Module):
         logists = torch.log_softmax(self.fc1(x), 1)     # 利用log_softmax来获得最终输出的类别
         return logists
 
+class CentralityTable(object):
+    """
+    预先计算的度中心性及每个节点按中心性从高到低排序的前k个邻居
+    中心性: 节点的度 / 其所有邻居的度之和
+    前k个邻居以CSR的形式存放 (topk_indptr, topk_indices), 邻居数不足k的节点保留全部邻居
+    Parameters:
+        adj_lists: CSRGraph 邻接表
+        k: 每个节点保留的邻居数量
+    """
+    def __init__(self, adj_lists, k=10):
+        super(CentralityTable, self).__init__()
+        self.k = k
+        self.update(adj_lists)
+    
+    def update(self, adj_lists):
+        " 根据当前的图重新计算中心性和前k个邻居, 只需在图发生变化时调用 "
+        num_nodes = len(adj_lists)
+        degree = adj_lists.degree()
+        rows = np.repeat(np.arange(num_nodes), degree)                                  # 每条边的源节点
+        cols = adj_lists.indices
+        sum_degree = np.bincount(rows, weights=degree[cols], minlength=num_nodes)       # 邻居的度之和
+        cen = np.zeros(num_nodes, dtype=np.float64)
+        np.divide(degree, sum_degree, out=cen, where=sum_degree != 0)
+        
+        order = np.lexsort((-cols, -cen[cols], rows))                                   # 先按源节点, 再按邻居中心性从高到低排序, 中心性相同时与原来的实现一样编号大的在前
+        cols = cols[order]
+        keep = (np.arange(len(rows)) - adj_lists.indptr[rows]) < self.k                 # 每个节点只保留排在前k的邻居
+        
+        self.centrality = cen
+        self.topk_indptr = np.concatenate(([0], np.cumsum(np.minimum(degree, self.k))))
+        self.topk_indices = cols[keep]
+    
+    def neighbours(self, node):
+        " 节点中心性最高的前k个邻居 "
+        return self.topk_indices[self.topk_indptr[node]:self.topk_indptr[node+1]]
+    
+    def batch_neighbours(self, nodes):
+        " 一批节点的前k个邻居, 返回(每个邻居对应的节点在nodes中的位置, 邻居编号) "
+        return CSRGraph(self.topk_indptr, self.topk_indices).batch_neighbours(nodes)
+
+def segment_sum(src, index, num_segments):
+    """
+    按index分段求和, index[i]为src第i行所属的段(目标节点)
+    Parameters:
+        src: E*d 每条采样边上邻居节点的特征
+        index: E 每条边对应的目标节点
+        num_segments: 目标节点数量
+    """
+    return src.new_zeros((num_segments, src.size(1))).index_add_(0, index, src)
+
+def segment_mean(src, index, num_segments):
+    " 按index分段求平均, 没有邻居的段为0 "
+    count = torch.bincount(index, minlength=num_segments).clamp(min=1).to(src.dtype)
+    return segment_sum(src, index, num_segments) / count.unsqueeze(1)
+
+def segment_max(src, index, num_segments):
+    " 按index分段逐维取最大值, 梯度只回传到最大值所在的位置, 没有邻居的段为0 "
+    out = src.new_zeros((num_segments, src.size(1)))
+    return out.scatter_reduce(0, index.view(-1, 1).expand_as(src), src, reduce='amax', include_self=False)
+
+def segment_to_padded(src, index, num_segments):
+    """
+    把按段排列的特征补齐成 num_segments*max_len*d 的张量, 供LSTM等序列聚合器使用
+    return:
+        padded: 补齐后的特征, 空位为0
+        lengths: 每段的实际长度, 可直接传给 nn.utils.rnn.pack_padded_sequence
+    """
+    lengths = torch.bincount(index, minlength=num_segments)
+    order = torch.argsort(index, stable=True)
+    index = index[order]
+    starts = torch.cumsum(lengths, 0) - lengths
+    position = torch.arange(len(index), device=index.device) - starts[index]   # 每条边在所属段中的位置
+    padded = src.new_zeros((num_segments, int(lengths.max()) if len(index) else 0, src.size(1)))
+    padded[index, position] = src[order]
+    return padded, lengths
+
 class SageLayer(nn.Module):
     " 一层SageLayer "
     def __init__(self, input_size, out_size, gcn=False):
@@ -286,7 +665,7 @@ class SageLayer(nn.Module):
     
 class GraphSage(nn.Module):
     " 定义一个GraphSage模型 "
-    def __init__(self, num_layers, input_size, out_size, raw_features, adj_lists, device, gcn=False, agg_func="MEAN"):
+    def __init__(self, num_layers, input_size, out_size, raw_features, adj_lists, device, gcn=False, agg_func="MEAN", num_sample=10):
         super(GraphSage, self).__init__()
         self.input_size = input_size
         self.out_size = out_size
@@ -296,36 +675,103 @@ class GraphSage(nn.Module):
         self.agg_func = agg_func
         self.raw_features = raw_features
         self.adj_lists = adj_lists
+        self.num_sample = num_sample
+        self.cen_table = CentralityTable(adj_lists, k=num_sample)                               # 中心性只在加载图时计算一次, 图变化后调用self.cen_table.update
         for index in range(1, num_layers+1):                                                        # 定义每一层的输入和输出
             layer_size = out_size if index != 1 else input_size
             setattr(self, 'sage_layer'+str(index), SageLayer(layer_size, out_size, gcn=self.gcn))   # 除了第1层的输入为input_size,其余层的输入和输出均为outsize
             
-    def forward(self, nodes_batch):
+    def forward(self, nodes_batch, plan=None, features=None):
         """
         为一批节点生成嵌入表示
         Parameters:
             nodes_batch: 目标批次的节点
+            plan: build_plan(nodes_batch)的结果(可选), 给出时不再采样, 只做张量计算
+            features: 第一层的输入特征(可选), 默认为raw_features; 给出时plan第一层的下标应指向features的行
         """
+        if plan is None:
+            with profiler.phase('sample'):
+                plan = self.build_plan(nodes_batch)
+
+        pre_hidden_embs = self.raw_features if features is None else features   # 初始化h0
+        device = pre_hidden_embs.device
+        for index, (embed_index, rows, cols, self_index, num_nodes) in enumerate(plan, 1):
+            with profiler.phase('gather'):
+                embed_matrix = pre_hidden_embs if len(pre_hidden_embs) == len(embed_index) else pre_hidden_embs[torch.from_numpy(embed_index).to(device)]
+                neigh_feats = embed_matrix[torch.from_numpy(cols).to(device)]           # E*d 每条边上邻居节点的特征
+            profiler.count('edges', len(rows))
+            with profiler.phase('aggregate'):
+                aggregate_feats = self._reduce(neigh_feats, torch.from_numpy(rows).to(device), num_nodes)
+            sage_layer = getattr(self, 'sage_layer'+str(index))
+            cur_hidden_embs = sage_layer(self_feats = pre_hidden_embs[torch.from_numpy(self_index).to(device)], aggregate_feats = aggregate_feats)
+            pre_hidden_embs = cur_hidden_embs
+
+        return pre_hidden_embs
+
+    def update_graph(self, adj_lists, raw_features=None, touched=(), changed_features=()):
+        """
+        换成更新后的图(和特征)并重新计算中心性表, 返回嵌入可能发生变化的节点(排好序)
+        Parameters:
+            touched: 出边发生变化的节点
+            changed_features: 特征发生变化或新加入的节点
+        节点的嵌入只依赖于它的前k个邻居表和num_layers跳以内经前k个邻居到达的节点:
+        先找出前k个邻居发生变化的节点, 再沿前k个邻居的反方向扩展num_layers层
+        """
+        old_table = self.cen_table
+        self.adj_lists = adj_lists
+        if raw_features is not None:
+            self.raw_features = raw_features
+        self.cen_table = CentralityTable(adj_lists, k=old_table.k)
+        num_old, num_nodes = len(old_table.centrality), len(adj_lists)
+        
+        # 中心性变化的节点的入邻居, 以及出边变化的节点, 前k个邻居才可能变化
+        cen_changed = np.zeros(num_nodes, dtype=bool)
+        cen_changed[num_old:] = True
+        cen_changed[:num_old] = old_table.centrality != self.cen_table.centrality[:num_old]
+        cen_changed[np.asarray(touched, dtype=np.int64)] = True
+        rows, cols = adj_lists.edges()
+        candidates = np.union1d(np.asarray(touched, dtype=np.int64), rows[cen_changed[cols]])
+        topk_changed = [v for v in candidates.tolist()
+                        if v >= num_old or not np.array_equal(old_table.neighbours(v), self.cen_table.neighbours(v))]
+        
+        affected = np.zeros(num_nodes, dtype=bool)
+        affected[np.asarray(changed_features, dtype=np.int64)] = True
+        rows = np.repeat(np.arange(num_nodes), np.diff(self.cen_table.topk_indptr))
+        for index in range(self.num_layers):                                           # 第index+1层的输出受影响的节点
+            affected[rows[affected[self.cen_table.topk_indices]]] = True
+            if index == 0:
+                affected[topk_changed] = True
+        return np.flatnonzero(affected)
+    
+    def sample_layers(self, nodes_batch, cen_table=None):
+        " 从目标节点开始逐层采样邻居, 返回从最外层到目标节点的每一层的节点信息, cen_table默认为self.cen_table "
         lower_layer_nodes = list(nodes_batch)           # 初始化第一层节点
         nodes_batch_layers = [(lower_layer_nodes, )]    # 存放每一层的节点信息
         for i in range(self.num_layers):
-            lower_samp_neighs, lower_layer_nodes_dict, lower_layer_nodes = self._get_unique_neighs_list(lower_layer_nodes) # 根据当前层节点获得下一层节点
+            lower_samp_neighs, lower_layer_nodes_dict, lower_layer_nodes = self._get_unique_neighs_list(lower_layer_nodes, self.num_sample, cen_table) # 根据当前层节点获得下一层节点
             nodes_batch_layers.insert(0, (lower_layer_nodes, lower_samp_neighs, lower_layer_nodes_dict))
-        
+
         assert len(nodes_batch_layers) == self.num_layers + 1
-        
-        pre_hidden_embs = self.raw_features             # 初始化h0
+        return nodes_batch_layers
+
+    def build_plan(self, nodes_batch, cen_table=None):
+        """
+        采样邻居并构造forward每一层需要的下标张量, 只用到中心性表, 可以在后台的worker中运行
+        cen_table: 与CentralityTable有相同neighbours接口的对象(可选), 默认为self.cen_table
+        return: 每一层的(embed_index, rows, cols, self_index, num_nodes), 下标都是numpy数组, 可以直接在进程之间传递
+            embed_index: 上一层的节点在上一层嵌入中的位置, rows/cols: 每条采样边的源节点位置和邻居在embed_index中的位置
+            self_index: 本层节点在上一层嵌入中的位置, num_nodes: 本层节点数
+        """
+        nodes_batch_layers = self.sample_layers(nodes_batch, cen_table)
+        plan = []
         for index in range(1, self.num_layers + 1):
             nb = nodes_batch_layers[index][0]           # 所有邻居节点
             pre_neighs = nodes_batch_layers[index-1]    # 上一层的邻居节点
-            aggregate_feats = self.aggregate(nb, pre_hidden_embs, pre_neighs)
-            sage_layer = getattr(self, 'sage_layer'+str(index))
+            embed_index, rows, cols = self._aggregate_index(nb, pre_neighs)
             if index > 1:
-                nb = self._nodes_map(nb, pre_hidden_embs, pre_neighs)
-            cur_hidden_embs = sage_layer(self_feats = pre_hidden_embs[nb], aggregate_feats = aggregate_feats)
-            pre_hidden_embs = cur_hidden_embs
-        
-        return pre_hidden_embs
+                nb = self._nodes_map(nb, None, pre_neighs)
+            plan.append((embed_index, rows, cols, np.array(nb, dtype=np.int64), len(nb)))
+        return plan
     
     def _nodes_map(self, nodes, hidden_embs, neighs):
         layer_nodes, samp_neighs, layer_nodes_dict = neighs
@@ -333,46 +779,14 @@ class GraphSage(nn.Module):
         index = [layer_nodes_dict[x] for x in nodes]
         return index
     
-    def _get_unique_neighs_list(self, nodes, num_sample=10):
-        # 计算中心性
-        trainnode_cen = {}
-        for node in list(self.adj_lists):
-            sum_degree = 0
-            node_neis_list = list(self.adj_lists[node])
-            for node_nei in node_neis_list:
-                sum_degree += len(self.adj_lists[node_nei])
-            if sum_degree != 0: trainnode_cen[node] = 1.0 * len(node_neis_list) / sum_degree
-            else: trainnode_cen[node] = 0
-        
+    def _get_unique_neighs_list(self, nodes, num_sample, cen_table=None):
         _set = set
-        to_neighs = [self.adj_lists[int(node)] for node in nodes]   # 获取目标节点集的所有邻居节点[[v0的邻居],[v1的邻居],[v2的邻居]]
-        samp_neighs = []
+        cen_table = self.cen_table if cen_table is None else cen_table
         if not num_sample is None:                                  # 如果num_sample为实数的话
-            # _sample = random.sample
-            for to_neigh in to_neighs:
-                # print(to_neigh)
-                if len(to_neigh) >= num_sample:
-                    # samp_neighs.append(_set(_sample(to_neigh, num_sample)))
-                    neigh_degree = {}
-                    for neigh in to_neigh:
-                        neigh_degree[neigh] = trainnode_cen[neigh]
-                    neigh_degree = sorted(neigh_degree.items(), key= lambda item:item[1])
-                    # print(neigh_degree)
-                    neighs_list = []
-                    for neigh in neigh_degree: neighs_list.append(neigh[0])
-                    samp_neighs_set = set()
-                    for i in range(10):
-                        # samp_neighs_set.add(neighs_list[i])
-                        samp_neighs_set.add(neighs_list[-i-1])
-                    # print(samp_neighs_set)
-                    samp_neighs.append(samp_neighs_set)
-                else:
-                    samp_neighs.append(to_neigh)
-            # samp_neighs
-            # samp_neighs = [_set(_sample(to_neigh, num_sample)) if len(to_neigh) >= num_sample else to_neigh for to_neigh in to_neighs]    # [set(随机采样的邻居集合),set(),set()]
-            # 遍历所有邻居集合如果邻居节点数>=num_sample，就从邻居节点集中随机采样num_sample个邻居节点，否则直接把邻居节点集放进去
+            # 每个节点取中心性最高的num_sample个邻居, 邻居数不足num_sample时取全部邻居, 直接查预先计算的表(表的k就是self.num_sample, 与inference和推理服务一致)
+            samp_neighs = [_set(cen_table.neighbours(int(node))[:num_sample].tolist()) for node in nodes]
         else:
-            samp_neighs = to_neighs
+            samp_neighs = [_set(self.adj_lists.neighbours(int(node)).tolist()) for node in nodes]   # 获取目标节点集的所有邻居节点[[v0的邻居],[v1的邻居],[v2的邻居]]
         samp_neighs = [samp_neigh | set([nodes[i]]) for i, samp_neigh in enumerate(samp_neighs)]    # 把源节点也放进去
         _unique_nodes_list = list(set.union(*samp_neighs))          # 展平
         i = list(range(len(_unique_nodes_list)))                    # 重新编号
@@ -387,39 +801,147 @@ class GraphSage(nn.Module):
             pre_hidden_embs: 上一层的节点嵌入
             pre_neighs: 上一层的节点
         """
+        embed_index, rows, cols = self._aggregate_index(nodes, pre_neighs)
+        # ---------------- ? --------------- #
+        if len(pre_hidden_embs) == len(embed_index):
+            embed_matrix = pre_hidden_embs
+        else:
+            embed_matrix = pre_hidden_embs[torch.from_numpy(embed_index)]
+        # ---------------- ? --------------- #
+        neigh_feats = embed_matrix[torch.from_numpy(cols).to(embed_matrix.device)]      # E*d 每条边上邻居节点的特征
+
+        return self._reduce(neigh_feats, torch.from_numpy(rows).to(embed_matrix.device), len(nodes))
+
+    def _aggregate_index(self, nodes, pre_neighs):
+        " 构造aggregate用到的下标: 上一层节点的编号, 以及每条采样边的(row, col) "
         unique_nodes_list, samp_neighs, unique_nodes = pre_neighs                       # 上一层的源节点, ..., ...,
         assert len(nodes) == len(samp_neighs)
         indicator = [(nodes[i] in samp_neighs[i]) for i in range(len(samp_neighs))]     # 判断每个节点是否出现在邻居节点中
         assert (False not in indicator)
         if not self.gcn:                                                                # 如果不适用gcn需要把源节点去掉
             samp_neighs = [(samp_neighs[i] - set([nodes[i]])) for i in range(len(samp_neighs))]
-        # ---------------- ? --------------- #
-        if len(pre_hidden_embs) == len(unique_nodes):
-            embed_matrix = pre_hidden_embs
-        else:
-            embed_matrix = pre_hidden_embs[torch.LongTensor(unique_nodes_list)]
-        # ---------------- ? --------------- #
-        mask = torch.zeros(len(samp_neighs), len(unique_nodes))
+        # 每条采样边用(row, col)表示: row为源节点所在行, col为邻居节点在embed_matrix中的位置, 不再构造稠密的mask
         column_indices = [unique_nodes[n] for samp_neigh in samp_neighs for n in samp_neigh]
         row_indices = [i for i in range(len(samp_neighs)) for j in range(len(samp_neighs[i]))]
-        mask[row_indices, column_indices] = 1                                           # 每个源节点为一行，一行元素中1对应的就是邻居节点的位置
-        
+        return (np.array(unique_nodes_list, dtype=np.int64), np.array(row_indices, dtype=np.int64),
+                np.array(column_indices, dtype=np.int64))
+    
+    def _reduce(self, neigh_feats, rows, num_nodes):
+        " 按agg_func把每条边上的邻居特征聚合到对应的源节点 "
         if self.agg_func == 'MEAN':
-            num_neigh = mask.sum(1, keepdim=True)                                       # 计算每个源节点有多少个邻居节点
-            mask = mask.div(num_neigh).to(embed_matrix.device)
-            aggregate_feats = mask.mm(embed_matrix)
+            aggregate_feats = segment_mean(neigh_feats, rows, num_nodes)
         elif self.agg_func == 'MAX':
-            indexs = [x.nonzero() for x in mask == 1]
-            aggregate_feats = []
-            for feat in [embed_matrix[x.squeeze()] for x in indexs]:                    # np.squeeze（）函数可以删除数组形状中的单维度条目，即把shape中为1的维度去掉，但是对非单维的维度不起作用
-                if len(feat.size()) == 1:
-                    aggregate_feats.append(feat.view(1, -1))
-                else:
-                    aggregate_feats.append(torch.max(feat, 0)[0].view(1, -1))
-            aggregate_feats = torch.cat(aggregate_feats, 0)
+            aggregate_feats = segment_max(neigh_feats, rows, num_nodes)
+        elif self.agg_func == 'SUM':
+            aggregate_feats = segment_sum(neigh_feats, rows, num_nodes)
         return aggregate_feats
     
-def evaluate(dataCenter, ds, graphSage, classification, device, max_vali_f1, name, cur_epoch, log):
+    def _sampled_edges(self, nodes):
+        """
+        与_get_unique_neighs_list相同的邻居选择, 以边列表的形式返回
+        return:
+            rows: 每条边的源节点在nodes中的位置
+            cols: 每条边的邻居节点编号
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        rows, cols = self.cen_table.batch_neighbours(nodes)
+        is_self = cols == nodes[rows]
+        if self.gcn:                                                                    # gcn需要源节点自身也参与聚合
+            missing = np.bincount(rows[is_self], minlength=len(nodes)) == 0
+            rows = np.concatenate((rows, np.flatnonzero(missing)))
+            cols = np.concatenate((cols, nodes[missing]))
+        else:
+            rows, cols = rows[~is_self], cols[~is_self]
+        return torch.from_numpy(rows), torch.from_numpy(cols)
+    
+    def inference(self, batch_size=500):
+        """
+        逐层计算全图所有节点的嵌入: 先算出所有节点的第1层输出, 再用它算所有节点的第2层输出, 以此类推
+        每层按batch_size分块在torch.inference_mode下计算, 写入预先分配的缓冲区, 共享的邻居不会被重复计算
+        邻居与forward使用同一张中心性表, 因此结果与逐批调用forward相同
+        """
+        num_nodes = len(self.raw_features)
+        with torch.inference_mode():
+            pre_hidden_embs = self.raw_features
+            for index in range(1, self.num_layers + 1):
+                sage_layer = getattr(self, 'sage_layer'+str(index))
+                cur_hidden_embs = torch.empty(num_nodes, self.out_size, device=pre_hidden_embs.device)
+                for start in range(0, num_nodes, batch_size):
+                    nodes_batch = torch.arange(start, min(start + batch_size, num_nodes))
+                    rows, cols = self._sampled_edges(nodes_batch.numpy())
+                    rows, cols = rows.to(pre_hidden_embs.device), cols.to(pre_hidden_embs.device)
+                    aggregate_feats = self._reduce(pre_hidden_embs[cols], rows, len(nodes_batch))
+                    cur_hidden_embs[start:start + len(nodes_batch)] = sage_layer(self_feats=pre_hidden_embs[nodes_batch.to(pre_hidden_embs.device)], aggregate_feats=aggregate_feats)
+                pre_hidden_embs = cur_hidden_embs
+        return pre_hidden_embs
+    
+class EmbeddingCache(object):
+    """
+    缓存GraphSage生成的全图节点嵌入, 只有GraphSage的参数发生变化后才重新计算
+    参数是否变化根据每个参数的版本号判断, optimizer.step()、load_state_dict()等原地修改都会使版本号增加
+    Parameters:
+        gnn_model: GraphSage模型
+        dataCenter: 创建好的datacenter对象
+        ds: 数据集的名称
+        embs: 已经计算好的嵌入(可选), 视为与当前参数对应
+    """
+    def __init__(self, gnn_model, dataCenter, ds, embs=None):
+        super(EmbeddingCache, self).__init__()
+        self.gnn_model = gnn_model
+        self.dataCenter = dataCenter
+        self.ds = ds
+        self.embs = None
+        self.key = None
+        if embs is not None:
+            self.set(embs)
+    
+    def _weights_key(self):
+        return tuple((id(param), param._version) for param in self.gnn_model.parameters())
+    
+    def set(self, embs):
+        self.embs = embs
+        self.key = self._weights_key()
+    
+    def invalidate(self):
+        self.embs = None
+        self.key = None
+    
+    def get(self):
+        " 返回全图的嵌入, 参数变化过则重新计算 "
+        if self.embs is None or self.key != self._weights_key():
+            self.set(get_gnn_embeddings(self.gnn_model, self.dataCenter, self.ds))
+        return self.embs
+    
+    def __getitem__(self, nodes):
+        return self.get()[nodes]
+    
+    def refresh(self, nodes, batch_size=500):
+        """
+        图更新后只重新计算nodes的嵌入, 图中增加了节点时嵌入矩阵同时扩展
+        还没有计算过嵌入或参数变化过时全部重新计算
+        """
+        if self.embs is None or self.key != self._weights_key():
+            return self.get()
+        num_nodes = len(self.gnn_model.raw_features)
+        if len(self.embs) < num_nodes:
+            append_rows(self, 'embs', self.embs.new_zeros(num_nodes - len(self.embs), self.embs.size(1)))
+        nodes = np.asarray(nodes, dtype=np.int64)
+        with torch.no_grad():                       # 结果写回普通tensor, 不使用inference_mode
+            for start in range(0, len(nodes), batch_size):
+                batch = nodes[start:start + batch_size]
+                self.embs[torch.from_numpy(batch)] = self.gnn_model(batch)
+        return self.embs
+
+_checkpoints = None
+
+def default_checkpoints():
+    " evaluate默认使用的CheckpointManager, 在outputFiles中保留验证集F1最高的3个checkpoint "
+    global _checkpoints
+    if _checkpoints is None or _checkpoints.closed:
+        _checkpoints = CheckpointManager('outputFiles', top_k=3, mode='max')
+    return _checkpoints
+
+def evaluate(dataCenter, ds, graphSage, classification, device, max_vali_f1, name, cur_epoch, log, emb_cache=None, checkpoints=None, stage=None):
     """
     测试模型的性能
     Parameters:
@@ -427,52 +949,46 @@ def evaluate(dataCenter, ds, graphSage, classification, device, max_vali_f1, nam
         ds: 数据集的名称
         graphSage: 训练好的graphSage对象
         classification: 训练好的calssificator
+        emb_cache: EmbeddingCache对象(可选), 给出时直接查表获得嵌入, 不再重新运行graphSage
+        checkpoints: CheckpointManager对象(可选), 验证集F1提高时保存模型参数, 默认见default_checkpoints
+        stage: 写入文件名的编号(可选), 区分cur_epoch从0重新开始的多次调用, 见train_classification
     """
     test_nodes = getattr(dataCenter, ds+'_test')    # 获得测试集
     val_nodes = getattr(dataCenter, ds+'_val')      # 获得验证集
     labels = getattr(dataCenter, ds+'_labels')      # 获得标签
     
-    models = [graphSage, classification]
-    
-    params = []                                     # 将两个模型参数放入一个列表中
-    for model in models:
-        for param in model.parameters():
-            if param.requires_grad:
-                param.requires_grad = False
-                params.append(param)
+    models = {'graphSage': graphSage, 'classification': classification}
+    embed = graphSage if emb_cache is None else emb_cache.__getitem__
     
-    embs = graphSage(val_nodes)
-    logists = classification(embs)
-    _, predicts = torch.max(logists, 1)
-    labels_val = labels[val_nodes]
-    assert len(labels_val) == len(predicts)
-    comps = zip(labels_val, predicts.data)
-    
-    vali_f1 = f1_score(labels_val, predicts.cpu().data, average="micro")
-    # print("Validation F1 : ", vali_f1)
-    log.write("Validation F1 : %f \n" % vali_f1)
-    
-    if vali_f1 > max_vali_f1:
-        max_vali_f1 = vali_f1
-        embs = graphSage(test_nodes)
+    with torch.no_grad(), profiler.phase('eval'):   # 评估时不需要构建计算图
+        embs = embed(val_nodes)
         logists = classification(embs)
         _, predicts = torch.max(logists, 1)
-        labels_test = labels[test_nodes]
-        assert len(labels_test) == len(predicts)
-        comps = zip(labels_test, predicts.data)
+        labels_val = labels[val_nodes]
+        assert len(labels_val) == len(predicts)
         
-        test_f1 = f1_score(labels_test, predicts.cpu().data, average="micro")
-        # print("Test F1 : ", test_f1)
-        log.write("Test F1 : %f \n" % test_f1)
+        vali_f1 = f1_score(labels_val, predicts.cpu().data, average="micro")
+        # print("Validation F1 : ", vali_f1)
+        log.write("Validation F1 : %f \n" % vali_f1)
         
-        for param in params:
-            param.requires_grad = True
-        
-        # --------------- 生成文件 ----------------- #
-        torch.save(models, 'outputFiles/model_best_{}_ep{}_{:.4f}.torch'.format(name, cur_epoch, test_f1))
-    
-    for param in params:
-        param.requires_grad = True
+        if vali_f1 > max_vali_f1:
+            max_vali_f1 = vali_f1
+            embs = embed(test_nodes)
+            logists = classification(embs)
+            _, predicts = torch.max(logists, 1)
+            labels_test = labels[test_nodes]
+            assert len(labels_test) == len(predicts)
+            
+            test_f1 = f1_score(labels_test, predicts.cpu().data, average="micro")
+            # print("Test F1 : ", test_f1)
+            log.write("Test F1 : %f \n" % test_f1)
+            
+            # --------------- 生成文件 ----------------- #
+            # 只保存state_dict(不含raw_features和adj_lists), 在后台线程中写盘
+            checkpoints = checkpoints or default_checkpoints()
+            prefix = name if stage is None else '{}_s{}'.format(name, stage)
+            checkpoints.save(models, vali_f1, 'model_best_{}_ep{}_{:.4f}.pt'.format(prefix, cur_epoch, test_f1),
+                             epoch=cur_epoch, stage=stage, test_f1=test_f1)
     
     return max_vali_f1
 
@@ -480,33 +996,30 @@ def get_gnn_embeddings(gnn_model, dataCenter, ds):
     " 使用GraphSage获得节点的嵌入表示 "
     print('Loading embeddings from trained GraphSAGE model.')
     # log.write('Loading embeddings from trained GraphSAGE model.\n')
-    features = np.zeros((len(getattr(dataCenter, ds+'_labels')), gnn_model.out_size))
-    nodes = np.arange(len(getattr(dataCenter, ds+'_labels'))).tolist()
     batchSize = 500
-    batches = math.ceil(len(nodes) / batchSize)     # ceil 取整 100.01 -> 101
-    embs = []
-    for index in range(batches):
-        nodes_batch = nodes[index * batchSize : (index + 1) * batchSize]
-        embs_batch = gnn_model(nodes_batch)
-        assert len(embs_batch) == len(nodes_batch)
-        embs.append(embs_batch)
-        
-    assert len(embs) == batches
-    embs = torch.cat(embs, 0)
-    assert len(embs) == len(nodes)
+    embs = gnn_model.inference(batchSize)           # 逐层计算全图的嵌入, 每层O(E)
+    assert len(embs) == len(getattr(dataCenter, ds+'_labels'))
     print('Embeddings loaded.')
     # log.write('Embeddings loaded.\n')
-    return embs.detach()                            # detach会生成一个新的tensor，对该tensor的改动不会影响原来的tensor
+    return embs.clone()                             # inference_mode下得到的tensor不能参与反向传播, clone成普通tensor
 
-def train_classification(log, dataCenter, graphSage, classification, ds, device, max_vali_f1, name, epochs=800):
-    " 训练分类器 "
+_classification_stages = itertools.count()
+
+def train_classification(log, dataCenter, graphSage, classification, ds, device, max_vali_f1, name, epochs=800, checkpoints=None, stage=None):
+    """
+    训练分类器
+    stage: checkpoint文件名中的编号(例如GraphSage训练到的epoch), 每次调用分类器的epoch都从0开始, 用它区分不同调用的checkpoint;
+           默认为本进程中调用train_classification的次数
+    """
+    stage = next(_classification_stages) if stage is None else stage
     print('Training Classification ...')
     # log.write('Training Classification... \n')
     c_optimizer = torch.optim.SGD(classification.parameters(), lr=0.5)  # train classification, detached from the current graph
     batchSize = 50
     train_nodes = getattr(dataCenter, ds+'_train')
     labels = getattr(dataCenter, ds+'_labels')
-    features = get_gnn_embeddings(graphSage, dataCenter, ds)
+    emb_cache = EmbeddingCache(graphSage, dataCenter, ds)                # graphSage在训练分类器期间不变, 嵌入只计算一次
+    features = emb_cache.get()
     for epoch in range(epochs):
         train_nodes = shuffle(train_nodes)
         batches = math.ceil(len(train_nodes) / batchSize)
@@ -527,13 +1040,223 @@ def train_classification(log, dataCenter, graphSage, classification, ds, device,
             c_optimizer.step()
             c_optimizer.zero_grad()
         
-        max_vali_f1 = evaluate(dataCenter, ds, graphSage, classification, device, max_vali_f1, name, epoch, log)
+        max_vali_f1 = evaluate(dataCenter, ds, graphSage, classification, device, max_vali_f1, name, epoch, log, emb_cache=emb_cache, checkpoints=checkpoints, stage=stage)
     return classification, max_vali_f1
 
-def apply_model(dataCenter, ds, graphSage, classification, unsupervised_loss, batchSize, unsup_loss, device, learn_method, log):
+def append_rows(owner, name, rows, growth=2):
+    """
+    在owner的属性name(numpy数组或tensor)末尾追加rows, 返回追加后的值
+    底层存储预留空余的行, 容量不足时扩大为growth倍, 多次追加时不必每次复制整个数组
+    属性的值是存储前n行的视图; 属性被其他代码替换后, 下一次追加以新的值为起点
+    """
+    current = getattr(owner, name)
+    storages = owner.__dict__.setdefault('_row_storage', {})
+    storage, view = storages.get(name, (None, None))
+    if view is not current:
+        storage = current
+    size, total = len(current), len(current) + len(rows)
+    if total > len(storage):
+        capacity = max(total, int(len(storage) * growth))
+        if torch.is_tensor(storage):
+            grown = storage.new_empty((capacity,) + tuple(storage.shape[1:]))
+        else:
+            grown = np.empty((capacity,) + storage.shape[1:], dtype=storage.dtype)
+        grown[:size] = current
+        storage = grown
+    if torch.is_tensor(storage):
+        storage[size:total] = torch.as_tensor(rows, dtype=storage.dtype, device=storage.device)
+    else:
+        storage[size:total] = rows
+    view = storage[:total]
+    storages[name] = (storage, view)
+    setattr(owner, name, view)
+    return view
+
+def update_graph(dataCenter, ds, graphSage, new_features=None, add_edges=None, remove_edges=None, remove_nodes=None,
+                 unsupervised_loss=None, emb_cache=None):
+    """
+    增量更新图, 只重新计算嵌入受影响的节点
+    依次: 在末尾加入新节点(new_features为m*d的特征, 标签记为-1), 删除remove_nodes的全部边, 删除remove_edges, 加入add_edges
+    删除的节点保留编号, 但不再有边, 并从训练集、验证集和测试集中去掉; 特征和标签按append_rows预留空间追加
+    Parameters:
+        add_edges / remove_edges: (rows, cols) 有向边, 无向边需要两个方向都给出
+        unsupervised_loss: UnsupervisedLoss(可选), 同步更新其采样器, 只丢弃可能变化的负采样缓存
+        emb_cache: EmbeddingCache(可选), 只重新计算受影响节点的嵌入
+    return: 嵌入可能发生变化的节点
+    """
+    old_adj = getattr(dataCenter, ds+'_adj_lists')
+    adj_lists, raw_features, changed_features = old_adj, None, np.zeros(0, dtype=np.int64)
+    removed = np.unique(np.asarray(remove_nodes if remove_nodes is not None else [], dtype=np.int64))
+    if new_features is not None and len(new_features):
+        new_features = np.asarray(new_features, dtype=np.float32)
+        changed_features = np.arange(len(old_adj), len(old_adj) + len(new_features))
+        adj_lists = adj_lists.add_nodes(len(new_features))
+        raw_features = append_rows(graphSage, 'raw_features', new_features)
+        append_rows(dataCenter, ds+'_feats', new_features)
+        append_rows(dataCenter, ds+'_labels', np.full(len(new_features), -1))
+    if len(removed):
+        adj_lists = adj_lists.remove_nodes(removed)
+        for split in ('_train', '_val', '_test'):
+            nodes = np.asarray(getattr(dataCenter, ds+split))
+            setattr(dataCenter, ds+split, nodes[~np.isin(nodes, removed)])
+    if add_edges is not None or remove_edges is not None:
+        adj_lists = adj_lists.update_edges(add_edges, remove_edges)
+    
+    N = len(adj_lists)                                                      # 出边发生变化的节点: 新旧边集合的对称差的源节点
+    old_rows, old_cols = old_adj.edges()
+    rows, cols = adj_lists.edges()
+    touched = np.unique(np.setxor1d(old_rows * N + old_cols, rows * N + cols) // N)
+    
+    affected = graphSage.update_graph(adj_lists, raw_features, touched, changed_features)
+    setattr(dataCenter, ds+'_adj_lists', adj_lists)
+    if unsupervised_loss is not None:
+        unsupervised_loss.update_graph(adj_lists, touched, removed)
+    if emb_cache is not None:
+        emb_cache.refresh(affected)
+    return affected
+
+def sample_batch(graphSage, unsupervised_loss, nodes, num_neg):
+    " 为一个batch采样正负样本对, 并构造GraphSage每一层的节点集合和下标张量 "
+    pairs = unsupervised_loss.sample_pairs(nodes, num_neg)
+    plan = graphSage.build_plan(pairs['unique_nodes'])
+    return pairs, plan
+
+@contextmanager
+def batch_seed(seed):
+    " 在with块内使用由seed确定的随机数, 退出时恢复原来的随机数状态 "
+    np_state, py_state = np.random.get_state(), random.getstate()
+    with torch.random.fork_rng(devices=[]):
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        try:
+            yield
+        finally:
+            np.random.set_state(np_state)
+            random.setstate(py_state)
+
+def _prefetch_worker(worker_id, num_workers, graphSage, unsupervised_loss, tasks, queue):
+    """
+    后台worker: 每个epoch从tasks收到(本worker负责的batch, num_neg, seed), 按顺序生成第worker_id, worker_id+num_workers, ...个batch
+    worker在各个epoch之间一直存在, 负采样器的k跳邻居缓存等状态得以保留
+    """
+    torch.set_num_threads(1)                                                    # 计算留给训练进程
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        batches, num_neg, seed = task
+        try:
+            for i, nodes_batch in enumerate(batches):
+                with batch_seed(seed + worker_id + i * num_workers):
+                    queue.put(sample_batch(graphSage, unsupervised_loss, nodes_batch, num_neg))
+        except Exception:
+            queue.put(RuntimeError('prefetch worker %d failed:\n%s' % (worker_id, traceback.format_exc())))
+
+class BatchPrefetcher(object):
+    """
+    在后台进程中提前采样batch k+1..k+prefetch, 训练进程只需处理第k个batch
+    采样结果是正负样本对(UnsupervisedLoss.sample_pairs)和每一层的下标张量(GraphSage.build_plan)
+    worker只在第一次使用时fork一次, 之后每个epoch调用epoch()把这个epoch的batch分给它们, 负采样缓存在epoch之间保留
+    第k个batch的随机数种子为seed+k, 采样结果与worker的个数和进程的调度无关, num_workers=0时也相同
+    worker持有fork时的图, 图更新(update_graph)后需要close(), 下一个epoch会重新fork
+    Parameters:
+        num_workers: 后台进程数, 为0(或者系统不支持fork)时在训练进程中依次采样
+        prefetch: 最多提前准备的batch数, 决定队列的大小
+    """
+    def __init__(self, graphSage, unsupervised_loss, num_workers=2, prefetch=4):
+        self.graphSage = graphSage
+        self.unsupervised_loss = unsupervised_loss
+        self.num_workers = num_workers if 'fork' in multiprocessing.get_all_start_methods() else 0
+        self.prefetch = prefetch
+        self.workers = []
+
+    def _start(self):
+        num_workers = self.num_workers
+        ctx = multiprocessing.get_context('fork')                               # fork后worker直接共享图和中心性表, 不需要序列化
+        self.tasks = [ctx.Queue() for _ in range(num_workers)]
+        self.queues = [ctx.Queue(max(1, self.prefetch // num_workers)) for _ in range(num_workers)]
+        self.workers = [ctx.Process(target=_prefetch_worker, args=(i, num_workers, self.graphSage, self.unsupervised_loss, self.tasks[i], self.queues[i]), daemon=True)
+                        for i in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def epoch(self, batches, num_neg, seed=0):
+        " 依次返回每个batch的采样结果 "
+        if self.num_workers == 0:
+            for index, nodes_batch in enumerate(batches):
+                with profiler.phase('sample'), batch_seed(seed + index):
+                    item = sample_batch(self.graphSage, self.unsupervised_loss, nodes_batch, num_neg)
+                yield item
+            return
+        if not self.workers:
+            self._start()
+        for i, tasks in enumerate(self.tasks):
+            tasks.put((batches[i::self.num_workers], num_neg, seed))
+        complete = False
+        try:
+            for index in range(len(batches)):
+                with profiler.phase('wait'):                                    # 训练进程等待采样的时间
+                    item = self.queues[index % self.num_workers].get()
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+            complete = True
+        finally:
+            if not complete:                                                    # 中途退出时队列里还有这个epoch的batch, 结束worker, 下次重新fork
+                self.close()
+
+    def close(self):
+        for tasks in getattr(self, 'tasks', []) if self.workers else []:
+            tasks.put(None)
+        for worker in self.workers:
+            worker.join(timeout=1)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        self.workers = []
+
+def init_distributed():
+    """
+    用torchrun启动时(环境变量WORLD_SIZE>1)初始化gloo进程组, 返回(rank, world_size)
+    单机: torchrun --nproc_per_node=8 Graphsage-Pytorch-Inductive-Central.py
+    多机: 每台机器上 torchrun --nnodes=2 --node_rank=<i> --nproc_per_node=8 --master_addr=<rank0地址> --master_port=29500 Graphsage-Pytorch-Inductive-Central.py
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 1
+    dist.init_process_group('gloo')
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))     # 同一台机器上的rank平分CPU核
+    return dist.get_rank(), world_size
+
+@contextmanager
+def local_rank_zero_first():
+    " 同一台机器上local rank 0先执行(例如生成数据集缓存), 其他rank等它完成后再执行 "
+    distributed = dist.is_available() and dist.is_initialized()
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if distributed and local_rank != 0:
+        dist.barrier()
+    yield
+    if distributed and local_rank == 0:
+        dist.barrier()
+
+def _unwrap(model):
+    " DistributedDataParallel包装的模型返回原模型 "
+    return model.module if isinstance(model, DistributedDataParallel) else model
+
+def apply_model(dataCenter, ds, graphSage, classification, unsupervised_loss, batchSize, unsup_loss, device, learn_method, log, num_workers=0, prefetch=4, rank=0, world_size=1, prefetcher=None):
+    """
+    训练一个epoch
+    num_workers>0时由BatchPrefetcher在后台进程中采样, 与训练重叠; 为0时在训练进程中依次采样
+    prefetcher: 在各个epoch之间共用的BatchPrefetcher(可选), 给出时忽略num_workers和prefetch, worker和其中的负采样缓存在epoch之间保留
+    world_size>1时graphSage(和classification)应为DistributedDataParallel, 每个rank只训练train_nodes中属于自己的一份
+    """
     test_nodes = getattr(dataCenter, ds+'_test')
     val_nodes = getattr(dataCenter, ds+'_val')
     train_nodes = getattr(dataCenter, ds+'_train')
+    if world_size > 1:          # 各rank的份数截成相同长度, 保证batch数相同, 梯度all-reduce的次数一致
+        train_nodes = train_nodes[rank::world_size][:len(train_nodes) // world_size]
     labels = getattr(dataCenter, ds+'_labels')
     
     if unsup_loss == 'margin':
@@ -559,14 +1282,19 @@ def apply_model(dataCenter, ds, graphSage, classification, unsupervised_loss, ba
         model.zero_grad()
     
     batches = math.ceil(len(train_nodes) / batchSize)
-    
+    target_batches = [train_nodes[index * batchSize : (index + 1) * batchSize] for index in range(batches)]
+    own_prefetcher = prefetcher is None
+    if own_prefetcher:
+        prefetcher = BatchPrefetcher(_unwrap(graphSage), unsupervised_loss, num_workers, prefetch)
+    seed = np.random.randint(2**31 - len(target_batches))
+    sampled_batches = prefetcher.epoch(target_batches, num_neg, seed=seed)
+
     visited_nodes = set()
-    for index in range(batches):
-        nodes_batch = train_nodes[index * batchSize : (index + 1) * batchSize]
-        
+    for index, (pairs, plan) in enumerate(sampled_batches):
         # extend nodes batch for unspervised learning
         # no conflicts with supervised learning
-        nodes_batch = np.asarray(list(unsupervised_loss.extend_nodes(nodes_batch, num_neg=num_neg)))
+        nodes_batch = np.asarray(unsupervised_loss.load_pairs(pairs))
+        profiler.count('nodes', len(nodes_batch))
         visited_nodes |= set(nodes_batch)
         
         # get ground-truth for the nodes batch
@@ -574,57 +1302,66 @@ def apply_model(dataCenter, ds, graphSage, classification, unsupervised_loss, ba
         
         # feed nodes batch to the graphSAGE
         # returning the nodes embeddings
-        embs_batch = graphSage(nodes_batch)
+        with profiler.phase('forward'):
+            embs_batch = graphSage(nodes_batch, plan)
         
-        if learn_method == 'sup':           
-            # supervised learning
-            logists = classification(embs_batch)
-            loss_sup = -torch.sum(logists[range(logists.size(0)), labels_batch], 0)
-            loss_sup /= len(nodes_batch)
-            loss = loss_sup
-        elif learn_method == 'plus_unsup':  
-            # supervised learning
-            logists = classification(embs_batch)
-            loss_sup = -torch.sum(logists[range(logists.size(0)), labels_batch], 0)
-            loss_sup /= len(nodes_batch)
-            # unsupervised learning
-            if unsup_loss == 'margin':
-                loss_net = unsupervised_loss.get_loss_margin(embs_batch, nodes_batch)
-            elif unsup_loss == 'normal':
-                loss_net = unsupervised_loss.get_loss_sage(embs_batch, nodes_batch)
-            loss = loss_sup + loss_net
-        else:
-            if unsup_loss == 'margin':
-                loss_net = unsupervised_loss.get_loss_margin(embs_batch, nodes_batch)
-            elif unsup_loss == 'normal':
-                loss_net = unsupervised_loss.get_loss_sage(embs_batch, nodes_batch)
-            loss = loss_net
+        with profiler.phase('loss'):
+            if learn_method == 'sup':           
+                # supervised learning
+                logists = classification(embs_batch)
+                loss_sup = -torch.sum(logists[range(logists.size(0)), labels_batch], 0)
+                loss_sup /= len(nodes_batch)
+                loss = loss_sup
+            elif learn_method == 'plus_unsup':  
+                # supervised learning
+                logists = classification(embs_batch)
+                loss_sup = -torch.sum(logists[range(logists.size(0)), labels_batch], 0)
+                loss_sup /= len(nodes_batch)
+                # unsupervised learning
+                if unsup_loss == 'margin':
+                    loss_net = unsupervised_loss.get_loss_margin(embs_batch, nodes_batch)
+                elif unsup_loss == 'normal':
+                    loss_net = unsupervised_loss.get_loss_sage(embs_batch, nodes_batch)
+                loss = loss_sup + loss_net
+            else:
+                if unsup_loss == 'margin':
+                    loss_net = unsupervised_loss.get_loss_margin(embs_batch, nodes_batch)
+                elif unsup_loss == 'normal':
+                    loss_net = unsupervised_loss.get_loss_sage(embs_batch, nodes_batch)
+                loss = loss_net
         
         # print('Step [{}/{}], Loss: {:.4f}, Dealed Nodes [{}/{}] '.format(index+1, batches, loss.item(), len(visited_nodes), len(train_nodes)))
         log.write('Step [{}/{}], Loss: {:.4f}, Dealed Nodes [{}/{}] \n'.format(index+1, batches, loss.item(), len(visited_nodes), len(train_nodes)))
-        loss.backward()
-        for model in models:
-            nn.utils.clip_grad_norm_(model.parameters(), 5)
-        optimizer.step()
-        
-        optimizer.zero_grad()
-        for model in models:
-            model.zero_grad()
+        with profiler.phase('backward'):
+            loss.backward()
+        with profiler.phase('step'):
+            for model in models:
+                nn.utils.clip_grad_norm_(model.parameters(), 5)
+            optimizer.step()
+            
+            optimizer.zero_grad()
+            for model in models:
+                model.zero_grad()
+    if own_prefetcher:
+        prefetcher.close()
         
     return graphSage, classification
 
 if __name__ == '__main__':
     file_paths = {'cora_content':'cora/cora.content','cora_cite':'cora/cora.cites'}
-    log = open('log.txt', 'w')
+    rank, world_size = init_distributed()                                   # 用torchrun启动时为多进程数据并行
+    log = open('log.txt' if rank == 0 else os.devnull, 'w')
 
+    np.random.seed(824)                                                     # 所有rank划分出相同的训练集、验证集和测试集
     datacenter = DataCenter(file_paths)
-    datacenter.load_Dataset()
-    feature_data = torch.FloatTensor(getattr(datacenter, 'cora'+'_feats'))
+    with local_rank_zero_first():
+        datacenter.load_Dataset(mmap_mode='c')
+    feature_data = torch.from_numpy(getattr(datacenter, 'cora'+'_feats'))   # 写时复制的内存映射, 同一台机器上的所有rank共享一份物理内存
     label_data = torch.from_numpy(getattr(datacenter, 'cora'+'_labels')).long()
     adj_lists = getattr(datacenter, 'cora'+'_adj_lists')
 
-    random.seed(824)
-    np.random.seed(824)
+    random.seed(824 + rank)                                                 # 每个rank的采样器使用不同的随机数
+    np.random.seed(824 + rank)
     torch.manual_seed(824)
     torch.cuda.manual_seed_all(824)
 
@@ -634,12 +1371,24 @@ if __name__ == '__main__':
 
     ds = 'cora'
     epochs = 10
+    num_workers = 2                 # 后台采样进程数, 0表示在训练进程中采样
+    resume = False                  # 为True时从outputFiles中最好的checkpoint恢复模型参数
     max_vali_f1=0
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     graphSage = GraphSage(2, feature_data.size(1), 128, feature_data, getattr(datacenter, ds+'_adj_lists'), device, gcn='store_true', agg_func='MEAN')
     num_labels = len(set(getattr(datacenter, ds+'_labels')))
     classification = Classification(128, num_labels)
     unsupervised_loss = UnsupervisedLoss(getattr(datacenter, ds+'_adj_lists'), getattr(datacenter, ds+'_train'), device)
+    checkpoints = default_checkpoints() if rank == 0 else None
+    if resume and rank == 0:                                                # 其他rank在包装DistributedDataParallel时从rank 0得到参数
+        state = checkpoints.restore({'graphSage': graphSage, 'classification': classification})
+        if state is not None:
+            max_vali_f1 = state['metric']
+            print('Resumed from checkpoint with Validation F1 %f' % max_vali_f1)
+    if world_size > 1:                                                      # 参数从rank 0广播, 反向传播时all-reduce梯度
+        graphSage = DistributedDataParallel(graphSage)
+        if learn_method != 'unsup':
+            classification = DistributedDataParallel(classification)
 
     if learn_method == 'sup':
         print('GraphSage with Supervised Learning')
@@ -651,15 +1400,24 @@ if __name__ == '__main__':
         print('GraphSage with Net Unsupervised Learning')
         log.write('GraphSage with Net Unsupervised Learning\n')
 
+    prefetcher = BatchPrefetcher(_unwrap(graphSage), unsupervised_loss, num_workers) # worker在所有epoch中共用, 负采样缓存不会在epoch之间丢失
     for epoch in range(epochs):
         # print('----------------------EPOCH %d-----------------------' % epoch)
         print('Start to train EPOCH %d' % epoch)
         log.write('----------------------EPOCH %d-----------------------\n' % epoch)
-        graphSage, classification = apply_model(datacenter, ds, graphSage, classification, unsupervised_loss, 20, 'normal', device, learn_method, log)
-        if (epoch+1) % 2 == 0 and learn_method == 'unsup':
-            classification, max_vali_f1 = train_classification(log, datacenter, graphSage, classification, ds, device, max_vali_f1, 'debug')
-    if learn_method != 'unsup':
-            max_vali_f1 = evaluate(datacenter, ds, graphSage, classification, device, max_vali_f1 , 'debug', epoch, log)
+        graphSage, classification = apply_model(datacenter, ds, graphSage, classification, unsupervised_loss, 20, 'normal', device, learn_method, log,
+                                                rank=rank, world_size=world_size, prefetcher=prefetcher)
+        if (epoch+1) % 2 == 0 and learn_method == 'unsup' and rank == 0:    # 评估和保存模型只在rank 0进行
+            classification, max_vali_f1 = train_classification(log, datacenter, _unwrap(graphSage), classification, ds, device, max_vali_f1, 'debug', checkpoints=checkpoints, stage=epoch)
+    prefetcher.close()
+    if learn_method != 'unsup' and rank == 0:
+            max_vali_f1 = evaluate(datacenter, ds, _unwrap(graphSage), _unwrap(classification), device, max_vali_f1 , 'debug', epoch, log, checkpoints=checkpoints)
+    if profiler.enabled:                                                        # GNN_PROFILE=<文件>时打开
+        print(profiler.report())
     
+    if checkpoints is not None:
+        checkpoints.close()                                                 # 等后台线程写完最后的checkpoint并结束线程
     log.close()
+    if world_size > 1:
+        dist.destroy_process_group()
 
@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+"""
+GraphSage的在线推理服务: 图和checkpoint只加载一次, 为已有节点和请求中新加入的节点(inductive)返回嵌入和Classification的标签
+
+请求(POST /predict, JSON):
+    {"nodes": [已有节点编号, ...],
+     "new_nodes": [{"features": [长度为特征维度的列表], "neighbours": [邻居编号, ...]}, ...],
+     "embeddings": true}
+    新节点的邻居可以是已有节点(编号>=0), 也可以是同一请求中的其他新节点(-1表示第1个新节点, -2表示第2个, 以此类推)。
+    新节点只在这次请求中加入图, 不改变已有节点的邻居和嵌入。
+返回:
+    {"labels": [...], "embeddings": [[...], ...]}, 顺序为nodes在前, new_nodes在后; "embeddings": false时不返回嵌入
+    请求不合法时返回400; 超过--timeout秒没有算完时返回504, 还在队列中的请求不再计算
+GET /info 返回图和模型的规模, GET /stats 返回最近请求的延迟分位数和micro-batch的大小。
+
+并发的请求由后台线程合并成micro-batch, 每个micro-batch只做一次采样和一次GraphSage.forward。
+同一进程中可以直接使用InferenceEngine.predict, 不经过HTTP。
+
+用法:
+    python Graphsage-Pytorch-Inductive-Server.py --port 8000
+    python Graphsage-Pytorch-Inductive-Server.py --checkpoint outputFiles/model_best_debug_s1_ep10_0.8000.pt
+"""
+
+import argparse
+import collections
+import http.client
+import importlib.util
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.checkpoint import CheckpointManager
+
+
+def import_central():
+    " 训练脚本的文件名不是合法的模块名, 按路径导入 "
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Graphsage-Pytorch-Inductive-Central.py')
+    spec = importlib.util.spec_from_file_location('graphsage_central', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _node_ids(values, what):
+    " 把请求中的节点编号转换为int64数组; 不是整数的编号(例如3.7、\"3\"、true)抛出ValueError, 而不是被截断成另一个节点 "
+    ids = np.asarray(values)
+    if ids.size == 0:
+        return np.zeros(0, dtype=np.int64)
+    if ids.dtype.kind not in 'iu':
+        raise ValueError('{} must be integers'.format(what))
+    return ids.astype(np.int64).reshape(-1)
+
+
+class RequestGraph(object):
+    """
+    一个micro-batch中的新节点叠加在原图上得到的图, 提供与CentralityTable相同的neighbours接口
+    新节点的编号从num_nodes开始连续排列, 新节点的前k个邻居按与CentralityTable相同的中心性排序
+    Parameters:
+        cen_table: 原图的CentralityTable
+        degree: 原图每个节点的度
+        neighbour_lists: 每个新节点的邻居编号(numpy数组)
+    """
+    def __init__(self, cen_table, degree, neighbour_lists):
+        super(RequestGraph, self).__init__()
+        self.cen_table = cen_table
+        self.num_nodes = len(degree)
+        new_degree = np.array([len(neighs) for neighs in neighbour_lists], dtype=np.int64)
+        all_degree = np.concatenate((degree, new_degree))
+        centrality = np.zeros(len(neighbour_lists), dtype=np.float64)
+        for i, neighs in enumerate(neighbour_lists):                            # 中心性: 节点的度 / 其所有邻居的度之和
+            sum_degree = all_degree[neighs].sum()
+            if sum_degree != 0:
+                centrality[i] = new_degree[i] / sum_degree
+        all_centrality = np.concatenate((cen_table.centrality, centrality))
+        self.topk = [neighs[np.lexsort((-neighs, -all_centrality[neighs]))[:cen_table.k]] for neighs in neighbour_lists]  # 排序规则与CentralityTable相同
+
+    def neighbours(self, node):
+        if node < self.num_nodes:
+            return self.cen_table.neighbours(node)
+        return self.topk[node - self.num_nodes]
+
+
+class _Request(object):
+    " 已经检查并转换成numpy数组的请求 "
+    def __init__(self, nodes, features, neighbour_lists, embeddings):
+        self.nodes = nodes
+        self.features = features
+        self.neighbour_lists = neighbour_lists
+        self.embeddings = embeddings
+        self.size = len(nodes) + len(features)
+        self.future = Future()
+        self.start = time.perf_counter()
+
+
+class InferenceEngine(object):
+    """
+    把并发的请求合并成micro-batch, 在一个后台线程中计算
+    Parameters:
+        graphSage: 训练好的GraphSage
+        classification: 训练好的Classification
+        max_batch_size: 一个micro-batch最多包含的目标节点数
+        max_wait_ms: 取到第一个请求后最多再等待的毫秒数; 为0时只合并已经在队列中的请求, 负载低时没有额外延迟
+    """
+    def __init__(self, graphSage, classification, max_batch_size=256, max_wait_ms=0.):
+        super(InferenceEngine, self).__init__()
+        self.graphSage = graphSage.eval()
+        self.classification = classification.eval()
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.num_nodes = len(graphSage.raw_features)
+        self.degree = graphSage.adj_lists.degree()
+        self._queue = queue.Queue()
+        self._latencies = collections.deque(maxlen=10000)          # 最近请求的延迟(秒)
+        self._batch_sizes = collections.deque(maxlen=10000)
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def info(self):
+        return {'num_nodes': self.num_nodes, 'feature_size': self.graphSage.input_size,
+                'embedding_size': self.graphSage.out_size, 'num_classes': self.classification.fc1.out_features}
+
+    def submit(self, nodes=(), new_nodes=(), embeddings=True):
+        """
+        检查请求并放入队列, 返回Future, 结果为 {'labels': [...], 'embeddings': [...]}
+        请求不合法时直接抛出ValueError, 不影响同一micro-batch中的其他请求
+        """
+        request = self._prepare(nodes, new_nodes, embeddings)
+        self._queue.put(request)
+        return request.future
+
+    def predict(self, nodes=(), new_nodes=(), embeddings=True, timeout=None):
+        " 同步版本的submit, 同一进程中的调用方直接使用; 超时时取消还在队列中的请求并抛出TimeoutError "
+        future = self.submit(nodes, new_nodes, embeddings)
+        try:
+            return future.result(timeout)
+        except FutureTimeout:
+            future.cancel()
+            raise
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _prepare(self, nodes, new_nodes, embeddings):
+        nodes = _node_ids(nodes, 'node ids')
+        if len(nodes) and (nodes.min() < 0 or nodes.max() >= self.num_nodes):
+            raise ValueError('node ids must be in [0, {})'.format(self.num_nodes))
+        num_new = len(new_nodes)
+        features = np.zeros((num_new, self.graphSage.input_size), dtype=np.float32)
+        neighbour_lists = []
+        for i, node in enumerate(new_nodes):
+            feats = np.asarray(node['features'], dtype=np.float32)
+            if feats.shape != (self.graphSage.input_size, ):
+                raise ValueError('new_nodes[{}]: expected {} features, got {}'.format(i, self.graphSage.input_size, feats.size))
+            features[i] = feats
+            neighs = np.unique(_node_ids(node.get('neighbours', ()), 'new_nodes[{}]: neighbour ids'.format(i)))
+            if len(neighs) and (neighs.min() < -num_new or neighs.max() >= self.num_nodes):
+                raise ValueError('new_nodes[{}]: neighbour ids must be in [{}, {})'.format(i, -num_new, self.num_nodes))
+            neighbour_lists.append(neighs)
+        if len(nodes) + num_new == 0:
+            raise ValueError('empty request')
+        return _Request(nodes, features, neighbour_lists, bool(embeddings))
+
+    def _loop(self):
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+            batch, size, closed = [request], request.size, False
+            deadline = time.perf_counter() + self.max_wait
+            while size < self.max_batch_size:
+                try:
+                    timeout = deadline - time.perf_counter()
+                    request = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    closed = True
+                    break
+                batch.append(request)
+                size += request.size
+            batch = [request for request in batch if request.future.set_running_or_notify_cancel()]   # 已经超时取消的请求不再计算
+            if batch:
+                self._run_batch(batch)
+            if closed:
+                return
+
+    def _run_batch(self, batch):
+        try:
+            results = self._infer(batch)
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        end = time.perf_counter()
+        self._batch_sizes.append(len(batch))
+        for request, result in zip(batch, results):
+            self._latencies.append(end - request.start)
+            request.future.set_result(result)
+
+    def _infer(self, batch):
+        " 一个micro-batch的全部请求只做一次采样和一次forward "
+        targets, features, neighbour_lists = [], [], []
+        offset = self.num_nodes
+        for request in batch:
+            targets.append(request.nodes)
+            targets.append(np.arange(offset, offset + len(request.features)))
+            for neighs in request.neighbour_lists:                              # 请求内的新节点编号(-1, -2, ...)换成micro-batch中的编号
+                neighbour_lists.append(np.where(neighs < 0, offset - neighs - 1, neighs))
+            features.append(request.features)
+            offset += len(request.features)
+        targets = np.concatenate(targets)
+        features = torch.from_numpy(np.concatenate(features))
+
+        with torch.inference_mode():
+            plan = self.graphSage.build_plan(targets, cen_table=RequestGraph(self.graphSage.cen_table, self.degree, neighbour_lists))
+            embed_index, rows, cols, self_index, num_nodes = plan[0]
+            x = self._gather(embed_index, features)                             # 只取第一层用到的特征, 不复制整个特征矩阵
+            order = np.argsort(embed_index)
+            self_index = order[np.searchsorted(embed_index, self_index, sorter=order)]
+            plan[0] = (np.arange(len(embed_index)), rows, cols, self_index, num_nodes)
+            embs = self.graphSage(targets, plan=plan, features=x)
+            labels = self.classification(embs).argmax(1)
+
+        results, start = [], 0
+        for request in batch:
+            end = start + request.size
+            result = {'labels': labels[start:end].tolist()}
+            if request.embeddings:
+                result['embeddings'] = embs[start:end].tolist()
+            results.append(result)
+            start = end
+        return results
+
+    def _gather(self, embed_index, features):
+        old = embed_index < self.num_nodes
+        x = torch.empty(len(embed_index), features.size(1))
+        x[torch.from_numpy(old)] = self.graphSage.raw_features[torch.from_numpy(embed_index[old])]
+        x[torch.from_numpy(~old)] = features[torch.from_numpy(embed_index[~old] - self.num_nodes)]
+        return x
+
+    def stats(self):
+        " 最近请求的延迟分位数(毫秒)和平均micro-batch大小 "
+        latencies = np.array(self._latencies) * 1000
+        if len(latencies) == 0:
+            return {'requests': 0}
+        return {'requests': len(latencies), 'p50_ms': float(np.percentile(latencies, 50)),
+                'p99_ms': float(np.percentile(latencies, 99)), 'max_ms': float(latencies.max()),
+                'mean_batch': float(np.mean(self._batch_sizes))}
+
+
+class PredictHandler(BaseHTTPRequestHandler):
+    " /predict, /info, /stats; 使用HTTP/1.1保持连接, 避免每个请求重新建立TCP连接 "
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True                                              # 响应头和响应体分两次写出, 不关闭Nagle会等待对方的延迟ACK
+
+    def do_GET(self):
+        if self.path == '/info':
+            self._send(200, self.server.engine.info())
+        elif self.path == '/stats':
+            self._send(200, self.server.engine.stats())
+        else:
+            self._send(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._send(404, {'error': 'not found'})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            future = self.server.engine.submit(body.get('nodes', ()), body.get('new_nodes', ()), body.get('embeddings', True))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self._send(400, {'error': str(e)})
+            return
+        timeout = self.server.request_timeout
+        try:
+            result = future.result(timeout)
+        except FutureTimeout:
+            future.cancel()                                                     # 还在队列中时不再计算
+            self._send(504, {'error': 'inference did not finish within {:g}s'.format(timeout)})
+            return
+        except Exception as e:
+            self._send(500, {'error': str(e)})
+            return
+        self._send(200, result)
+
+    def _send(self, code, obj):
+        data = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass                                                                    # 每个请求都写日志会明显增加延迟
+
+
+def make_server(engine, host='127.0.0.1', port=8000, timeout=30.):
+    """
+    创建HTTP服务, 每个连接一个线程, 请求在engine中合并成micro-batch; port=0时由系统分配端口
+    timeout: 一个/predict请求最多等待的秒数, 超时返回504, 处理线程不会因为engine阻塞而一直占用; None为不限制
+    """
+    server = ThreadingHTTPServer((host, port), PredictHandler)
+    server.daemon_threads = True
+    server.engine = engine
+    server.request_timeout = timeout
+    return server
+
+
+class InferenceClient(object):
+    """
+    HTTP客户端, 保持一个长连接; 一个对象只能在一个线程中使用
+    同一进程中不需要HTTP时直接调用InferenceEngine.predict
+    """
+    def __init__(self, host='127.0.0.1', port=8000, timeout=30):
+        super(InferenceClient, self).__init__()
+        self.conn = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def _request(self, method, path, body=None):
+        self.conn.request(method, path, body=None if body is None else json.dumps(body).encode(),   # bytes与请求头一起发出
+                          headers={'Content-Type': 'application/json'})
+        response = self.conn.getresponse()
+        result = json.loads(response.read())
+        if response.status != 200:
+            raise ValueError(result.get('error', response.reason))
+        return result
+
+    def predict(self, nodes=(), new_nodes=(), embeddings=True):
+        return self._request('POST', '/predict', {'nodes': list(nodes), 'new_nodes': list(new_nodes), 'embeddings': embeddings})
+
+    def info(self):
+        return self._request('GET', '/info')
+
+    def stats(self):
+        return self._request('GET', '/stats')
+
+    def close(self):
+        self.conn.close()
+
+
+def load_engine(central, file_paths, checkpoint=None, checkpoint_dir='outputFiles', num_layers=2, hidden=128, gcn=True,
+                agg_func='MEAN', max_batch_size=256, max_wait_ms=0.):
+    """
+    按训练脚本的方式加载图, 构造模型并载入checkpoint(默认为checkpoint_dir中验证集F1最高的一个)
+    模型的超参数必须与训练时相同
+    """
+    np.random.seed(824)                                                         # 与训练时相同的划分, 保证邻接表相同
+    datacenter = central.DataCenter(file_paths)
+    datacenter.load_Dataset(mmap_mode='c')
+    feature_data = torch.from_numpy(datacenter.cora_feats)
+    num_labels = len(set(datacenter.cora_labels))
+    graphSage = central.GraphSage(num_layers, feature_data.size(1), hidden, feature_data, datacenter.cora_adj_lists, 'cpu', gcn=gcn, agg_func=agg_func)
+    classification = central.Classification(hidden, num_labels)
+    with CheckpointManager(checkpoint_dir) as checkpoints:
+        state = checkpoints.restore({'graphSage': graphSage, 'classification': classification}, path=checkpoint)
+    if state is None:
+        raise FileNotFoundError('no checkpoint found in {}'.format(checkpoint_dir))
+    return InferenceEngine(graphSage, classification, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--content', type=str, default='cora/cora.content', help='Node feature file.')
+    parser.add_argument('--cites', type=str, default='cora/cora.cites', help='Edge file.')
+    parser.add_argument('--checkpoint', type=str, default=None, help='Checkpoint to serve (default: best one in --checkpoint_dir).')
+    parser.add_argument('--checkpoint_dir', type=str, default='outputFiles', help='Directory written by the training script.')
+    parser.add_argument('--num_layers', type=int, default=2, help='Number of GraphSage layers used in training.')
+    parser.add_argument('--hidden', type=int, default=128, help='Embedding size used in training.')
+    parser.add_argument('--no_gcn', action='store_true', default=False, help='The model was trained with gcn=False.')
+    parser.add_argument('--agg_func', type=str, default='MEAN', choices=['MEAN', 'MAX', 'SUM'], help='Aggregator used in training.')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on.')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on.')
+    parser.add_argument('--max_batch_size', type=int, default=256, help='Maximum number of target nodes per micro-batch.')
+    parser.add_argument('--max_wait_ms', type=float, default=0., help='Extra time to wait for more requests before running a micro-batch.')
+    parser.add_argument('--timeout', type=float, default=30., help='Seconds a /predict request may wait before returning 504.')
+    args = parser.parse_args()
+
+    engine = load_engine(import_central(), {'cora_content': args.content, 'cora_cite': args.cites}, args.checkpoint, args.checkpoint_dir,
+                         args.num_layers, args.hidden, not args.no_gcn, args.agg_func, args.max_batch_size, args.max_wait_ms)
+    server = make_server(engine, args.host, args.port, args.timeout)
+    print('Serving GraphSage on http://{}:{}'.format(*server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    engine.close()
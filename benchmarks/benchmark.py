@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+GCN, GAT, GraphSage的统一基准测试
+
+在cora和可配置规模、度分布、特征维度的合成图上运行三个模型, 统计
+    load_time_cold / load_time_cached: 不使用缓存 / 使用磁盘缓存时读取数据的时间(秒)
+    epoch_time: 每个epoch训练时间的中位数(秒), 第一个epoch作为预热不计入
+    nodes_per_sec: 每秒处理的节点数, 全图训练的GCN/GAT按全部节点计, GraphSage按训练节点计
+    inference_ms: 全图推理时间的中位数(毫秒)
+    peak_rss_mb: 进程的峰值常驻内存(MB)
+每个 (模型, 数据集) 在单独的子进程中运行, 峰值内存互不影响。结果写成JSON, 便于比较不同提交之间的差异。
+
+用法:
+    python benchmarks/benchmark.py --datasets cora synthetic --nodes 10000 50000 --degree_dist powerlaw
+"""
+
+import argparse
+import importlib.util
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SCRIPTS = {
+    'gcn': os.path.join(ROOT, 'GCN', 'GCN.py'),
+    'gat': os.path.join(ROOT, 'GAT', 'GAT.py'),
+    'graphsage': os.path.join(ROOT, 'GraphSage-Pytorch-Inductive', 'Graphsage-Pytorch-Inductive-Central.py'),
+}
+
+
+def import_script(model):
+    """按文件路径导入模型脚本, GraphSage的文件名含有'-', 不能直接import"""
+    name = 'bench_' + model
+    spec = importlib.util.spec_from_file_location(name, SCRIPTS[model])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_synthetic(out_dir, num_nodes, avg_degree, degree_dist='uniform', feat_dim=500, num_classes=7,
+                   feat_density=0.02, powerlaw_exponent=2.5, seed=0):
+    """生成cora格式的合成图(.content和.cites), 使三个模型的数据读取流程也被测到
+    Params:
+        num_nodes: 节点数
+        avg_degree: 对称化之后的平均度, 其中2条来自把所有节点连成一个环的边, 保证每个节点都有邻居
+        degree_dist: 'uniform'时边的端点均匀选取, 'powerlaw'时按Chung-Lu模型选取, 度服从幂律分布
+        feat_dim: 特征维度, 特征为稀疏的0/1向量, 非零比例为feat_density
+        powerlaw_exponent: 幂律分布的指数
+    Return:
+        数据集名称, 文件为 out_dir/<name>.content 和 out_dir/<name>.cites
+    """
+    name = 'synthetic_n{}_d{}_{}_f{}'.format(num_nodes, avg_degree, degree_dist, feat_dim)
+    content = os.path.join(out_dir, name + '.content')
+    cite = os.path.join(out_dir, name + '.cites')
+    if os.path.exists(content) and os.path.exists(cite):
+        return name
+    rng = np.random.RandomState(seed)
+    node_names = rng.permutation(num_nodes) + 1 # 节点名称与编号不同, 映射过程也被测到
+    labels = rng.randint(num_classes, size=num_nodes)
+    with open(content, 'w') as f:
+        for start in range(0, num_nodes, 10000): # 分块生成, 避免一次分配N*F的矩阵
+            end = min(start + 10000, num_nodes)
+            feats = (rng.random_sample((end - start, feat_dim)) < feat_density).astype(np.int64)
+            rows = np.column_stack((node_names[start:end], feats, labels[start:end]))
+            np.savetxt(f, rows, fmt='%d', delimiter='\t')
+
+    num_edges = num_nodes * max(avg_degree - 2, 0) // 2 # 每条边在读取时会被对称化, 环贡献了每个节点的2个度
+    if degree_dist == 'powerlaw':
+        weights = np.arange(1, num_nodes + 1, dtype=np.float64) ** (-1.0 / (powerlaw_exponent - 1))
+        weights /= weights.sum()
+        src = rng.choice(num_nodes, size=num_edges, p=weights)
+        dst = rng.choice(num_nodes, size=num_edges, p=weights)
+    elif degree_dist == 'uniform':
+        src = rng.randint(num_nodes, size=num_edges)
+        dst = rng.randint(num_nodes, size=num_edges)
+    else:
+        raise ValueError("degree_dist can be only 'uniform' or 'powerlaw'.")
+    keep = src != dst
+    ring = np.arange(num_nodes) # 孤立节点没有正例, GraphSage的无监督损失要求每个节点都有邻居
+    src = np.concatenate((ring, src[keep]))
+    dst = np.concatenate(((ring + 1) % num_nodes, dst[keep]))
+    np.savetxt(cite, np.column_stack((node_names[src], node_names[dst])), fmt='%d', delimiter='\t')
+    return name
+
+
+def time_call(fn):
+    t = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - t
+
+
+def time_repeated(fn, repeat, warmup=1):
+    """先运行warmup次预热, 再运行repeat次, 返回每次的时间"""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        times.append(time_call(fn)[1])
+    return times
+
+
+def bench_gcn(path, name, args):
+    gcn = import_script('gcn')
+    load = lambda use_cache: gcn.load_data(path, name, use_cache=use_cache)
+    _, load_cold = time_call(lambda: load(False))
+    load(True) # 第一次调用生成缓存
+    (adj, features, labels, idx_train, _, _), load_cached = time_call(lambda: load(True))
+    model = gcn.GCN(features.shape[1], args.hidden, int(labels.max()) + 1, dropout=0.5)
+    optimizer = optim.Adam(model.parameters(), lr=0.01, weight_decay=5e-4)
+
+    def epoch():
+        model.train()
+        optimizer.zero_grad()
+        output = model(adj, features)
+        F.nll_loss(output[idx_train], labels[idx_train]).backward()
+        optimizer.step()
+
+    def infer():
+        model.eval()
+        with torch.inference_mode():
+            model(adj, features)
+
+    return load_cold, load_cached, len(labels), epoch, infer
+
+
+def bench_gat(path, name, args):
+    gat = import_script('gat')
+    load = lambda use_cache: gat.load_data(path, name, sparse=True, use_cache=use_cache) # 稠密的N*N注意力无法扩展到大图
+    _, load_cold = time_call(lambda: load(False))
+    load(True)
+    (adj, features, labels, idx_train, _, _), load_cached = time_call(lambda: load(True))
+    model = gat.GAT(features.shape[1], 8, int(labels.max()) + 1, dropout=0.6, alpha=0.2, nheads=8, sparse=True)
+    optimizer = optim.Adam(model.parameters(), lr=0.005, weight_decay=5e-4)
+
+    def epoch():
+        model.train()
+        optimizer.zero_grad()
+        output = model(features, adj)
+        F.nll_loss(output[idx_train], labels[idx_train]).backward()
+        optimizer.step()
+
+    def infer():
+        model.eval()
+        with torch.inference_mode():
+            model(features, adj)
+
+    return load_cold, load_cached, len(labels), epoch, infer
+
+
+def bench_graphsage(path, name, args):
+    sage = import_script('graphsage')
+    file_paths = {'cora_content': os.path.join(path, name + '.content'), 'cora_cite': os.path.join(path, name + '.cites')}
+
+    def load(use_cache):
+        datacenter = sage.DataCenter(file_paths)
+        datacenter.load_Dataset('cora', use_cache=use_cache)
+        return datacenter
+
+    _, load_cold = time_call(lambda: load(False))
+    load(True)
+    datacenter, load_cached = time_call(lambda: load(True))
+    features = torch.from_numpy(np.array(datacenter.cora_feats, dtype=np.float32))
+    graphSage = sage.GraphSage(2, features.size(1), 128, features, datacenter.cora_adj_lists, 'cpu', gcn=True, agg_func='MEAN')
+    classification = sage.Classification(128, int(datacenter.cora_labels.max()) + 1)
+    unsupervised_loss = sage.UnsupervisedLoss(datacenter.cora_adj_lists, datacenter.cora_train, 'cpu')
+    log = io.StringIO()
+
+    def epoch():
+        sage.apply_model(datacenter, 'cora', graphSage, classification, unsupervised_loss, args.sage_batch_size,
+                         'normal', 'cpu', 'sup', log)
+        log.seek(0)
+        log.truncate()
+
+    def infer():
+        graphSage.inference(500)
+
+    return load_cold, load_cached, len(datacenter.cora_train), epoch, infer
+
+
+BENCHMARKS = {'gcn': bench_gcn, 'gat': bench_gat, 'graphsage': bench_graphsage}
+
+
+def run_worker(spec):
+    """在子进程中测试一个 (模型, 数据集), 返回结果字典"""
+    args = argparse.Namespace(**spec['args'])
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    load_cold, load_cached, num_nodes, epoch, infer = BENCHMARKS[spec['model']](spec['path'], spec['name'], args)
+    epoch_times = time_repeated(epoch, args.epochs)
+    inference_times = time_repeated(infer, args.repeat)
+    epoch_time = float(np.median(epoch_times))
+    return {
+        'status': 'ok',
+        'load_time_cold': load_cold,
+        'load_time_cached': load_cached,
+        'epoch_time': epoch_time,
+        'epoch_times': epoch_times,
+        'nodes_per_sec': num_nodes / epoch_time,
+        'inference_ms': float(np.median(inference_times)) * 1000,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024., # Linux下单位为KB
+    }
+
+
+def failure(error, details):
+    """失败的测试在结果中的记录"""
+    return {'status': 'failed', 'error': error, 'traceback': details}
+
+
+def run_worker_safe(spec):
+    """run_worker抛出异常时返回失败记录, 而不是让子进程带着traceback退出"""
+    try:
+        return run_worker(spec)
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e) if str(e) else type(e).__name__
+        return failure(error, traceback.format_exc())
+
+
+def run_isolated(spec):
+    """启动子进程运行run_worker, 最后一行输出为JSON结果; 子进程异常退出(例如内存不足被杀死)时也返回失败记录"""
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', json.dumps(spec)],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    lines = proc.stdout.strip().splitlines()
+    if proc.returncode != 0 or not lines:
+        stderr = proc.stderr.strip()
+        return failure('exit code %d' % proc.returncode, '\n'.join(stderr.splitlines()[-20:]))
+    try:
+        return json.loads(lines[-1])
+    except ValueError:
+        return failure('invalid worker output', '\n'.join(lines[-20:]))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def collect_datasets(args, work_dir):
+    """返回 [(数据集描述, 目录, 名称)]"""
+    datasets = []
+    if 'cora' in args.datasets:
+        if os.path.exists(os.path.join(args.cora_dir, 'cora.content')):
+            datasets.append(({'name': 'cora'}, args.cora_dir, 'cora'))
+        else:
+            print('Skipping cora: {} not found.'.format(os.path.join(args.cora_dir, 'cora.content')))
+    if 'synthetic' in args.datasets:
+        for num_nodes in args.nodes:
+            print('Generating synthetic graph with {} nodes...'.format(num_nodes))
+            name = make_synthetic(work_dir, num_nodes, args.avg_degree, args.degree_dist, args.feat_dim,
+                                  args.num_classes, args.feat_density, args.powerlaw_exponent, args.seed)
+            info = {'name': name, 'num_nodes': num_nodes, 'avg_degree': args.avg_degree,
+                    'degree_dist': args.degree_dist, 'feat_dim': args.feat_dim}
+            datasets.append((info, work_dir, name))
+    return datasets
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', nargs='+', default=['gcn', 'gat', 'graphsage'], choices=sorted(BENCHMARKS))
+    parser.add_argument('--datasets', nargs='+', default=['cora', 'synthetic'], choices=['cora', 'synthetic'])
+    parser.add_argument('--cora_dir', type=str, default=os.path.join(ROOT, 'GraphSage-Pytorch-Inductive', 'cora'),
+                        help='Directory holding cora.content and cora.cites.')
+    parser.add_argument('--nodes', type=int, nargs='+', default=[10000], help='Synthetic graph sizes.')
+    parser.add_argument('--avg_degree', type=int, default=10, help='Average degree of the synthetic graphs.')
+    parser.add_argument('--degree_dist', type=str, default='uniform', choices=['uniform', 'powerlaw'])
+    parser.add_argument('--powerlaw_exponent', type=float, default=2.5)
+    parser.add_argument('--feat_dim', type=int, default=500, help='Feature width of the synthetic graphs.')
+    parser.add_argument('--feat_density', type=float, default=0.02, help='Fraction of non-zero synthetic features.')
+    parser.add_argument('--num_classes', type=int, default=7)
+    parser.add_argument('--epochs', type=int, default=5, help='Timed training epochs (after one warm-up epoch).')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed inference runs (after one warm-up run).')
+    parser.add_argument('--hidden', type=int, default=16, help='GCN hidden size.')
+    parser.add_argument('--sage_batch_size', type=int, default=256)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--work_dir', type=str, default=None, help='Where synthetic graphs are written (default: a temp dir).')
+    parser.add_argument('--output', type=str, default='benchmark_results.json')
+    parser.add_argument('--worker', type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        print(json.dumps(run_worker_safe(json.loads(args.worker))))
+        sys.exit(0)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='gnn_bench_')
+    os.makedirs(work_dir, exist_ok=True)
+    worker_args = {k: getattr(args, k) for k in ('epochs', 'repeat', 'hidden', 'sage_batch_size', 'seed')}
+    results = []
+    for info, path, name in collect_datasets(args, work_dir):
+        for model in args.models:
+            print('Running {} on {}...'.format(model, info['name']))
+            spec = {'model': model, 'path': path + os.sep, 'name': name, 'args': worker_args}
+            result = dict(model=model, dataset=info, **run_isolated(spec))
+            results.append(result)
+            if result['status'] == 'failed':
+                print('  failed: {}'.format(result['error']))
+            else:
+                print('  load {:.3f}s (cached {:.3f}s), epoch {:.4f}s, {:.0f} nodes/s, inference {:.1f}ms, peak RSS {:.0f}MB'.format(
+                    result['load_time_cold'], result['load_time_cached'], result['epoch_time'],
+                    result['nodes_per_sec'], result['inference_ms'], result['peak_rss_mb']))
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'platform': platform.platform(),
+        'num_threads': torch.get_num_threads(),
+        'args': {k: v for k, v in vars(args).items() if k != 'worker'},
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Results written to {}'.format(args.output))
+    failed = [r for r in results if r['status'] == 'failed']
+    if failed:
+        print('{} of {} benchmarks failed.'.format(len(failed), len(results)))
+        sys.exit(1)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+二进制数据集缓存
+
+预处理好的数组以.npy格式存放在磁盘上, 之后用np.load(mmap_mode='r')直接映射读取,
+重启的进程和并行的多个进程共享同一份页缓存, 不再重复解析文本文件。
+缓存目录名是源文件(路径、大小、修改时间)和预处理选项的哈希, 任何一项变化都会生成新的缓存。
+由内存中的数组计算的结果没有源文件, 以array_digest得到的数组内容的哈希作为选项。
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import scipy.sparse as sp
+
+
+def cache_key(sources, options):
+    """根据源文件和预处理选项计算缓存的键"""
+    h = hashlib.sha1()
+    for path in sources:
+        st = os.stat(path)
+        h.update(json.dumps([os.path.abspath(path), st.st_size, st.st_mtime_ns]).encode())
+    h.update(json.dumps(options, sort_keys=True).encode())
+    return h.hexdigest()[:16]
+
+
+def array_digest(arrays):
+    """数组的形状、类型和内容的哈希"""
+    h = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        h.update(json.dumps([array.shape, array.dtype.str]).encode())
+        h.update(array.view(np.uint8).ravel())
+    return h.hexdigest()[:16]
+
+
+def default_cache_dir(sources):
+    """默认缓存在第一个源文件旁边的.npcache目录, 没有源文件时为当前目录下的.npcache, 可以用环境变量GRAPH_CACHE_DIR修改"""
+    root = os.path.dirname(os.path.abspath(sources[0])) if sources else os.getcwd()
+    return os.environ.get('GRAPH_CACHE_DIR', os.path.join(root, '.npcache'))
+
+
+def load_cached(sources, options, build, cache_dir=None, mmap_mode='r'):
+    """读取缓存, 不存在时调用build()生成并写入缓存
+    Params:
+        sources: 源文件路径列表, 可以为空, 这时options必须能唯一确定结果
+        options: 预处理选项, 可以json序列化的dict
+        build: 无参数的函数, 返回 {名称: numpy数组}
+        cache_dir: 缓存目录, 默认见default_cache_dir
+        mmap_mode: 'r'为只读映射; 'c'为写时复制, 数组可写, 没有写过的页仍与其他进程共享
+    Return:
+        {名称: 内存映射数组}
+    """
+    cache_dir = cache_dir or default_cache_dir(sources)
+    target = os.path.join(cache_dir, cache_key(sources, options))
+    if not os.path.isdir(target):
+        arrays = build()
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=cache_dir) # 先写到临时目录再整体改名, 其他进程不会读到写了一半的缓存
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), np.asarray(array))
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump({'sources': [os.path.abspath(p) for p in sources], 'options': options}, f)
+        try:
+            os.rename(tmp, target)
+        except OSError: # 其他进程已经写好了同一份缓存
+            shutil.rmtree(tmp)
+    return {name[:-4]: np.load(os.path.join(target, name), mmap_mode=mmap_mode)
+            for name in os.listdir(target) if name.endswith('.npy')}
+
+
+def csr_to_arrays(name, mx):
+    """把scipy稀疏矩阵拆成可以缓存的CSR数组"""
+    mx = sp.csr_matrix(mx)
+    return {name + '_data': mx.data, name + '_indices': mx.indices,
+            name + '_indptr': mx.indptr, name + '_shape': np.array(mx.shape, dtype=np.int64)}
+
+
+def csr_from_arrays(arrays, name):
+    """由缓存的CSR数组还原scipy稀疏矩阵, 不复制数据"""
+    return sp.csr_matrix((arrays[name + '_data'], arrays[name + '_indices'], arrays[name + '_indptr']),
+                         shape=tuple(int(x) for x in arrays[name + '_shape']), copy=False)
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+异步保存模型的state_dict, 只保留指标最好的top_k个
+
+save()在调用线程中只把参数复制到CPU(远快于序列化和写盘), 序列化、写盘和删除旧文件都在后台线程中完成。
+只保存state_dict, 不保存挂在模型上的特征矩阵和邻接表等图数据。
+目录中的checkpoints.json记录现有的checkpoint及其指标, 进程重启后可以继续按top_k管理, 也可以用restore()恢复训练。
+进程退出前由同一个atexit函数写完所有未关闭的CheckpointManager的队列; 不再使用的CheckpointManager应调用close()结束后台线程。
+"""
+
+import atexit
+import json
+import os
+import queue
+import threading
+import weakref
+
+import torch
+
+_open_managers = weakref.WeakSet() # 还没有close()的CheckpointManager
+
+
+@atexit.register
+def _flush_all():
+    " 进程退出前写完队列中的checkpoint "
+    for manager in list(_open_managers):
+        manager.close()
+
+
+class CheckpointManager(object):
+    """
+    Params:
+        directory: 保存目录
+        top_k: 保留的checkpoint数量
+        mode: 'max'时指标越大越好, 'min'时越小越好
+    """
+
+    INDEX = 'checkpoints.json'
+
+    def __init__(self, directory, top_k=3, mode='max'):
+        assert mode in ('max', 'min')
+        self.directory = directory
+        self.top_k = top_k
+        self.mode = mode
+        os.makedirs(directory, exist_ok=True)
+        self.entries = self._read_index() # [{'file', 'metric', ...}], 按指标从好到坏排列
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._error = None
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+        _open_managers.add(self)
+
+    def _read_index(self):
+        path = os.path.join(self.directory, self.INDEX)
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            entries = json.load(f)
+        return [e for e in entries if os.path.exists(os.path.join(self.directory, e['file']))]
+
+    def _write_index(self):
+        path = os.path.join(self.directory, self.INDEX)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(path + '.tmp', path)
+
+    def _rank(self, metric):
+        return -metric if self.mode == 'max' else metric
+
+    def is_better(self, metric):
+        " metric能否进入已写完的top_k; 队列中还没写完的由后台线程写完后再淘汰 "
+        with self._lock:
+            return len(self.entries) < self.top_k or self._rank(metric) < self._rank(self.entries[-1]['metric'])
+
+    def save(self, models, metric, filename, **info):
+        """
+        把models的state_dict放入后台线程的写盘队列
+        Params:
+            models: {名称: nn.Module}
+            metric: 用于排序的指标
+            filename: 文件名
+            info: 其他需要记录的信息(例如epoch), 会写入checkpoint和checkpoints.json
+        Return:
+            是否保存(指标进不了top_k时不保存)
+        """
+        self._raise_error()
+        if self.closed:
+            raise RuntimeError('CheckpointManager is closed')
+        if not self.is_better(metric):
+            return False
+        state = {name: {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()}
+                 for name, model in models.items()}
+        self._queue.put((filename, {'models': state, 'metric': metric, 'info': info}))
+        return True
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None: # close()
+                self._queue.task_done()
+                return
+            filename, checkpoint = item
+            try:
+                path = os.path.join(self.directory, filename)
+                torch.save(checkpoint, path + '.tmp')
+                os.replace(path + '.tmp', path) # 不会留下写了一半的checkpoint
+                with self._lock:
+                    self.entries = [e for e in self.entries if e['file'] != filename]
+                    self.entries.append(dict(file=filename, metric=checkpoint['metric'], **checkpoint['info']))
+                    self.entries.sort(key=lambda e: self._rank(e['metric']))
+                    removed, self.entries = self.entries[self.top_k:], self.entries[:self.top_k]
+                    self._write_index()
+                for e in removed:
+                    os.remove(os.path.join(self.directory, e['file']))
+            except Exception as e: # 在下一次save/wait时在训练线程中抛出
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def wait(self):
+        " 等待队列中的checkpoint全部写完 "
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        " 写完队列中的checkpoint并结束后台线程, 之后不能再save, 可以多次调用 "
+        if not self.closed:
+            self._queue.put(None)
+            self._thread.join()
+        _open_managers.discard(self)
+        self._raise_error()
+
+    @property
+    def closed(self):
+        return not self._thread.is_alive()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def best(self):
+        " 指标最好的checkpoint的路径, 没有时返回None "
+        self.wait()
+        return os.path.join(self.directory, self.entries[0]['file']) if self.entries else None
+
+    def restore(self, models, path=None, map_location='cpu'):
+        """
+        把checkpoint中的参数载入models, 默认使用最好的checkpoint
+        Return:
+            checkpoint的信息 {'metric': ..., 'info': {...}}, 没有checkpoint时返回None
+        """
+        path = path or self.best()
+        if path is None:
+            return None
+        checkpoint = torch.load(path, map_location=map_location)
+        for name, model in models.items():
+            model.load_state_dict(checkpoint['models'][name])
+        return {'metric': checkpoint['metric'], 'info': checkpoint['info']}
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+训练循环共用的验证调度: 按节奏验证、早停、恢复最好的参数
+
+验证在torch.inference_mode下运行, 不记录计算图。每every个epoch验证一次;
+adaptive=True时连续验证没有改进就把间隔加倍(最多max_every), 有改进时恢复为every, 训练后期收敛变慢时少做验证。
+"""
+
+import torch
+
+from common.profiling import profiler
+
+
+class EvaluationScheduler(object):
+    """
+    Params:
+        model: 被训练的模型, 验证时切换到eval模式, 验证后恢复原来的模式
+        evaluate: 无参数的函数, 返回 (验证集损失, 验证集准确率), 损失越小越好
+        every: 验证间隔(epoch数)
+        adaptive: 是否在没有改进时加大验证间隔
+        max_every: adaptive时验证间隔的上限
+        patience: 最好的一次验证之后连续patience个epoch没有改进时停止, 0表示不早停
+        restore_best: 为True时记录验证损失最小时的参数, restore()时载入
+    """
+
+    def __init__(self, model, evaluate, every=1, adaptive=False, max_every=16, patience=0, restore_best=True):
+        assert every >= 1
+        self.model = model
+        self.evaluate = evaluate
+        self.every = every
+        self.adaptive = adaptive
+        self.max_every = max(every, min(max_every, patience) if patience > 0 else max_every)
+        self.patience = patience
+        self.restore_best = restore_best
+        self.interval = every
+        self.next_epoch = every - 1
+        self.best = float('inf')
+        self.best_epoch = -1
+        self.best_state = None
+        self.should_stop = False
+        self.evaluations = 0
+
+    def due(self, epoch):
+        " epoch结束时是否需要验证 "
+        return epoch >= self.next_epoch
+
+    def step(self, epoch, result=None):
+        """
+        在每个epoch结束时调用, 按节奏验证并更新最好结果和早停状态
+        Params:
+            result: (损失, 准确率), 给出时直接使用(例如训练时前向得到的输出), 不再调用evaluate
+        Return:
+            这一个epoch验证了时返回 (损失, 准确率), 否则返回None
+        """
+        if not self.due(epoch):
+            self._check_patience(epoch)
+            return None
+        if result is None:
+            result = self.run()
+        loss, acc = (float(v) for v in result)
+        self.evaluations += 1
+        if loss < self.best:
+            self.best, self.best_epoch = loss, epoch
+            if self.restore_best:
+                self.best_state = {k: v.detach().clone() for k, v in self.model.state_dict().items()}
+            self.interval = self.every
+        elif self.adaptive:
+            self.interval = min(self.interval * 2, self.max_every)
+        self.next_epoch = epoch + self.interval
+        self._check_patience(epoch)
+        return loss, acc
+
+    def run(self):
+        " 在inference_mode和eval模式下运行evaluate "
+        training = self.model.training
+        self.model.eval()
+        try:
+            with torch.inference_mode(), profiler.phase('eval'):
+                return self.evaluate()
+        finally:
+            self.model.train(training)
+
+    def _check_patience(self, epoch):
+        if self.patience > 0 and self.best_epoch >= 0 and epoch - self.best_epoch >= self.patience:
+            self.should_stop = True
+
+    def restore(self):
+        " 把验证损失最小时的参数载入模型, 返回对应的epoch(没有记录时返回-1) "
+        if self.best_state is not None:
+            self.model.load_state_dict(self.best_state)
+        return self.best_epoch
+
+
+def validation_log(result):
+    " step()返回值的打印字段, 没有验证的epoch为空列表 "
+    if result is None:
+        return []
+    return ['loss_val: {:.4f}'.format(result[0]), 'acc_val: {:.4f}'.format(result[1])]
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+分块读取边文件, 在内存放不下整个边文件时构造CSR邻接表
+
+边文件按chunk_size行一块读入, 每块单独把节点名称映射为编号、排序去重后作为一个有序段(run)写到磁盘,
+最后按节点编号区间把所有有序段归并成CSR文件(indptr.npy, indices.npy): 每个段一个读取位置,
+用堆找出下一个区间内还有边的段, 没有边落在区间内的段不会被访问。
+除了长度为N的计数数组外, 任何时刻内存中最多只有约chunk_size条边。
+"""
+
+import heapq
+import itertools
+import os
+import tempfile
+
+import numpy as np
+
+DEFAULT_CHUNK_SIZE = 1 << 20 # 每块读取的行数
+
+
+class NodeIndex(object):
+    """用排序+二分查找把节点名称映射为节点编号, 节点编号即名称在names中的下标"""
+
+    def __init__(self, names):
+        names = np.asarray(names)
+        try: # 名称都是整数时按整数比较, 比字符串快得多
+            names = names.astype(np.int64)
+            self.numeric = True
+        except ValueError:
+            self.numeric = False
+        self.names = names
+        self.sorter = np.argsort(names, kind='stable')
+        self.sorted_names = names[self.sorter]
+
+    def __len__(self):
+        return len(self.names)
+
+    def lookup(self, tokens):
+        tokens = np.asarray(tokens)
+        if self.numeric:
+            tokens = tokens.astype(np.int64)
+        pos = np.minimum(np.searchsorted(self.sorted_names, tokens), len(self.names) - 1)
+        missing = self.sorted_names[pos] != tokens
+        if missing.any():
+            raise KeyError(tokens[missing][0])
+        return self.sorter[pos]
+
+
+def iter_edge_chunks(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """每次读取chunk_size行, 返回 (行数*2) 的名称数组"""
+    with open(path) as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if not lines:
+                break
+            tokens = ''.join(lines).split()
+            num_lines = sum(1 for line in lines if line.strip())
+            assert len(tokens) == 2 * num_lines # 每行必须恰好是一对节点
+            yield np.array(tokens).reshape(-1, 2)
+
+
+def iter_mapped_edges(path, node_index, chunk_size=DEFAULT_CHUNK_SIZE):
+    """逐块返回映射为节点编号的边 (行数*2)"""
+    for chunk in iter_edge_chunks(path, chunk_size):
+        yield node_index.lookup(chunk.ravel()).reshape(-1, 2)
+
+
+def _spill_runs(path, node_index, run_dir, chunk_size, symmetric, dedupe):
+    """第一遍: 每块映射、排序后写成一个有序段, 同时统计每个节点的出边数"""
+    N = len(node_index)
+    counts = np.zeros(N, dtype=np.int64)
+    runs = []
+    for i, edges in enumerate(iter_mapped_edges(path, node_index, chunk_size)):
+        if symmetric:
+            edges = np.concatenate((edges, edges[:, ::-1]))
+        keys = edges[:, 0].astype(np.int64) * N + edges[:, 1] # 以 源节点*N+目标节点 编码, 排序后即按CSR的顺序
+        keys = np.unique(keys) if dedupe else np.sort(keys)
+        counts += np.bincount(keys // N, minlength=N)
+        run = os.path.join(run_dir, 'run_%06d.npy' % i)
+        np.save(run, keys)
+        runs.append(run)
+    return runs, counts
+
+
+def _merge_runs(runs, counts, out_dir, chunk_size, dedupe):
+    """第二遍: 按节点编号区间归并所有有序段, 每个区间的边数不超过chunk_size(单个节点超过时除外)
+    堆中是 (段中下一个未读的键, 段号), 每个区间只取出下一个键落在区间内的段, 总的查找次数与边数成正比而不是区间数*段数
+    """
+    N = len(counts)
+    runs = [np.load(run, mmap_mode='r') for run in runs]
+    cursors = [0] * len(runs)
+    heap = [(int(run[0]), i) for i, run in enumerate(runs) if len(run)]
+    heapq.heapify(heap)
+    degree = np.zeros(N, dtype=np.int64)
+    raw = os.path.join(out_dir, 'indices.raw')
+    total = 0
+    cum = np.cumsum(counts)
+    with open(raw, 'wb') as f:
+        start = 0
+        while heap:
+            done = cum[start - 1] if start > 0 else 0
+            end = max(int(np.searchsorted(cum, done + chunk_size, side='right')), start + 1)
+            hi = end * N
+            keys = [np.zeros(0, dtype=np.int64)]
+            while heap and heap[0][0] < hi:
+                _, i = heapq.heappop(heap)
+                run, lo = runs[i], cursors[i]
+                cut = lo + int(np.searchsorted(run[lo:], hi))
+                keys.append(run[lo:cut])
+                cursors[i] = cut
+                if cut < len(run):
+                    heapq.heappush(heap, (int(run[cut]), i))
+            keys = np.concatenate(keys)
+            keys = np.unique(keys) if dedupe else np.sort(keys)
+            degree[start:end] = np.bincount(keys // N - start, minlength=end - start)
+            f.write((keys % N).astype(np.int64).tobytes())
+            total += len(keys)
+            start = end
+
+    indptr = np.zeros(N + 1, dtype=np.int64)
+    np.cumsum(degree, out=indptr[1:])
+    np.save(os.path.join(out_dir, 'indptr.npy'), indptr)
+    src = np.memmap(raw, dtype=np.int64, mode='r', shape=(total,)) if total else np.zeros(0, dtype=np.int64)
+    indices = np.lib.format.open_memmap(os.path.join(out_dir, 'indices.npy'), mode='w+', dtype=np.int64, shape=(total,))
+    for i in range(0, total, chunk_size): # 分块拷贝成.npy格式
+        indices[i:i + chunk_size] = src[i:i + chunk_size]
+    indices.flush()
+    del src, indices
+    os.remove(raw)
+
+
+def edge_file_to_csr(path, node_index, out_dir, chunk_size=DEFAULT_CHUNK_SIZE, symmetric=False, dedupe=True):
+    """把边文件转换为CSR文件
+    Params:
+        path: 边文件, 每行一对节点名称
+        node_index: NodeIndex, 节点名称到编号的映射
+        out_dir: 输出目录, 生成indptr.npy和indices.npy
+        chunk_size: 每块的行数, 决定内存峰值
+        symmetric: 为True时每条边同时加入反向边
+        dedupe: 为True时去掉重复的边
+    Return:
+        (indptr, indices) 只读的内存映射数组
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=out_dir) as run_dir:
+        runs, counts = _spill_runs(path, node_index, run_dir, chunk_size, symmetric, dedupe)
+        _merge_runs(runs, counts, out_dir, chunk_size, dedupe)
+    return load_csr(out_dir)
+
+
+def load_csr(out_dir):
+    """内存映射读取edge_file_to_csr生成的CSR文件"""
+    return (np.load(os.path.join(out_dir, 'indptr.npy'), mmap_mode='r'),
+            np.load(os.path.join(out_dir, 'indices.npy'), mmap_mode='r'))
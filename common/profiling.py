@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+训练循环中按阶段计时的轻量级性能分析
+
+训练代码用 `with profiler.phase('sample'):` 把采样、收集特征、聚合、前向、损失、反向、参数更新、评估等阶段包起来,
+用 `profiler.count('edges', n)` 记录计数。关闭时phase()直接返回一个共享的空上下文, 几乎没有开销。
+阶段可以嵌套, 每个阶段的时间包含其中嵌套的阶段。
+
+不修改代码即可在运行中打开:
+    GNN_PROFILE=profile.json python GCN.py
+进程退出时写出profile.json(各阶段的汇总)和profile.trace.json(Chrome trace, 在chrome://tracing或Perfetto中查看)。
+GNN_PROFILE_TORCH=1 时同时运行torch.profiler, 每个阶段也作为record_function出现在torch的trace中, 写到profile.torch.json。
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+_NULL = nullcontext() # 关闭时所有阶段共享的空上下文
+
+
+class Profiler(object):
+    """
+    按名称累计每个阶段的次数和时间, 以及计数器
+    Params:
+        enabled: 为False时所有调用都是空操作
+        torch_profiler: 为True时start()同时启动torch.profiler
+        max_events: Chrome trace中最多保留的事件数, 超过后只累计汇总
+    """
+
+    def __init__(self, enabled=False, torch_profiler=False, max_events=1000000):
+        self.enabled = enabled
+        self.torch_profiler = torch_profiler
+        self.max_events = max_events
+        self._torch_prof = None
+        self._torch_running = False
+        self.reset()
+
+    def reset(self):
+        self.totals = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.maxima = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.events = []
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """打开计时, torch_profiler=True时同时启动torch.profiler"""
+        self.enabled = True
+        if self.torch_profiler and self._torch_prof is None:
+            self._torch_prof = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU])
+            self._torch_prof.__enter__()
+            self._torch_running = True
+
+    def stop(self):
+        self.enabled = False
+        if self._torch_running:
+            self._torch_prof.__exit__(None, None, None)
+            self._torch_running = False
+
+    def phase(self, name):
+        """返回为阶段name计时的上下文"""
+        if not self.enabled:
+            return _NULL
+        return self._phase(name)
+
+    @contextmanager
+    def _phase(self, name):
+        record = torch.profiler.record_function(name) if self._torch_running else None
+        if record is not None:
+            record.__enter__()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            if record is not None:
+                record.__exit__(None, None, None)
+            self._record(name, start, end)
+
+    def _record(self, name, start, end):
+        elapsed = end - start
+        with self._lock:
+            self.totals[name] += elapsed
+            self.calls[name] += 1
+            self.maxima[name] = max(self.maxima[name], elapsed)
+            if len(self.events) < self.max_events:
+                self.events.append((name, start, elapsed, threading.get_ident()))
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] += int(value)
+
+    def summary(self):
+        """Return: {'phases': {阶段: {calls, total, mean, max}}, 'counters': {...}}, 时间单位为秒"""
+        phases = {}
+        for name in sorted(self.totals, key=self.totals.get, reverse=True):
+            phases[name] = {'calls': self.calls[name], 'total': self.totals[name],
+                            'mean': self.totals[name] / self.calls[name], 'max': self.maxima[name]}
+        return {'phases': phases, 'counters': dict(self.counters)}
+
+    def report(self):
+        """返回按总时间排序的文本表格"""
+        lines = ['{:<16}{:>10}{:>12}{:>12}{:>12}'.format('phase', 'calls', 'total(s)', 'mean(ms)', 'max(ms)')]
+        for name, s in self.summary()['phases'].items():
+            lines.append('{:<16}{:>10}{:>12.4f}{:>12.3f}{:>12.3f}'.format(name, s['calls'], s['total'], s['mean'] * 1000, s['max'] * 1000))
+        for name, value in sorted(self.counters.items()):
+            lines.append('{:<16}{:>10}'.format(name, value))
+        return '\n'.join(lines)
+
+    def export_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def export_chrome_trace(self, path):
+        """以Chrome trace的complete事件(ph='X')写出每一次阶段, 时间单位为微秒"""
+        pid = os.getpid()
+        events = [{'name': name, 'ph': 'X', 'ts': (start - self._origin) * 1e6, 'dur': elapsed * 1e6,
+                   'pid': pid, 'tid': tid} for name, start, elapsed, tid in self.events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def export(self, path):
+        """写出 path(汇总), path去掉.json加上.trace.json(Chrome trace), 以及torch.profiler的trace(如果启用)"""
+        base = path[:-5] if path.endswith('.json') else path
+        self.export_json(path)
+        self.export_chrome_trace(base + '.trace.json')
+        if self._torch_prof is not None:
+            self.stop()
+            self._torch_prof.export_chrome_trace(base + '.torch.json')
+
+
+profiler = Profiler() # 各个训练脚本共享的全局profiler
+
+
+def enable_profiling(path, torch_profiler=False):
+    """打开全局profiler, 进程退出时把结果写到path"""
+    profiler.torch_profiler = torch_profiler
+    profiler.start()
+    atexit.register(profiler.export, path)
+    return profiler
+
+
+if os.environ.get('GNN_PROFILE'):
+    enable_profiling(os.environ['GNN_PROFILE'], torch_profiler=os.environ.get('GNN_PROFILE_TORCH', '0') not in ('', '0'))
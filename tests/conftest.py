@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+测试共用的fixture: 按路径导入三个模型脚本, 在临时目录中生成cora格式的小型合成图
+"""
+
+import importlib.util
+import os
+import sys
+
+import numpy as np
+import pytest
+import torch
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+SCRIPTS = {
+    'gcn': os.path.join(ROOT, 'GCN', 'GCN.py'),
+    'gat': os.path.join(ROOT, 'GAT', 'GAT.py'),
+    'graphsage': os.path.join(ROOT, 'GraphSage-Pytorch-Inductive', 'Graphsage-Pytorch-Inductive-Central.py'),
+    'server': os.path.join(ROOT, 'GraphSage-Pytorch-Inductive', 'Graphsage-Pytorch-Inductive-Server.py'),
+}
+
+
+def import_script(model):
+    """按文件路径导入脚本, GraphSage的文件名含有'-', 不能直接import"""
+    name = 'script_' + model
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(name, SCRIPTS[model])
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    return sys.modules[name]
+
+
+@pytest.fixture(scope='session')
+def gcn():
+    return import_script('gcn')
+
+
+@pytest.fixture(scope='session')
+def gat():
+    return import_script('gat')
+
+
+@pytest.fixture(scope='session')
+def sage():
+    return import_script('graphsage')
+
+
+@pytest.fixture(scope='session')
+def server():
+    return import_script('server')
+
+
+@pytest.fixture(scope='session')
+def cora_files(tmp_path_factory):
+    """300个节点的合成图, 每个节点至少有环上的两个邻居; 缓存写在同一个临时目录中"""
+    from benchmarks.benchmark import make_synthetic
+    out_dir = tmp_path_factory.mktemp('cora')
+    name = make_synthetic(str(out_dir), 300, 6, feat_dim=32, num_classes=4, feat_density=0.2, seed=0)
+    return {'cora_content': str(out_dir / (name + '.content')), 'cora_cite': str(out_dir / (name + '.cites'))}
+
+
+@pytest.fixture
+def datacenter(sage, cora_files):
+    np.random.seed(824)
+    torch.manual_seed(0)
+    dc = sage.DataCenter(cora_files)
+    dc.load_Dataset()
+    return dc
+
+
+def random_adj(num_nodes, num_edges, seed=0):
+    """对称、带自环的随机稠密邻接矩阵"""
+    rng = np.random.RandomState(seed)
+    adj = np.zeros((num_nodes, num_nodes), dtype=np.float32)
+    rows, cols = rng.randint(num_nodes, size=num_edges), rng.randint(num_nodes, size=num_edges)
+    adj[rows, cols] = adj[cols, rows] = 1
+    np.fill_diagonal(adj, 1)
+    return torch.from_numpy(adj)
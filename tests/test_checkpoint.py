@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""CheckpointManager只保留指标最好的top_k个checkpoint, 并能从中恢复参数; close()结束后台线程; 多次训练分类器的checkpoint文件名不冲突"""
+
+import io
+import os
+import threading
+
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+
+from common import checkpoint
+from common.checkpoint import CheckpointManager
+
+
+def checkpoint_files(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith('.pt'))
+
+
+def test_keeps_top_k(tmp_path):
+    manager = CheckpointManager(str(tmp_path), top_k=3, mode='max')
+    model = nn.Linear(4, 2)
+    for epoch, metric in enumerate([0.5, 0.7, 0.6, 0.4, 0.9, 0.8]):
+        manager.save({'model': model}, metric, 'ep{}.pt'.format(epoch), epoch=epoch)
+    manager.wait()
+    assert [e['metric'] for e in manager.entries] == [0.9, 0.8, 0.7]
+    assert checkpoint_files(str(tmp_path)) == ['ep1.pt', 'ep4.pt', 'ep5.pt']
+    assert manager.best() == os.path.join(str(tmp_path), 'ep4.pt')
+    assert not manager.save({'model': model}, 0.1, 'ep6.pt')                # 进不了top_k时不保存
+
+
+def test_min_mode_and_index_reload(tmp_path):
+    manager = CheckpointManager(str(tmp_path), top_k=2, mode='min')
+    model = nn.Linear(4, 2)
+    for epoch, loss in enumerate([3., 1., 2., 4.]):
+        manager.save({'model': model}, loss, 'ep{}.pt'.format(epoch))
+    manager.wait()
+    assert checkpoint_files(str(tmp_path)) == ['ep1.pt', 'ep2.pt']
+
+    reloaded = CheckpointManager(str(tmp_path), top_k=2, mode='min')        # 重启后从checkpoints.json继续管理
+    assert [e['file'] for e in reloaded.entries] == ['ep1.pt', 'ep2.pt']
+    assert not reloaded.is_better(2.5)
+    assert reloaded.is_better(0.5)
+
+
+def test_restore_best(tmp_path):
+    manager = CheckpointManager(str(tmp_path), top_k=2)
+    model = nn.Linear(4, 2)
+    best = {k: v.clone() for k, v in model.state_dict().items()}
+    manager.save({'model': model}, 0.9, 'best.pt', epoch=3)
+    with torch.no_grad():
+        model.weight.add_(1.)                                               # save时已经复制了参数, 之后的修改不影响checkpoint
+    manager.save({'model': model}, 0.5, 'worse.pt', epoch=4)
+
+    restored = nn.Linear(4, 2)
+    state = manager.restore({'model': restored})
+    assert state == {'metric': 0.9, 'info': {'epoch': 3}}
+    assert all(torch.equal(restored.state_dict()[k], v) for k, v in best.items())
+
+
+def test_close_flushes_and_stops_thread(tmp_path):
+    threads = threading.active_count()
+    model = nn.Linear(4, 2)
+    for i in range(5):
+        manager = CheckpointManager(str(tmp_path / str(i)))
+        manager.save({'model': model}, 0.5, 'ep0.pt')
+        assert manager in checkpoint._open_managers
+        manager.close()
+        manager.close()                                                     # 可以重复调用
+        assert manager.closed and manager not in checkpoint._open_managers
+        assert checkpoint_files(str(tmp_path / str(i))) == ['ep0.pt']
+        with pytest.raises(RuntimeError):
+            manager.save({'model': model}, 0.9, 'ep1.pt')
+    assert threading.active_count() == threads
+
+
+def test_exit_hook_flushes_open_managers(tmp_path):
+    with CheckpointManager(str(tmp_path / 'closed')) as closed:
+        pass
+    manager = CheckpointManager(str(tmp_path / 'open'))
+    manager.save({'model': nn.Linear(4, 2)}, 0.5, 'ep0.pt')
+    checkpoint._flush_all()                                                 # 进程退出时由atexit调用
+    assert closed.closed and manager.closed
+    assert checkpoint_files(str(tmp_path / 'open')) == ['ep0.pt']
+
+
+def test_train_classification_stages_do_not_collide(sage, datacenter, tmp_path):
+    """分类器的epoch每次从0开始, 文件名中的stage区分各次调用"""
+    torch.manual_seed(0)
+    features = torch.from_numpy(np.array(datacenter.cora_feats))
+    graphSage = sage.GraphSage(2, features.size(1), 16, features, datacenter.cora_adj_lists, 'cpu', gcn=True)
+    classification = sage.Classification(16, 4)
+    for explicit in ((1, 3), (None, None)):                                # 默认为调用的次数
+        directory = str(tmp_path / str(explicit[0]))
+        with CheckpointManager(directory, top_k=100) as manager:
+            for stage in explicit:
+                sage.train_classification(io.StringIO(), datacenter, graphSage, classification, 'cora', 'cpu', 0, 'debug',
+                                          epochs=3, checkpoints=manager, stage=stage)
+        stages = set(e['stage'] for e in manager.entries)
+        assert len(checkpoint_files(directory)) == len(manager.entries)
+        assert len(stages) == 2 and (explicit[0] is None or stages == set(explicit))
+        assert all(e['file'].startswith('model_best_debug_s{}_ep{}_'.format(e['stage'], e['epoch'])) for e in manager.entries)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""DataCenter.load_Dataset与原来逐行解析、用dict of set建邻接表的实现等价; 邻接表的缓存随训练集的划分变化"""
+
+import os
+from collections import defaultdict
+
+import numpy as np
+import pytest
+
+
+def reference_load(sage, file_paths, seed):
+    """原来的load_Dataset: 逐行读取, 邻接表为{节点: 邻居集合}"""
+    feat_list, label_list, node_map, label_map = [], [], {}, {}
+    with open(file_paths['cora_content']) as f1:
+        for i, each_sample in enumerate(f1.readlines()):
+            sample_clean = each_sample.strip().split()
+            feat_list.append(sample_clean[1:-1])
+            node_map[sample_clean[0]] = i
+            label_map.setdefault(sample_clean[-1], len(label_map))
+            label_list.append(label_map[sample_clean[-1]])
+    feat_list = np.asarray(feat_list, dtype=np.float64)
+    np.random.seed(seed)
+    train_index, test_index, val_index = sage.DataCenter(file_paths)._split_data(len(feat_list))
+
+    adj_lists = defaultdict(set)
+    with open(file_paths['cora_cite']) as f2:
+        for each_pair in f2.readlines():
+            u, v = (node_map[name] for name in each_pair.strip().split())
+            adj_lists[u], adj_lists[v]
+            if (u in train_index and v in train_index) or u not in train_index:
+                adj_lists[u].add(v)
+                adj_lists[v].add(u)
+    for demo in list(adj_lists):
+        if demo in train_index and len(adj_lists[demo]) == 0:
+            del adj_lists[demo]
+            train_index = np.delete(train_index, np.where(train_index == demo)[0])
+    return {'train': train_index, 'val': val_index, 'test': test_index, 'feats': feat_list,
+            'labels': np.asarray(label_list, dtype=np.int64), 'adj_lists': adj_lists}
+
+
+def assert_matches(dc, expected):
+    for split in ('train', 'val', 'test'):
+        assert np.array_equal(getattr(dc, 'cora_' + split), expected[split])
+    assert np.allclose(dc.cora_feats, expected['feats'])
+    assert np.array_equal(dc.cora_labels, expected['labels'])
+    graph = dc.cora_adj_lists
+    assert len(graph) == len(expected['feats'])
+    for node in range(len(graph)):
+        assert set(graph.neighbours(node).tolist()) == expected['adj_lists'].get(node, set())
+
+
+@pytest.mark.parametrize('use_cache', [False, True])
+def test_load_matches_reference(sage, cora_files, tmp_path, monkeypatch, use_cache):
+    monkeypatch.setenv('GRAPH_CACHE_DIR', str(tmp_path))
+    for _ in range(2):                                                      # 第二次从缓存读取
+        np.random.seed(5)
+        dc = sage.DataCenter(cora_files)
+        dc.load_Dataset(use_cache=use_cache)
+        assert_matches(dc, reference_load(sage, cora_files, 5))
+    assert len(os.listdir(str(tmp_path))) == (2 if use_cache else 0)
+
+
+def test_graph_cache_follows_split(sage, cora_files, tmp_path, monkeypatch):
+    """不同的随机种子得到不同的划分, 邻接表不能复用前一个划分的缓存"""
+    monkeypatch.setenv('GRAPH_CACHE_DIR', str(tmp_path))
+    graphs = []
+    for seed in (1, 2, 1):
+        np.random.seed(seed)
+        dc = sage.DataCenter(cora_files)
+        dc.load_Dataset()
+        assert_matches(dc, reference_load(sage, cora_files, seed))
+        graphs.append(dc.cora_adj_lists)
+    assert len(os.listdir(str(tmp_path))) == 3                               # 解析结果一份, 两个划分的邻接表各一份
+    assert not np.array_equal(graphs[0].indices, graphs[1].indices)
+    assert np.array_equal(graphs[0].indptr, graphs[2].indptr) and np.array_equal(graphs[0].indices, graphs[2].indices)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""EvaluationScheduler的验证节奏、早停和恢复最好的参数"""
+
+import torch
+import torch.nn as nn
+
+from common.evaluation import EvaluationScheduler
+
+
+def run(scheduler, losses, epochs):
+    evaluated = []
+    for epoch in range(epochs):
+        result = scheduler.step(epoch, (losses[epoch], 0.))
+        if result is not None:
+            evaluated.append(epoch)
+        if scheduler.should_stop:
+            break
+    return evaluated, epoch
+
+
+def test_every_k_epochs():
+    scheduler = EvaluationScheduler(nn.Linear(2, 2), None, every=3)
+    evaluated, _ = run(scheduler, [1.] * 10, 10)
+    assert evaluated == [2, 5, 8]
+
+
+def test_adaptive_interval_and_patience():
+    scheduler = EvaluationScheduler(nn.Linear(2, 2), None, adaptive=True, max_every=4, patience=6)
+    losses = [5., 4., 3.] + [3.] * 20
+    evaluated, stopped = run(scheduler, losses, len(losses))
+    assert evaluated == [0, 1, 2, 3, 5]                                    # 没有改进时间隔加倍: 1, 2, 4
+    assert stopped == 8 and scheduler.best_epoch == 2                       # 第9个epoch之前已经超过patience
+    assert scheduler.interval == 4
+
+
+def test_runs_in_inference_mode_and_restores_best():
+    model = nn.Linear(2, 2)
+    calls = []
+
+    def evaluate():
+        calls.append((torch.is_inference_mode_enabled(), model.training))
+        return -float(model.bias.sum()), 0.
+
+    scheduler = EvaluationScheduler(model, evaluate)
+    with torch.no_grad():
+        model.bias.fill_(1.)
+    scheduler.step(0)
+    best = model.state_dict()['bias'].clone()
+    with torch.no_grad():
+        model.bias.fill_(-1.)
+    scheduler.step(1)
+    assert calls == [(True, False), (True, False)] and model.training
+    assert scheduler.restore() == 0
+    assert torch.equal(model.bias, best)
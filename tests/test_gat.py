@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""GAT的各种实现互相等价: 融合多头与逐头, 边列表与稠密矩阵, 稀疏特征与稠密特征;
+邻居采样的二部图块, 全部邻居时逐块前向与全图前向相同
+"""
+
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from conftest import random_adj
+
+
+def per_head_layers(fused, layer_class):
+    """把融合层的参数拆成nheads个单头层"""
+    w = fused.w.data.view(fused.input_feature, fused.nheads, fused.output_feature)
+    heads = []
+    for i in range(fused.nheads):
+        head = layer_class(fused.input_feature, fused.output_feature, dropout=0., alpha=fused.alpha, concat=fused.concat)
+        head.w.data.copy_(w[:, i, :])
+        head.a.data.copy_(fused.a.data[i].unsqueeze(1))
+        heads.append(head.eval())
+    return heads
+
+
+def combine(outputs, concat):
+    return torch.cat(outputs, dim=1) if concat else torch.stack(outputs).mean(0)
+
+
+def test_sparse_layer_matches_dense_layer(gat):
+    torch.manual_seed(0)
+    adj = random_adj(40, 120)
+    x = torch.rand(40, 12)
+    dense = gat.GATLayer(12, 5, dropout=0., alpha=0.2).eval()
+    sparse = gat.SpGATLayer(12, 5, dropout=0., alpha=0.2).eval()
+    sparse.load_state_dict(dense.state_dict())
+    assert torch.allclose(dense(x, adj), sparse(x, adj.nonzero().t()), atol=1e-6)
+
+
+@pytest.mark.parametrize('concat', [True, False])
+def test_fused_dense_matches_per_head(gat, concat):
+    torch.manual_seed(0)
+    adj = random_adj(40, 120)
+    x = torch.rand(40, 12)
+    fused = gat.MultiHeadGATLayer(12, 5, 4, dropout=0., alpha=0.2, concat=concat).eval()
+    expected = combine([head(x, adj) for head in per_head_layers(fused, gat.GATLayer)], concat)
+    assert torch.allclose(fused(x, adj), expected, atol=1e-6)
+
+
+def test_fused_dense_gradients_match_per_head(gat):
+    torch.manual_seed(0)
+    adj = random_adj(40, 120)
+    x = torch.rand(40, 12)
+    fused = gat.MultiHeadGATLayer(12, 5, 4, dropout=0., alpha=0.2).eval()
+    heads = per_head_layers(fused, gat.GATLayer)
+    fused(x, adj).pow(2).sum().backward()
+    combine([head(x, adj) for head in heads], True).pow(2).sum().backward()
+    w_grad = torch.stack([head.w.grad for head in heads], 1).reshape(fused.w.shape)
+    assert torch.allclose(fused.w.grad, w_grad, atol=1e-5)
+    assert torch.allclose(fused.a.grad, torch.stack([head.a.grad.squeeze(1) for head in heads]), atol=1e-5)
+
+
+@pytest.mark.parametrize('concat', [True, False])
+def test_fused_sparse_matches_per_head(gat, concat):
+    torch.manual_seed(0)
+    adj = random_adj(40, 120)
+    edge_index = adj.nonzero().t()
+    x = torch.rand(40, 12)
+    fused = gat.MultiHeadGATLayer(12, 5, 4, dropout=0., alpha=0.2, concat=concat, sparse=True).eval()
+    expected = combine([head(x, edge_index) for head in per_head_layers(fused, gat.SpGATLayer)], concat)
+    assert torch.allclose(fused(x, edge_index), expected, atol=1e-6)
+
+
+def test_sparse_model_matches_dense(gat):
+    torch.manual_seed(0)
+    adj = random_adj(40, 120)
+    x = torch.rand(40, 12)
+    dense = gat.GAT(12, 6, 3, dropout=0.6, alpha=0.2, nheads=4).eval()
+    sparse = gat.GAT(12, 6, 3, dropout=0.6, alpha=0.2, nheads=4, sparse=True).eval()
+    sparse.load_state_dict(dense.state_dict())
+    assert torch.allclose(dense(x, adj), sparse(x, adj.nonzero().t()), atol=1e-5)
+
+
+def test_sparse_features_match_dense(gat):
+    torch.manual_seed(0)
+    adj = random_adj(40, 120)
+    x = torch.rand(40, 12) * (torch.rand(40, 12) < 0.3)
+    edge_index = adj.nonzero().t()
+    for model, graph in ((gat.GAT(12, 6, 3, dropout=0.6, alpha=0.2, nheads=4, sparse=True).eval(), edge_index),
+                         (gat.GAT(12, 6, 3, dropout=0.6, alpha=0.2, nheads=4).eval(), adj)):
+        assert torch.allclose(model(x, graph), model(x.to_sparse(), graph), atol=1e-5)
+
+
+def test_load_data_sparse_features(gat, cora_files):
+    path, name = os.path.split(cora_files['cora_content'])
+    dataset = os.path.splitext(name)[0]
+    _, dense, _, _, _, _ = gat.load_data(path + '/', dataset, use_cache=False)
+    _, sparse, _, _, _, _ = gat.load_data(path + '/', dataset, use_cache=False, sparse_features=True)
+    assert sparse.is_sparse and torch.allclose(sparse.to_dense(), dense)
+
+
+@pytest.mark.parametrize('fanouts', [[3, 2], [1, 1], [100, 100]])
+def test_neighbour_sampler_blocks(gat, fanouts):
+    np.random.seed(0)
+    adj = random_adj(60, 150).numpy()
+    sampler = gat.NeighbourSampler(torch.from_numpy(adj).nonzero().t(), 60, fanouts)
+    batch = np.random.permutation(60)[:8]
+    blocks, input_nodes = sampler.sample(batch)
+    input_nodes = input_nodes.numpy()
+    assert len(np.unique(input_nodes)) == len(input_nodes)
+    assert np.array_equal(input_nodes[:len(batch)], batch)
+    assert blocks[-1][1] == len(batch)
+
+    num_src = len(input_nodes)
+    for (edge_index, num_dst), fanout in zip(blocks, fanouts):
+        row, col = edge_index.numpy()
+        assert num_dst <= num_src and row.max() < num_dst and col.max() < num_src
+        for dst in range(num_dst):
+            src = col[row == dst]
+            neighs = input_nodes[src[src != dst]]
+            node = input_nodes[dst]
+            assert (src == dst).sum() == 1                                  # 每个目标节点恰好一个自环
+            assert len(np.unique(neighs)) == len(neighs) == min(fanout, int(adj[node].sum()) - 1)
+            assert adj[node, neighs].all() and (neighs != node).all()
+        num_src = num_dst
+
+
+def test_full_fanout_blocks_match_full_graph(gat):
+    np.random.seed(0)
+    torch.manual_seed(0)
+    adj = random_adj(60, 150)
+    edge_index = adj.nonzero().t()
+    x = torch.rand(60, 12)
+    model = gat.GAT(12, 6, 3, dropout=0.6, alpha=0.2, nheads=4, sparse=True).eval()
+    batch = np.random.permutation(60)[:10]
+    blocks, input_nodes = gat.NeighbourSampler(edge_index, 60, [60, 60]).sample(batch)
+    with torch.no_grad():
+        assert torch.allclose(model.forward_blocks(x[input_nodes], blocks), model(x, edge_index)[batch], atol=1e-5)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""GCN的数据加载; 预先计算adj·x的GCN与逐次传播的GCN等价, 缓存的键由输入决定; 稀疏特征与稠密特征等价;
+Cluster-GCN的划分覆盖每个节点恰好一次, 子图按导出子图重新归一化
+"""
+
+import os
+
+import numpy as np
+import pytest
+import scipy.sparse as sp
+import torch
+
+from conftest import random_adj
+
+
+def normalized_adj(gcn, num_nodes, num_edges, seed=0):
+    adj = sp.csr_matrix(random_adj(num_nodes, num_edges, seed).numpy())
+    return gcn.sparse_mx_to_torch_sparse_tensor(gcn.normalize(adj))
+
+
+def test_load_data_keeps_duplicate_edges_as_weights(gcn, tmp_path):
+    """cites中重复的边与原来的coo_matrix一样累加为权重, 反向的边按最大值对称化"""
+    (tmp_path / 'toy.content').write_text('a\t1\t0\tx\nb\t0\t1\ty\nc\t1\t1\tx\n')
+    (tmp_path / 'toy.cites').write_text('a\tb\na\tb\nb\ta\nb\tc\n')
+    adj, _, _, _, _, _ = gcn.load_data(str(tmp_path) + '/', 'toy', use_cache=False)
+    edges = np.array([[0, 1], [0, 1], [1, 0], [1, 2]])
+    expected = sp.coo_matrix((np.ones(len(edges)), (edges[:, 0], edges[:, 1])), shape=(3, 3), dtype=np.float32)
+    expected = expected + expected.T.multiply(expected.T > expected) - expected.multiply(expected.T > expected)
+    expected = gcn.normalize(expected + sp.eye(3))
+    assert np.allclose(adj.to_dense().numpy(), expected.toarray(), atol=1e-6)
+
+
+def test_precompute_matches_propagation(gcn):
+    torch.manual_seed(0)
+    adj = normalized_adj(gcn, 60, 200)
+    x = torch.rand(60, 16)
+    model = gcn.GCN(16, 8, 3, dropout=0.5).eval()
+    precomputed = gcn.GCN(16, 8, 3, dropout=0.5, precompute=True).eval()
+    precomputed.load_state_dict(model.state_dict())
+    features = gcn.precompute_features(adj, x, k=1)
+    assert torch.allclose(model(adj, x), precomputed(adj, features), atol=1e-6)
+
+
+def test_precompute_powers(gcn):
+    adj = normalized_adj(gcn, 60, 200)
+    x = torch.rand(60, 16)
+    dense = adj.to_dense()
+    expected = dense @ (dense @ x)
+    assert torch.allclose(gcn.precompute_features(adj, x, k=2), expected, atol=1e-6)
+
+
+def test_precompute_cache_keyed_by_inputs(gcn, tmp_path, monkeypatch):
+    """不同的图、特征或k不能读到其他输入的缓存; 相同的输入只计算一次"""
+    monkeypatch.chdir(tmp_path)                                             # 没有./cora也可以使用缓存
+    calls = []
+    propagate = gcn.propagate_features
+    monkeypatch.setattr(gcn, 'propagate_features', lambda *args: calls.append(args) or propagate(*args))
+    x = torch.rand(60, 16)
+    inputs = [(normalized_adj(gcn, 60, 200, seed), features, k)
+              for seed in (0, 1) for features in (x, x + 1) for k in (1, 2)]
+    for _ in range(2):
+        for adj, features, k in inputs:
+            expected = propagate(adj, features, k)
+            assert torch.allclose(gcn.precompute_features(adj, features, k, use_cache=True), expected, atol=1e-6)
+    assert len(calls) == len(inputs)
+    assert len(os.listdir(str(tmp_path / '.npcache'))) == len(inputs)
+
+
+def test_precompute_explicit_key(gcn, tmp_path):
+    adj, x = normalized_adj(gcn, 60, 200), torch.rand(60, 16)
+    first = gcn.precompute_features(adj, x, use_cache=True, key='toy', cache_dir=str(tmp_path))
+    again = gcn.precompute_features(adj, x + 1, use_cache=True, key='toy', cache_dir=str(tmp_path))  # 调用者保证相同的key对应相同的输入
+    assert torch.equal(first, again)
+    other = gcn.precompute_features(adj, x + 1, use_cache=True, key='toy+1', cache_dir=str(tmp_path))
+    assert torch.allclose(other, torch.spmm(adj, x + 1), atol=1e-6)
+
+
+def test_precompute_no_cache_by_default(gcn, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    gcn.precompute_features(normalized_adj(gcn, 60, 200), torch.rand(60, 16))
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_sparse_features_match_dense(gcn):
+    torch.manual_seed(0)
+    adj = normalized_adj(gcn, 60, 200)
+    x = torch.rand(60, 16) * (torch.rand(60, 16) < 0.2)
+    model = gcn.GCN(16, 8, 3, dropout=0.5).eval()
+    assert torch.allclose(model(adj, x), model(adj, x.to_sparse()), atol=1e-6)
+    assert torch.allclose(gcn.precompute_features(adj, x, k=2), gcn.precompute_features(adj, x.to_sparse(), k=2), atol=1e-6)
+
+    model.train()
+    grads = []
+    for features in (x, x.to_sparse()):
+        model.zero_grad()
+        torch.manual_seed(1)
+        model(adj, features).sum().backward()
+        grads.append(model.gcn1.weights.grad.clone())
+    assert torch.allclose(grads[0], grads[1], atol=1e-5)
+
+
+def test_load_data_sparse_features(gcn, cora_files):
+    path, name = os.path.split(cora_files['cora_content'])
+    dataset = os.path.splitext(name)[0]
+    _, dense, _, _, _, _ = gcn.load_data(path + '/', dataset, use_cache=False)
+    _, sparse, _, _, _, _ = gcn.load_data(path + '/', dataset, use_cache=False, sparse_features=True)
+    assert sparse.is_sparse and torch.allclose(sparse.to_dense(), dense)
+
+
+def disconnected_adj(gcn):
+    """两个随机图加上10个孤立节点"""
+    adj = sp.block_diag((random_adj(50, 80, 0).numpy(), random_adj(30, 40, 1).numpy(), sp.eye(10))).tocsr()
+    return gcn.sparse_mx_to_torch_sparse_tensor(gcn.normalize(adj))
+
+
+@pytest.mark.parametrize('num_parts', [1, 3, 7, 90])
+def test_partition_covers_every_node_once(gcn, num_parts):
+    adj = disconnected_adj(gcn)
+    loader = gcn.ClusterLoader(adj, num_parts, seed=0)
+    parts = gcn.partition_graph(loader.pattern, num_parts, seed=0)
+    assert ((parts >= 0) & (parts < num_parts)).all()
+    assert np.bincount(parts).max() <= -(-90 // num_parts)
+    assert np.array_equal(np.sort(np.concatenate(loader.clusters)), np.arange(90))
+    for clusters_per_batch in (1, 2):
+        loader.clusters_per_batch = clusters_per_batch
+        batches = [nodes.numpy() for nodes, _ in loader]
+        assert len(batches) == len(loader)
+        assert np.array_equal(np.sort(np.concatenate(batches)), np.arange(90))
+
+
+def test_cluster_sub_adjacency_is_row_normalised_slice(gcn):
+    adj = disconnected_adj(gcn)
+    pattern = (adj.to_dense() > 0).float()
+    loader = gcn.ClusterLoader(adj, 4, clusters_per_batch=2, seed=0)
+    for nodes, sub_adj in loader:
+        block = pattern[nodes][:, nodes]
+        assert torch.allclose(sub_adj.to_dense(), block / block.sum(1, keepdim=True), atol=1e-6)
+
+    whole = gcn.ClusterLoader(adj, 1, seed=0)                                # 只有一个簇时就是整个图
+    (nodes, sub_adj), = list(whole)
+    assert torch.allclose(sub_adj.to_dense(), adj.to_dense(), atol=1e-6)
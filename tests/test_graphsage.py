@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""GraphSage的邻居表, 全图推理、增量更新图与逐批前向/全部重新计算等价, 后台采样的结果与worker数无关"""
+
+import numpy as np
+import pytest
+import torch
+
+
+def make_model(sage, dc, gcn=True, agg_func='MEAN', num_sample=10):
+    torch.manual_seed(0)
+    features = torch.from_numpy(np.array(dc.cora_feats))
+    return sage.GraphSage(2, features.size(1), 16, features, dc.cora_adj_lists, 'cpu', gcn=gcn, agg_func=agg_func,
+                          num_sample=num_sample)
+
+
+@pytest.mark.parametrize('gcn, agg_func', [(True, 'MEAN'), (False, 'MEAN'), (False, 'MAX')])
+def test_inference_matches_forward(sage, datacenter, gcn, agg_func):
+    model = make_model(sage, datacenter, gcn, agg_func)
+    nodes = np.arange(len(datacenter.cora_adj_lists))
+    with torch.no_grad():
+        expected = torch.cat([model(nodes[start:start + 64]) for start in range(0, len(nodes), 64)])
+    assert torch.allclose(model.inference(batch_size=50), expected, atol=1e-6)
+
+
+def test_centrality_ties_prefer_higher_ids(sage, datacenter):
+    """与原来的实现相同: 按中心性从低到高稳定排序后从末尾取k个, 中心性相同时编号大的在前"""
+    graph = datacenter.cora_adj_lists
+    degree = graph.degree()
+    table = sage.CentralityTable(graph, k=3)
+    for node in range(len(graph)):
+        neighs = graph.neighbours(node).tolist()
+        centrality = {n: degree[n] / degree[graph.neighbours(n)].sum() for n in neighs}
+        expected = sorted(neighs, key=lambda n: (centrality[n], n))[::-1][:3]
+        assert table.neighbours(node).tolist() == expected
+
+
+@pytest.mark.parametrize('num_sample', [5, 15])
+def test_forward_plan_uses_num_sample(sage, datacenter, num_sample):
+    """训练时的forward(plan)与inference()取相同数量的邻居"""
+    hub, others = np.zeros(40, dtype=np.int64), np.arange(1, 41)             # 节点0有40个邻居, 多于默认的10个
+    datacenter.cora_adj_lists = datacenter.cora_adj_lists.update_edges(add=(np.concatenate((hub, others)), np.concatenate((others, hub))))
+    model = make_model(sage, datacenter, num_sample=num_sample)
+    nodes = np.arange(len(datacenter.cora_adj_lists))
+    with torch.no_grad():
+        embs = model(nodes, model.build_plan(nodes))
+    assert torch.allclose(embs, model.inference()[torch.from_numpy(nodes)], atol=1e-6)
+
+
+@pytest.mark.parametrize('gcn', [True, False])
+def test_update_graph_matches_full_recompute(sage, datacenter, gcn):
+    dc = datacenter
+    model = make_model(sage, dc, gcn)
+    unsupervised_loss = sage.UnsupervisedLoss(dc.cora_adj_lists, dc.cora_train, 'cpu')
+    for node in range(0, len(dc.cora_adj_lists), 4):                     # 先填充负采样缓存
+        unsupervised_loss.neg_sampler._k_hop(node)
+    cache = sage.EmbeddingCache(model, dc, 'cora')
+    cache.get()
+
+    N = len(dc.cora_adj_lists)
+    rows, cols = dc.cora_adj_lists.edges()
+    new_features = np.random.RandomState(1).rand(2, model.input_size).astype(np.float32)
+    removed = [int(dc.cora_train[0]), int(dc.cora_test[0])]
+    affected = sage.update_graph(dc, 'cora', model, new_features=new_features,
+                                 add_edges=(np.array([N, 5, N + 1, 77]), np.array([5, N, 77, N + 1])),
+                                 remove_edges=(rows[:3], cols[:3]), remove_nodes=removed,
+                                 unsupervised_loss=unsupervised_loss, emb_cache=cache)
+
+    assert len(affected) < len(cache.embs) == N + 2
+    assert torch.allclose(cache.embs, model.inference(), atol=1e-6)
+    assert all(np.array_equal(hop, dc.cora_adj_lists.k_hop([node], 5)) for node, hop in unsupervised_loss.neg_sampler.cache.items())
+    for split in ('_train', '_val', '_test'):
+        assert not np.isin(getattr(dc, 'cora' + split), removed).any()
+    assert not np.isin(unsupervised_loss.neg_sampler.train_nodes, removed).any()
+    assert len(dc.cora_feats) == len(dc.cora_labels) == N + 2
+
+
+def test_append_rows_reserves_capacity(sage):
+    class Holder(object):
+        pass
+    holder = Holder()
+    holder.feats = torch.zeros(10, 3)
+    pointers = set()
+    for i in range(20):
+        sage.append_rows(holder, 'feats', np.full((2, 3), i, dtype=np.float32))
+        pointers.add(holder.feats.data_ptr())
+    assert holder.feats.shape == (50, 3)
+    assert len(pointers) == 3                                               # 容量 20, 40, 80
+    assert torch.equal(holder.feats[10:], torch.arange(20.).repeat_interleave(2).unsqueeze(1).expand(40, 3))
+
+
+def run_epoch(sage, dc, num_workers, seed, batches):
+    model = make_model(sage, dc)
+    unsupervised_loss = sage.UnsupervisedLoss(dc.cora_adj_lists, dc.cora_train, 'cpu')
+    prefetcher = sage.BatchPrefetcher(model, unsupervised_loss, num_workers=num_workers)
+    try:
+        return list(prefetcher.epoch(batches, 6, seed=seed))
+    finally:
+        prefetcher.close()
+
+
+def test_prefetch_independent_of_num_workers(sage, datacenter):
+    batches = [datacenter.cora_train[i:i + 20] for i in range(0, 140, 20)]
+    state = np.random.get_state()[1].copy()
+    serial = run_epoch(sage, datacenter, 0, 123, batches)
+    assert np.array_equal(np.random.get_state()[1], state)                 # 训练进程的随机数不受采样影响
+    for num_workers in (2, 3):
+        assert_same_batches(run_epoch(sage, datacenter, num_workers, 123, batches), serial)
+    other = run_epoch(sage, datacenter, 0, 124, batches)
+    assert not all(np.array_equal(a['negative_pairs'], b['negative_pairs']) for (a, _), (b, _) in zip(other, serial))
+
+
+def assert_same_batches(batches, expected):
+    assert len(batches) == len(expected)
+    for (pairs, plan), (expected_pairs, expected_plan) in zip(batches, expected):
+        for key in ('nodes', 'positive_pairs', 'negative_pairs', 'unique_nodes'):
+            assert np.array_equal(pairs[key], expected_pairs[key])
+        for layer, expected_layer in zip(plan, expected_plan):
+            assert all(np.array_equal(a, b) for a, b in zip(layer, expected_layer))
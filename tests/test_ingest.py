@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""分块读取、外部归并得到的CSR与一次性在内存中构造的CSR相同"""
+
+import numpy as np
+import pytest
+
+from common.ingest import NodeIndex, edge_file_to_csr
+
+
+def reference_csr(edges, num_nodes, symmetric, dedupe):
+    if symmetric:
+        edges = np.concatenate((edges, edges[:, ::-1]))
+    keys = edges[:, 0] * num_nodes + edges[:, 1]
+    keys = np.unique(keys) if dedupe else np.sort(keys)
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys // num_nodes, minlength=num_nodes), out=indptr[1:])
+    return indptr, keys % num_nodes
+
+
+@pytest.fixture(scope='module')
+def edge_file(tmp_path_factory):
+    """名称为字符串的小图, 含重复边、自环和没有边的节点"""
+    rng = np.random.RandomState(0)
+    names = np.array(['n%d' % i for i in rng.permutation(40)])
+    edges = rng.randint(35, size=(150, 2))
+    edges = np.concatenate((edges, edges[:10], [[3, 3], [34, 0]]))
+    path = tmp_path_factory.mktemp('ingest') / 'toy.cites'
+    path.write_text(''.join('%s\t%s\n' % (names[u], names[v]) for u, v in edges))
+    return str(path), NodeIndex(names), edges
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64, 1 << 20])
+@pytest.mark.parametrize('symmetric', [False, True])
+@pytest.mark.parametrize('dedupe', [False, True])
+def test_chunked_csr_matches_in_memory(edge_file, tmp_path, chunk_size, symmetric, dedupe):
+    path, node_index, edges = edge_file
+    indptr, indices = edge_file_to_csr(path, node_index, str(tmp_path), chunk_size=chunk_size,
+                                       symmetric=symmetric, dedupe=dedupe)
+    expected_indptr, expected_indices = reference_csr(edges, len(node_index), symmetric, dedupe)
+    assert np.array_equal(indptr, expected_indptr)
+    assert np.array_equal(indices, expected_indices)
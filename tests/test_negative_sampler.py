@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""NegativeSampler: 负样本不在k跳以内, 远节点太少时退化为精确计算, 缓存不超过cache_elements"""
+
+import numpy as np
+import pytest
+
+
+def test_negatives_outside_k_hop(sage, datacenter):
+    np.random.seed(0)
+    graph, train = datacenter.cora_adj_lists, datacenter.cora_train
+    for weighted in (False, True):
+        sampler = sage.NegativeSampler(graph, train, num_hops=2, weighted=weighted)
+        nodes = train[:60]
+        pairs = sampler.sample(nodes, 8)
+        assert np.isin(pairs[:, 1], train).all()
+        for node in nodes:
+            negatives = pairs[pairs[:, 0] == node, 1]
+            assert len(negatives) == len(np.unique(negatives)) == 8
+            assert not np.isin(negatives, graph.k_hop([node], 2)).any()
+
+
+def clique_with_pair(sage):
+    """节点0..27两两相连, 28和29只与对方相连: 节点0的远节点只有28和29"""
+    rows, cols = np.triu_indices(28, 1)
+    rows, cols = np.concatenate((rows, [28])), np.concatenate((cols, [29]))
+    return sage.CSRGraph.from_edges(np.concatenate((rows, cols)), np.concatenate((cols, rows)), 30)
+
+
+@pytest.mark.parametrize('max_rounds', [0, 5])
+def test_exact_fallback_when_rejection_fails(sage, max_rounds):
+    np.random.seed(0)
+    sampler = sage.NegativeSampler(clique_with_pair(sage), np.arange(30), num_hops=2, max_rounds=max_rounds)
+    pairs = sampler.sample([0, 3], 5)                                       # 只有2个远节点, 拒绝采样不可能凑够5个
+    assert pairs.tolist() == [[0, 28], [0, 29], [3, 28], [3, 29]]
+
+    pairs = sampler.sample([28], 40)                                        # 远节点就是0..27
+    assert pairs[:, 1].tolist() == list(range(28))
+
+
+def test_fallback_samples_without_replacement(sage):
+    np.random.seed(0)
+    sampler = sage.NegativeSampler(clique_with_pair(sage), np.arange(30), num_hops=2, max_rounds=0)
+    negatives = sampler.sample([28], 10)[:, 1]
+    assert len(np.unique(negatives)) == 10 and (negatives < 28).all()
+
+
+def test_cache_stays_within_budget(sage, datacenter):
+    np.random.seed(0)
+    graph, train = datacenter.cora_adj_lists, datacenter.cora_train
+    budget = 200
+    sampler = sage.NegativeSampler(graph, train, num_hops=2, cache_elements=budget)
+    for start in range(0, 120, 10):
+        sampler.sample(train[start:start + 10], 4)
+        sizes = [len(hop) for hop in sampler.cache.values()]
+        assert sampler.cached_elements == sum(sizes) <= budget
+    assert 0 < len(sampler.cache) < 120
+
+    small = sage.NegativeSampler(graph, train, num_hops=5, cache_elements=10)  # 比整个缓存还大的集合不缓存
+    small.sample(train[:5], 4)
+    assert len(small.cache) == 0 and small.cached_elements == 0
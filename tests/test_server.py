@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""推理服务的结果与GraphSage.forward一致, 不合法的请求返回400, 超时返回504且不再计算已取消的请求"""
+
+import http.client
+import json
+import threading
+import time
+from concurrent.futures import TimeoutError
+from contextlib import contextmanager
+
+import numpy as np
+import pytest
+import torch
+
+
+@pytest.fixture
+def engine(sage, server, datacenter):
+    torch.manual_seed(0)
+    features = torch.from_numpy(np.array(datacenter.cora_feats))
+    graphSage = sage.GraphSage(2, features.size(1), 16, features, datacenter.cora_adj_lists, 'cpu', gcn=True)
+    classification = sage.Classification(16, 4)
+    engine = server.InferenceEngine(graphSage, classification)
+    yield engine
+    engine.close()
+
+
+def test_existing_and_new_nodes_match_forward(engine):
+    graphSage = engine.graphSage
+    nodes = [5, 17, 120]
+    with torch.no_grad():
+        expected = graphSage(nodes)
+    result = engine.predict(nodes=nodes)
+    assert np.allclose(result['embeddings'], expected.numpy(), atol=1e-6)
+
+    v = 120                                                                 # 特征和邻居都与节点v相同的新节点得到相同的嵌入
+    new_node = {'features': graphSage.raw_features[v].tolist(), 'neighbours': graphSage.adj_lists.neighbours(v).tolist()}
+    result = engine.predict(new_nodes=[new_node])
+    assert np.allclose(result['embeddings'][0], expected[2].numpy(), atol=1e-6)
+
+
+@pytest.mark.parametrize('nodes', [[3.7], [3, '4'], [True], [2 ** 70], [-1], [10 ** 6]])
+def test_rejects_invalid_node_ids(engine, nodes):
+    with pytest.raises(ValueError):
+        engine.predict(nodes=nodes)
+
+
+def test_rejects_non_integer_neighbours(engine):
+    features = engine.graphSage.raw_features[0].tolist()
+    with pytest.raises(ValueError):
+        engine.predict(new_nodes=[{'features': features, 'neighbours': [1.5]}])
+
+
+@contextmanager
+def serving(server, engine, **kwargs):
+    httpd = server.make_server(engine, port=0, **kwargs)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    try:
+        yield http.client.HTTPConnection('127.0.0.1', httpd.server_address[1])
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def post(connection, body):
+    connection.request('POST', '/predict', json.dumps(body))
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def test_http_bad_request(server, engine):
+    with serving(server, engine) as connection:
+        status, result = post(connection, {'nodes': [3.7]})
+        assert status == 400
+        assert 'integers' in result['error']
+
+
+def blocking_infer(engine, monkeypatch):
+    """让engine的micro-batch等到release.set()才开始计算, 返回(release, 每个micro-batch的目标节点)"""
+    release, batches = threading.Event(), []
+    infer = engine._infer
+
+    def slow_infer(batch):
+        batches.append([int(n) for request in batch for n in request.nodes])
+        release.wait(10)
+        return infer(batch)
+    monkeypatch.setattr(engine, '_infer', slow_infer)
+    return release, batches
+
+
+def test_http_timeout(server, engine, monkeypatch):
+    release, batches = blocking_infer(engine, monkeypatch)
+    with serving(server, engine, timeout=0.2) as connection:
+        status, result = post(connection, {'nodes': [5]})
+        assert status == 504 and '0.2s' in result['error']
+        status, result = post(connection, {'nodes': [6]})                  # 排在阻塞的micro-batch后面, 超时后取消
+        assert status == 504
+        release.set()
+        status, result = post(connection, {'nodes': [7]})
+        assert status == 200 and len(result['labels']) == 1
+    assert batches == [[5], [7]]
+
+
+def test_cancelled_requests_are_skipped(engine, monkeypatch):
+    release, batches = blocking_infer(engine, monkeypatch)
+    running = engine.submit(nodes=[1])
+    while not batches:
+        time.sleep(0.01)
+    with pytest.raises(TimeoutError):
+        engine.predict(nodes=[2], timeout=0.05)
+    release.set()
+    assert running.result(10)['labels'] and engine.predict(nodes=[3], timeout=10)['labels']
+    assert batches == [[1], [3]]
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""UnsupervisedLoss的向量化损失与原来逐节点循环的实现一致"""
+
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+
+def loop_loss_sage(loss, embeddings):
+    """原来的get_loss_sage: 逐个源节点计算"""
+    node2index = {n: i for i, n in enumerate(loss.unique_nodes_batch)}
+    nodes_score = []
+    for node in loss.node_positive_pairs:
+        pps, nps = loss.node_positive_pairs[node], loss.node_negative_pairs[node]
+        if len(pps) == 0 or len(nps) == 0:
+            continue
+        neg_score = F.cosine_similarity(embeddings[[node2index[x] for x in nps[:, 0]]], embeddings[[node2index[x] for x in nps[:, 1]]])
+        neg_score = loss.Q * torch.mean(torch.log(torch.sigmoid(-neg_score)), 0)
+        pos_score = F.cosine_similarity(embeddings[[node2index[x] for x in pps[:, 0]]], embeddings[[node2index[x] for x in pps[:, 1]]])
+        pos_score = torch.log(torch.sigmoid(pos_score))
+        nodes_score.append(torch.mean(- pos_score - neg_score).view(1, -1))
+    return torch.mean(torch.cat(nodes_score, 0))
+
+
+def loop_loss_margin(loss, embeddings):
+    """原来的get_loss_margin: 逐个源节点计算"""
+    node2index = {n: i for i, n in enumerate(loss.unique_nodes_batch)}
+    nodes_score = []
+    for node in loss.node_positive_pairs:
+        pps, nps = loss.node_positive_pairs[node], loss.node_negative_pairs[node]
+        if len(pps) == 0 or len(nps) == 0:
+            continue
+        pos_score = F.cosine_similarity(embeddings[[node2index[x] for x in pps[:, 0]]], embeddings[[node2index[x] for x in pps[:, 1]]])
+        pos_score, _ = torch.min(torch.log(torch.sigmoid(pos_score)), 0)
+        neg_score = F.cosine_similarity(embeddings[[node2index[x] for x in nps[:, 0]]], embeddings[[node2index[x] for x in nps[:, 1]]])
+        neg_score, _ = torch.max(torch.log(torch.sigmoid(neg_score)), 0)
+        nodes_score.append(torch.clamp(neg_score - pos_score + loss.MARGIN, min=0.0).view(1, -1))
+    return torch.mean(torch.cat(nodes_score, 0), 0)
+
+
+@pytest.mark.parametrize('num_neg', [6, 100])
+@pytest.mark.parametrize('method', ['sage', 'margin'])
+def test_vectorised_loss_matches_loop(sage, datacenter, num_neg, method):
+    np.random.seed(0)
+    loss = sage.UnsupervisedLoss(datacenter.cora_adj_lists, datacenter.cora_train, 'cpu')
+    nodes = loss.extend_nodes(datacenter.cora_train[:40], num_neg=num_neg)
+    assert sum(len(p) > 0 for p in loss.node_positive_pairs.values()) > 0
+    embeddings = torch.randn(len(nodes), 16, generator=torch.Generator().manual_seed(0), requires_grad=True)
+
+    vectorised = getattr(loss, 'get_loss_' + method)(embeddings, nodes)
+    grad, = torch.autograd.grad(vectorised, embeddings)
+    reference = {'sage': loop_loss_sage, 'margin': loop_loss_margin}[method](loss, embeddings).squeeze()
+    reference_grad, = torch.autograd.grad(reference, embeddings)
+    assert torch.allclose(vectorised, reference, atol=1e-6)
+    assert torch.allclose(grad, reference_grad, atol=1e-6)